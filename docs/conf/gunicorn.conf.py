@@ -0,0 +1,17 @@
+# gunicorn configuration with asynchronous workers (gevent): one process holds
+# many slow or waiting connections (see COMMENTS_WAIT). In $INSTALL_PATH:
+#   gunicorn -c docs/conf/gunicorn.conf.py papillon.wsgi:application
+
+bind = '127.0.0.1:8000'
+worker_class = 'gevent'
+workers = 2
+# connections by worker
+worker_connections = 1000
+
+def post_fork(server, worker):
+    # with PostgreSQL let other requests run while waiting for the database
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        return
+    patch_psycopg()
@@ -18,6 +18,9 @@ sys.path.append(sep.join(curdir.split(sep)[:-1]))
 
 
 from papillon.polls.models import Poll
+from papillon.polls.routers import pollDatabases, useShard
 
-for poll in Poll.objects.all():
-    poll.checkForErasement()
+for alias in pollDatabases():
+    useShard(alias)
+    for poll in Poll.objects.using(alias).all():
+        poll.checkForErasement()
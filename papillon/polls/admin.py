@@ -21,14 +21,138 @@
 Settings for administration pages
 """
 
-from papillon.polls.models import Poll, Category
+import datetime
+
+from papillon.polls.models import Poll, Category, Voter, Vote, Webhook, \
+                                  purgePolls, queueWebhookEvents
+from papillon.polls.database import estimateCount
+from django.conf import settings
 from django.contrib import admin
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.db.models.query import QuerySet
+from django.utils.translation import ugettext, ugettext_lazy as _
+
+class EstimatedCountQuerySet(QuerySet):
+    '''Counting all the polls of a big table is slow: without filter their
+    number is estimated by the database when it is over ADMIN_ESTIMATED_COUNT
+    '''
+    def count(self):
+        if self._result_cache is None and not self.query.where:
+            estimate = estimateCount(self.model, self.db)
+            if estimate is not None \
+               and estimate >= settings.ADMIN_ESTIMATED_COUNT:
+                return estimate
+        return super(EstimatedCountQuerySet, self).count()
+
+# counts computed by the database for the displayed polls only
+COUNTS = {
+    'voter_count':"SELECT COUNT(*) FROM %(voter)s WHERE "
+                  "%(voter)s.poll_id = %(poll)s.id",
+    'vote_count':"SELECT COUNT(*) FROM %(vote)s INNER JOIN %(voter)s ON "
+                 "%(vote)s.voter_id = %(voter)s.id WHERE "
+                 "%(voter)s.poll_id = %(poll)s.id",
+}
+TABLES = {'poll':Poll._meta.db_table, 'voter':Voter._meta.db_table,
+          'vote':Vote._meta.db_table}
 
 class PollAdmin(admin.ModelAdmin):
     search_fields = ("name",)
-    list_display = ('name', 'category', 'modification_date', 'public', 'open')
+    list_display = ('name', 'category', 'modification_date', 'public', 'open',
+                    'voterCount', 'voteCount', 'comment_count')
     list_filter = ('public', 'open', 'category')
+    actions = ['closePolls', 'reopenPolls', 'archivePolls', 'purgePolls']
+    readonly_fields = ('comment_count',)
+
+    def queryset(self, request):
+        queryset = super(PollAdmin, self).queryset(request)
+        counts = ('voter_count',)
+        if not settings.PACKED_BALLOTS:
+            counts += ('vote_count',)
+        # a nullable foreign key has to be named to be joined
+        return queryset._clone(klass=EstimatedCountQuerySet).select_related(
+                       'category').extra(select=dict([(key, COUNTS[key] % TABLES)
+                                                       for key in counts]))
+
+    def get_list_display(self, request):
+        if settings.PACKED_BALLOTS:
+            # packed votes are not rows
+            return [field for field in self.list_display
+                    if field != 'voteCount']
+        return self.list_display
+
+    def voterCount(self, obj):
+        return obj.voter_count
+    voterCount.short_description = _("Voters")
+
+    def voteCount(self, obj):
+        return obj.vote_count
+    voteCount.short_description = _("Votes")
+
+    def save_model(self, request, obj, form, change):
+        if change:
+            obj.saveEdited(using=getattr(self, 'using', None))
+        else:
+            obj.save(using=getattr(self, 'using', None))
+
+    def getDatabase(self):
+        return getattr(self, 'using', None) or DEFAULT_DB_ALIAS
+
+    def updatePolls(self, request, queryset, message, event, **values):
+        using = self.getDatabase()
+        queryset = queryset.using(using)
+        with transaction.commit_on_success(using=using):
+            changed = queryset.exclude(open=values['open']).values('pk')
+            queueWebhookEvents(Webhook.objects.using(using).filter(
+                                                  poll__in=changed), event)
+            # the modification date is the version of the pages of the poll
+            values['modification_date'] = datetime.datetime.now()
+            number = queryset.update(**values)
+        self.message_user(request, message % number)
+
+    def closePolls(self, request, queryset):
+        self.updatePolls(request, queryset, ugettext("%d poll(s) closed."),
+                         'closed', open=False)
+    closePolls.short_description = _("Close selected polls")
+
+    def reopenPolls(self, request, queryset):
+        self.updatePolls(request, queryset, ugettext("%d poll(s) reopened."),
+                         'reopened', open=True)
+    reopenPolls.short_description = _("Reopen selected polls")
+
+    def archivePolls(self, request, queryset):
+        self.updatePolls(request, queryset, ugettext("%d poll(s) archived."),
+                         'closed', open=False, public=False)
+    archivePolls.short_description = _("Archive selected polls (closed and \
+removed from the main page)")
+
+    def purgePolls(self, request, queryset):
+        number = purgePolls(queryset, using=self.getDatabase())
+        self.message_user(request, ugettext("%d poll(s) purged.") % number)
+    purgePolls.short_description = _("Purge selected polls with their votes \
+and comments")
+
+class ShardPollAdmin(PollAdmin):
+    '''Administration of the polls stored on the database "using"'''
+    using = None
+
+    def queryset(self, request):
+        return super(ShardPollAdmin, self).queryset(request).using(self.using)
+
+    def delete_model(self, request, obj):
+        obj.delete(using=self.using)
+
+    def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
+        return super(ShardPollAdmin, self).formfield_for_foreignkey(db_field,
+                                     request=request, using=self.using, **kwargs)
 
 # register of differents database fields
 admin.site.register(Category)
 admin.site.register(Poll, PollAdmin)
+
+# one administration site by shard: ids of polls are only unique on a shard
+shard_sites = []
+for alias in settings.SHARD_DATABASES:
+    site = admin.AdminSite(name='admin_' + alias)
+    site.register(Poll, type('ShardPollAdmin_' + str(alias),
+                             (ShardPollAdmin,), {'using':alias}))
+    shard_sites.append((alias, site))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Static files built by management commands
+'''
+
+import hashlib
+import json
+import os
+
+from django.conf import settings
+
+# javascript catalogs written by "./manage.py compile_jsi18n"
+JS_CATALOG_DIR = 'jsi18n'
+JS_CATALOG_MANIFEST = 'catalogs.json'
+# static files collected by "./manage.py collect_assets"
+ASSETS_MANIFEST = 'assets.json'
+
+def hashedName(name, content):
+    "Name of a file with the hash of its content: the name changes with it"
+    base, ext = os.path.splitext(name)
+    return '%s.%s%s' % (base, hashlib.md5(content).hexdigest()[:12], ext)
+
+def writeFile(path, content):
+    "Write a file atomically: it can be served while it is written"
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as tmp:
+        tmp.write(content)
+    os.rename(tmp_path, path)
+
+def loadManifest(path):
+    "Names of the built files by source name - empty if not built"
+    try:
+        with open(path) as manifest:
+            return json.load(manifest)
+    except (IOError, ValueError):
+        return {}
+
+_manifests = {}
+
+def getManifest(path):
+    "Manifest loaded again when it is rewritten - by a rename"
+    try:
+        stat = os.stat(path)
+        version = (stat.st_ino, stat.st_mtime)
+    except OSError:
+        version = None
+    if path not in _manifests or _manifests[path][0] != version:
+        _manifests[path] = (version, loadManifest(path))
+    return _manifests[path][1]
+
+def getAssetUrl(name):
+    '''Url of a static file - name is relative to MEDIA_ROOT, admin files
+    are in "admin/". The collected copy is used if any.
+    '''
+    assets = getManifest(os.path.join(settings.ASSETS_ROOT, ASSETS_MANIFEST))
+    if name in assets:
+        return settings.ASSETS_URL + assets[name]
+    if name.startswith('admin/'):
+        return settings.ADMIN_MEDIA_PREFIX + name[len('admin/'):]
+    return settings.MEDIA_URL + name
+
+def getJsCatalogUrl(language):
+    '''Url of the compiled javascript catalog of language - None if it has
+    not been compiled'''
+    catalogs = getManifest(os.path.join(settings.MEDIA_ROOT, JS_CATALOG_DIR,
+                                        JS_CATALOG_MANIFEST))
+    name = catalogs.get(language) or catalogs.get(language.split('-')[0])
+    if not name:
+        return None
+    return getAssetUrl(JS_CATALOG_DIR + '/' + name)
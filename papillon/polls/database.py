@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Database tuning and write serialization
+'''
+
+import sys
+import threading
+import Queue
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from papillon.polls.routers import primary, markWritten, onShard, \
+                                   currentShard
+from papillon.polls.overload import measured
+
+
+def setSqlitePragmas(sender, connection, **kwargs):
+    """Apply SQLITE_PRAGMAS to each new sqlite connection
+    Connected to the connection_created signal in models.py.
+    """
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', None)
+    if not pragmas:
+        return
+    cursor = connection.connection.cursor()
+    for key in pragmas:
+        cursor.execute('PRAGMA %s = %s' % (key, pragmas[key]))
+    cursor.close()
+
+
+def estimateCount(model, using):
+    """Number of rows of the table of a model according to the statistics of
+    the database - None if the database doesn't keep them
+    """
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        sql = "SELECT reltuples FROM pg_class WHERE relname = %s"
+    elif connection.vendor == 'mysql':
+        sql = "SELECT table_rows FROM information_schema.tables WHERE "\
+              "table_schema = DATABASE() AND table_name = %s"
+    else:
+        return None
+    cursor = connection.cursor()
+    cursor.execute(sql, [model._meta.db_table])
+    row = cursor.fetchone()
+    if not row or row[0] is None:
+        return None
+    return int(row[0])
+
+
+class WriteTask(object):
+    '''A write waiting in the writer queue'''
+    def __init__(self, fct, args, kwargs):
+        self.fct, self.args, self.kwargs = fct, args, kwargs
+        self.result, self.exc_info = None, None
+        self.done = threading.Event()
+
+    def execute(self):
+        try:
+            self.result = self.fct(*self.args, **self.kwargs)
+        except:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class Writer(threading.Thread):
+    '''Dedicated thread executing every write of the application one after
+    the other: with sqlite there is only one writer at a time so queuing in
+    Python is cheaper than waiting for the database lock.
+    '''
+    def __init__(self):
+        threading.Thread.__init__(self, name='papillon-writer')
+        self.daemon = True
+        self.queue = Queue.Queue()
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            task.execute()
+            if task.exc_info:
+                # don't keep connections in an unknown state
+                for conn in connections.all():
+                    conn.close()
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def getWriter():
+    global _writer
+    with _writer_lock:
+        if not _writer or not _writer.is_alive():
+            _writer = Writer()
+            _writer.start()
+    return _writer
+
+def write(fct, *args, **kwargs):
+    """Execute fct in a transaction and return its result
+    If SINGLE_WRITER is set, the call is made by the writer thread and the
+    current thread waits for its completion. Its duration is added to the
+    database latency of the overload protection. Reads made by fct are done on the
+    primary database and on the shard of the current request.
+    """
+    shard = currentShard()
+    def transactional():
+        with primary():
+            with onShard(shard):
+                with transaction.commit_on_success(using=shard):
+                    return fct(*args, **kwargs)
+    markWritten()
+    if not getattr(settings, 'SINGLE_WRITER', False) \
+       or threading.current_thread() is _writer:
+        with measured():
+            return transactional()
+    task = WriteTask(transactional, (), {})
+    # the wait in the queue is part of the latency
+    with measured():
+        getWriter().queue.put(task)
+        return task.wait()
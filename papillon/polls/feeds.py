@@ -25,7 +25,7 @@ from django.contrib.syndication.views import Feed
 from django.utils.translation import gettext_lazy as _
 from django.utils.safestring import mark_safe
 
-from papillon.polls.models import Poll, Vote, Voter
+from papillon.polls.models import Poll, Vote, Voter, getPoll
 
 
 class PollLatestEntries(Feed):
@@ -33,7 +33,10 @@ class PollLatestEntries(Feed):
         self.request = request
         if len(poll_url) < 1:
             raise ObjectDoesNotExist
-        return Poll.objects.get(base_url=poll_url)
+        poll = getPoll(base_url=poll_url)
+        if not poll:
+            raise ObjectDoesNotExist
+        return poll
 
     def title(self, obj):
         return _("Papillon - poll : ") + obj.name
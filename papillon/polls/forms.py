@@ -21,35 +21,56 @@
 Forms management
 '''
 
+import urlparse
 from datetime import datetime
 
 from django import forms
 from django.contrib.admin import widgets as adminwidgets
 from django.utils.translation import gettext_lazy as _
 
-from papillon.polls.models import Poll, Category, Choice, Comment
+from papillon.polls.models import Poll, Choice, Comment, Webhook, \
+                                  hasCategories
+from papillon.polls.assets import getAssetUrl
+from papillon.polls.webhooks import CONNECTIONS, parseAddress, \
+                                    isPublicAddress, isAllowedHost
 from django.conf import settings
 
 class TextareaWidget(forms.Textarea):
     """
     Manage the edition of a text using TinyMCE
     """
-    class Media:
-        js = ["%stiny_mce.js" % settings.TINYMCE_URL,
-              "%stextareas.js" % settings.MEDIA_URL,]
+    @property
+    def media(self):
+        # at rendering: the collected copy changes with "collect_assets"
+        return forms.Media(js=["%stiny_mce.js" % settings.TINYMCE_URL,
+                               getAssetUrl("textareas.js"),])
 
 class PollForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
         super(PollForm, self).__init__(*args, **kwargs)
         self.fields['description'].widget = TextareaWidget()
+        # categories can be added at any time: not decided at import
+        if not hasCategories():
+            del self.fields['category']
 
 class CreatePollForm(PollForm):
+    author_email = forms.EmailField(required=False, label=_("E-mail"),
+        help_text=_("Give your e-mail to receive digests of the new votes and \
+comments"))
     class Meta:
         model = Poll
         exclude = ['base_url', 'admin_url', 'open', 'author', 'enddate', 
                     'public', 'opened_admin', 'hide_choices']
-        if not Category.objects.all():
-            exclude.append('category')
+
+class ApiPollForm(forms.ModelForm):
+    '''Settings of a poll created with the JSON API'''
+    author_email = forms.EmailField(required=False)
+    class Meta:
+        model = Poll
+        fields = ['author_name', 'name', 'description', 'category', 'type',
+                  'dated_choices', 'enddate', 'opened_admin', 'hide_choices']
+        if settings.ALLOW_FRONTPAGE_POLL:
+            fields.append('public')
 
 class CommentForm(forms.ModelForm):
     class Meta:
@@ -59,6 +80,31 @@ class CommentForm(forms.ModelForm):
         super(CommentForm, self).__init__(*args, **kwargs)
         self.fields['text'].widget = TextareaWidget()
 
+class WebhookForm(forms.ModelForm):
+    class Meta:
+        model = Webhook
+        fields = ('url',)
+    def __init__(self, *args, **kwargs):
+        super(WebhookForm, self).__init__(*args, **kwargs)
+        # the form also deletes webhooks
+        self.fields['url'].required = False
+
+    def clean_url(self):
+        '''Only http and https addresses - not on a local address. The names
+        are resolved and checked at each delivery.'''
+        url = self.cleaned_data['url']
+        if not url:
+            return url
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme not in CONNECTIONS:
+            raise forms.ValidationError(_("Only http and https addresses are "
+                                          "allowed."))
+        host = parsed.hostname or ''
+        if parseAddress(host) and not isPublicAddress(host) \
+           and not isAllowedHost(host):
+            raise forms.ValidationError(_("This address is not public."))
+        return url
+
 # workaround for SplitDateTime with required=False
 class SplitDateTimeJSField(forms.SplitDateTimeField):
     def __init__(self, *args, **kwargs):
@@ -71,8 +117,6 @@ class AdminPollForm(PollForm):
         model = Poll
         exclude = ['author', 'author_name', 'base_url', 'admin_url',
                    'dated_choices', 'type']
-        if not Category.objects.all():
-            exclude.append('category')
         if not settings.ALLOW_FRONTPAGE_POLL:
             exclude.append('public')
     enddate = SplitDateTimeJSField(widget=adminwidgets.AdminSplitDateTime(),
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+WSGI handler of Papillon
+'''
+
+import urlparse
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.http import Http404, HttpResponseNotFound
+
+from papillon.polls.views import asset
+
+class PapillonHandler(WSGIHandler):
+    '''WSGI handler sending the files collected in ASSETS_URL without the
+    middlewares: they are not compressed again nor varied by language or
+    session, so shared caches keep them.
+    '''
+    def get_response(self, request):
+        prefix = urlparse.urlsplit(settings.ASSETS_URL).path
+        if request.method not in ('GET', 'HEAD') \
+           or not request.path.startswith(prefix):
+            return WSGIHandler.get_response(self, request)
+        try:
+            response = asset(request, request.path[len(prefix):])
+        except Http404:
+            response = HttpResponseNotFound()
+        return self.apply_response_fixes(request, response)
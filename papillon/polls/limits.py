@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Limits on the votes and comments posted: sliding windows by client and by poll
+and detection of repeated ballots. The state is kept in the cache - shared by
+the processes with memcached, see local_settings.py.sample - so abusive
+requests are refused without any query on the database.
+'''
+
+import hashlib
+import struct
+import threading
+import time
+import unicodedata
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.translation import ugettext as _
+
+# number of bits of the filter set by a ballot
+FILTER_HASHES = 4
+# lock of the filter of a poll during an addition: seconds before it expires
+# and tries to take it every FILTER_LOCK_WAIT seconds
+FILTER_LOCK_TIMEOUT = 2
+FILTER_LOCK_ATTEMPTS = 200
+FILTER_LOCK_WAIT = 0.005
+
+# incr of the local memory cache is a get then a set: the counters are
+# changed one at a time in the process - memcached changes them atomically
+_counters_lock = threading.Lock()
+
+def getClientAddress(request):
+    '''Address of the client. Behind a proxy CLIENT_ADDRESS_HEADER is a header
+    like X-Forwarded-For: the address added by the proxy is the last one.
+    '''
+    address = request.META.get(settings.CLIENT_ADDRESS_HEADER, '') \
+              or request.META.get('REMOTE_ADDR', '')
+    return address.split(',')[-1].strip()
+
+def countPost(key, rate):
+    '''Count a post in the window of key limited to rate - a tuple (number
+    of posts, seconds). The previous window counts for the part of it still
+    in the last period. Return 0 or the seconds to wait. The counters are only
+    changed by add, incr and decr: atomic with memcached, so the processes
+    cannot take the same last post.
+    '''
+    capacity, period = rate
+    window, elapsed = divmod(time.time(), period)
+    current = '%s_%d' % (key, window)
+    # kept during the next window
+    timeout = int(period) * 2 + 1
+    with _counters_lock:
+        cache.add(current, 0, timeout)
+        try:
+            count = cache.incr(current)
+        except ValueError:
+            # expired meanwhile
+            cache.add(current, 1, timeout)
+            count = 1
+    previous = cache.get('%s_%d' % (key, window - 1), 0)
+    weight = 1 - elapsed / period
+    if previous * weight + count <= capacity:
+        return 0
+    # a refused post is not counted
+    with _counters_lock:
+        try:
+            cache.decr(current)
+        except ValueError:
+            pass
+    if previous and count <= capacity:
+        # until enough previous posts have left the period
+        return (previous * weight + count - capacity) / previous * period
+    return period - elapsed
+
+def isPost(request):
+    "A vote or a comment is posted"
+    return request.method == 'POST' and ('author_name' in request.POST
+                                          or 'comment' in request.POST)
+
+def throttle(request, poll_url):
+    '''Refuse the votes and comments on the poll above the rates
+    POST_RATE_BY_CLIENT and POST_RATE_BY_POLL: return a "429 Too Many
+    Requests" response or None.
+    '''
+    wait = 0
+    if settings.POST_RATE_BY_CLIENT:
+        key = 'papillon_rate_client_' + hashlib.md5(
+                            getClientAddress(request)).hexdigest()
+        wait = countPost(key, settings.POST_RATE_BY_CLIENT)
+    if not wait and settings.POST_RATE_BY_POLL:
+        key = 'papillon_rate_poll_' + poll_url.split('_')[0]
+        wait = countPost(key, settings.POST_RATE_BY_POLL)
+    if not wait:
+        return
+    response = HttpResponse(_("Too many votes or comments: try again later."),
+                            status=429, content_type='text/plain; charset=utf-8')
+    response.reason_phrase = 'TOO MANY REQUESTS'
+    response['Retry-After'] = str(int(wait) + 1)
+    return response
+
+def normalizeName(name):
+    "Author name without case, accents and repeated spaces"
+    name = unicodedata.normalize('NFKD', name.lower())
+    name = u''.join([c for c in name if not unicodedata.combining(c)])
+    return u' '.join(name.split())
+
+def getBallotKeys(request):
+    '''Values identifying a ballot according to DUPLICATE_BALLOTS: the
+    normalized author name and the fingerprint of the client (address and
+    headers of the browser - shared by the browsers of a same model behind a
+    same address).
+    '''
+    keys = []
+    if 'name' in settings.DUPLICATE_BALLOTS:
+        keys.append(u'name:' + normalizeName(request.POST['author_name']))
+    if 'client' in settings.DUPLICATE_BALLOTS:
+        keys.append(u'client:' + u'|'.join([getClientAddress(request)] + [
+                        request.META.get(header, '').decode('latin-1')
+                        for header in ('HTTP_USER_AGENT',
+                                       'HTTP_ACCEPT_LANGUAGE')]))
+    return keys
+
+def getBits(key):
+    "Positions of the bits of the filter set by key"
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    size = settings.DUPLICATE_FILTER_BYTES * 8
+    return [position % size
+            for position in struct.unpack('<4I', digest)[:FILTER_HASHES]]
+
+class BallotFilter(object):
+    '''Bloom filter of the ballots of a poll: DUPLICATE_FILTER_BYTES bytes
+    whatever the number of voters. A new ballot can be taken for a repeat
+    (false positive) when the filter fills up: about 2% once as many keys as
+    bytes have been added.
+    '''
+    def __init__(self, poll):
+        self.key = 'papillon_ballots_' + poll.base_url
+        self.lock_key = self.key + '_lock'
+
+    def getFilter(self):
+        bits = cache.get(self.key)
+        if not bits or len(bits) != settings.DUPLICATE_FILTER_BYTES:
+            return bytearray(settings.DUPLICATE_FILTER_BYTES)
+        return bytearray(bits)
+
+    def contains(self, keys):
+        "The first of the keys which has been added - None if none"
+        bits = self.getFilter()
+        for key in keys:
+            if all([bits[position // 8] & (1 << position % 8)
+                    for position in getBits(key)]):
+                return key
+        return None
+
+    def add(self, keys):
+        '''Add keys - the filter is locked in the cache so the concurrent
+        additions are kept. A lock not released by a stopped process expires.
+        '''
+        locked = False
+        for attempt in xrange(FILTER_LOCK_ATTEMPTS):
+            locked = cache.add(self.lock_key, 1, FILTER_LOCK_TIMEOUT)
+            if locked:
+                break
+            time.sleep(FILTER_LOCK_WAIT)
+        try:
+            bits = self.getFilter()
+            for key in keys:
+                for position in getBits(key):
+                    bits[position // 8] |= 1 << position % 8
+            cache.set(self.key, str(bits), settings.DUPLICATE_FILTER_TIMEOUT)
+        finally:
+            if locked:
+                cache.delete(self.lock_key)
+
+def isDuplicateBallot(request, poll):
+    '''The new ballot has already been posted on the poll: return what has
+    been found - 'name' or 'client' - or None'''
+    if not settings.DUPLICATE_BALLOTS:
+        return None
+    key = BallotFilter(poll).contains(getBallotKeys(request))
+    return key.split(':')[0] if key else None
+
+def addBallot(request, poll):
+    "Remember the new ballot of the poll"
+    if not settings.DUPLICATE_BALLOTS:
+        return
+    BallotFilter(poll).add(getBallotKeys(request))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Load a running deployment of Papillon to compare the servers
+'''
+
+import threading
+import time
+import urllib2
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+def percentile(durations, ratio):
+    if not durations:
+        return 0
+    return durations[min(int(len(durations) * ratio), len(durations) - 1)]
+
+class Client(threading.Thread):
+    "Request an address again and again until the end of the benchmark"
+    def __init__(self, url, end, timeout):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url, self.end, self.timeout = url, end, timeout
+        self.durations, self.errors = [], 0
+
+    def run(self):
+        while time.time() < self.end:
+            start = time.time()
+            try:
+                response = urllib2.urlopen(self.url, timeout=self.timeout)
+                response.read()
+                response.close()
+            except (urllib2.URLError, IOError):
+                self.errors += 1
+                continue
+            self.durations.append(time.time() - start)
+
+class Command(BaseCommand):
+    args = 'url [url ...]'
+    help = 'Request the addresses with simultaneous connections and display '\
+           'the answered requests and their durations by address. Run it '\
+           'with the same options against each deployment to compare (WSGI '\
+           'server with threads, gunicorn with gevent workers - see '\
+           'docs/conf/gunicorn.conf.py). With COMMENTS_WAIT set, the '\
+           'comments address of a poll with "?after=" the id of its last '\
+           'comment makes waiting connections.'
+    option_list = BaseCommand.option_list + (
+        make_option('--connections', type='int', dest='connections',
+            default=100, help='Simultaneous connections shared by the '
+                              'addresses'),
+        make_option('--duration', type='int', dest='duration', default=30,
+            help='Duration in seconds'),
+        make_option('--timeout', type='int', dest='timeout', default=120,
+            help='Seconds before a request is given up'),
+        )
+
+    def handle(self, *urls, **options):
+        if not urls:
+            raise CommandError('No address to request')
+        end = time.time() + options['duration']
+        clients = [Client(urls[idx % len(urls)], end, options['timeout'])
+                   for idx in xrange(options['connections'])]
+        for client in clients:
+            client.start()
+        for client in clients:
+            # the last requests end at most timeout seconds after the end
+            client.join(options['duration'] + options['timeout'])
+        for url in urls:
+            durations, errors = [], 0
+            for client in clients:
+                if client.url == url:
+                    durations += client.durations
+                    errors += client.errors
+            durations.sort()
+            self.stdout.write('%s\n  %d request(s) - %.1f/s, %d error(s)\n'
+                  '  duration: median %.3fs, 95%% %.3fs, max %.3fs\n' % (
+                  url, len(durations), len(durations) / float(
+                  options['duration']), errors, percentile(durations, 0.5),
+                  percentile(durations, 0.95), percentile(durations, 1)))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Measure the start of a process of Papillon
+'''
+
+import json
+import os
+import subprocess
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+# run in a new process: the time to load the settings, the applications and
+# the URLconf with its views (forms, admin) and the queries made meanwhile
+STARTUP = '''
+import json, time
+def loadViews(patterns):
+    for pattern in patterns:
+        if hasattr(pattern, 'url_patterns'):
+            loadViews(pattern.url_patterns)
+        else:
+            pattern.callback
+start = time.time()
+from django.conf import settings
+settings.INSTALLED_APPS
+times = [time.time()]
+from django.db import connections
+for connection in connections.all():
+    connection.use_debug_cursor = True
+from django.db.models import get_models
+get_models()
+times.append(time.time())
+from django.core.urlresolvers import get_resolver
+loadViews(get_resolver(None).url_patterns)
+times.append(time.time())
+print json.dumps({'times':[moment - start for moment in times],
+                  'queries':sum([len(connection.queries)
+                                 for connection in connections.all()])})
+'''
+
+PHASES = ('settings', 'applications', 'URLconf and views')
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Start new processes loading the settings, the applications, '\
+           'the URLconf and its views and display the median time of each step and the '\
+           'database queries made'
+    option_list = BaseCommand.option_list + (
+        make_option('--runs', type='int', dest='runs', default=10,
+            help='Number of processes started'),
+        )
+
+    def handle(self, *args, **options):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+        runs = []
+        for idx in xrange(options['runs']):
+            process = subprocess.Popen([sys.executable, '-c', STARTUP],
+                        env=env, stdout=subprocess.PIPE)
+            output = process.communicate()[0]
+            if process.returncode:
+                raise CommandError('The process has failed')
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        for idx, phase in enumerate(PHASES):
+            durations = sorted([run['times'][idx] - (idx and
+                                run['times'][idx - 1]) for run in runs])
+            self.stdout.write('%s loaded in %.3fs\n' % (phase,
+                                            durations[len(durations) // 2]))
+        totals = sorted([run['times'][-1] for run in runs])
+        self.stdout.write('started in %.3fs\n' % totals[len(totals) // 2])
+        self.stdout.write('%d database quer(y/ies) at startup\n' %
+                          max([run['queries'] for run in runs]))
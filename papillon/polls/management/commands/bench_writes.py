@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Measure the concurrent votes with and without the single writer
+'''
+
+import threading
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, DatabaseError
+
+from papillon.polls.database import write
+from papillon.polls.management.commands.bench_server import percentile
+from papillon.polls.models import Poll, PollUser, Choice, Voter, \
+                                  genRandomURL, purgePolls
+from papillon.polls.routers import shardFor, useShard
+
+def vote(poll, choices, name):
+    "Record a vote as the poll page does"
+    author = PollUser(name=name)
+    author.save()
+    voter = Voter(user=author, poll=poll)
+    voter.setVotes(dict([(choice, 1) for choice in choices[::2]]))
+    poll.touch()
+
+class Voters(threading.Thread):
+    "Vote a number of times one vote after the other"
+    def __init__(self, poll, choices, votes, idx):
+        threading.Thread.__init__(self)
+        self.poll, self.choices, self.votes, self.idx = poll, choices, \
+                                                        votes, idx
+        self.durations, self.errors = [], 0
+
+    def run(self):
+        useShard(shardFor(self.poll.base_url))
+        try:
+            for jdx in xrange(self.votes):
+                start = time.time()
+                try:
+                    write(vote, self.poll, self.choices,
+                          'voter %d-%d' % (self.idx, jdx))
+                except DatabaseError:
+                    # "database is locked"
+                    self.errors += 1
+                    continue
+                self.durations.append(time.time() - start)
+        finally:
+            connection.close()
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Vote from simultaneous threads on a temporary poll of the '\
+           'database, with SINGLE_WRITER off then on, and display the rate, '\
+           'the errors and the durations of the votes of each mode. Run it '\
+           'on a copy of the database with the SQLITE_PRAGMAS of production.'
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', type='int', dest='threads', default=20,
+            help='Simultaneous voters'),
+        make_option('--votes', type='int', dest='votes', default=50,
+            help='Votes by thread'),
+        make_option('--choices', type='int', dest='choices', default=10,
+            help='Choices of the poll'),
+        )
+
+    def bench(self, single_writer, options):
+        "Vote with SINGLE_WRITER set to single_writer"
+        base_url = genRandomURL()
+        useShard(shardFor(base_url))
+        poll = Poll.objects.create(base_url=base_url,
+                                   admin_url=genRandomURL(),
+                                   author_name='bench_writes',
+                                   name='bench_writes', description='-',
+                                   type='P')
+        choices = [Choice.objects.create(poll=poll, name='choice %d' % idx,
+                                         order=idx)
+                   for idx in xrange(options['choices'])]
+        settings.SINGLE_WRITER = single_writer
+        voters = [Voters(poll, choices, options['votes'], idx)
+                  for idx in xrange(options['threads'])]
+        start = time.time()
+        for thread in voters:
+            thread.start()
+        for thread in voters:
+            thread.join()
+        duration = time.time() - start
+        durations = sorted(sum([thread.durations for thread in voters], []))
+        errors = sum([thread.errors for thread in voters])
+        self.stdout.write('SINGLE_WRITER %s\n  %d vote(s) in %.1fs - %.1f/s, '
+              '%d error(s)\n  duration: median %.3fs, 95%% %.3fs, max %.3fs\n'
+              % ('on' if single_writer else 'off', len(durations), duration,
+                 len(durations) / duration, errors,
+                 percentile(durations, 0.5), percentile(durations, 0.95),
+                 percentile(durations, 1)))
+        purgePolls(Poll.objects.filter(pk=poll.pk), using=poll._state.db)
+
+    def handle(self, *args, **options):
+        single_writer = getattr(settings, 'SINGLE_WRITER', False)
+        try:
+            for mode in (False, True):
+                self.bench(mode, options)
+        finally:
+            settings.SINGLE_WRITER = single_writer
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Close the polls whose closing date has passed
+'''
+
+from django.core.management.base import BaseCommand
+
+from papillon.polls.models import closeDuePolls
+from papillon.polls.routers import pollDatabases
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Close the polls whose closing date has passed - to be run '\
+           'regularly (every minute with cron for instance)'
+
+    def handle(self, *args, **options):
+        closed = 0
+        for alias in pollDatabases():
+            closed += closeDuePolls(using=alias)
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('%d poll(s) closed\n' % closed)
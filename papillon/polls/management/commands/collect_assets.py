@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Collect the static files with the hash of their content in their name and
+their compressed versions
+'''
+
+import gzip
+import json
+import os
+import posixpath
+import re
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+import django.contrib.admin
+
+from papillon.polls.assets import ASSETS_MANIFEST, hashedName, writeFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# files worth compressing
+COMPRESSED_EXTENSIONS = ('.css', '.js', '.json', '.html', '.txt', '.svg')
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+def sourceFiles():
+    "Path of the static files of Papillon and of the admin by name"
+    roots = [(settings.MEDIA_ROOT, ''),
+             (os.path.join(os.path.dirname(django.contrib.admin.__file__),
+                           'static', 'admin'), 'admin/')]
+    files = {}
+    for root, prefix in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            if dirpath == root and not prefix and 'admin' in dirnames:
+                # link to the admin files
+                dirnames.remove('admin')
+            for filename in filenames:
+                if filename.startswith('.') or filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, root).replace(os.sep, '/')
+                files[prefix + name] = path
+    return files
+
+def cssUrls(name, content):
+    "Names of the files refered by a stylesheet"
+    for quote, url in CSS_URL.findall(content):
+        if ':' in url or url.startswith('/'):
+            continue
+        yield posixpath.normpath(posixpath.join(posixpath.dirname(name),
+                                                url.split('?')[0]))
+
+def rewriteCss(name, content, manifest):
+    "Make the urls of a stylesheet refer to the collected files"
+    def replace(match):
+        quote, url = match.groups()
+        if ':' in url or url.startswith('/'):
+            return match.group(0)
+        target = posixpath.normpath(posixpath.join(posixpath.dirname(name),
+                                                   url.split('?')[0]))
+        if target not in manifest:
+            return match.group(0)
+        return 'url(%s%s%s)' % (quote, posixpath.relpath(manifest[target],
+                                         posixpath.dirname(name) or '.'), quote)
+    return CSS_URL.sub(replace, content)
+
+def compress(content):
+    "gzip content - without date to get the same file each time"
+    buf = StringIO()
+    zfile = gzip.GzipFile(mode='wb', compresslevel=9, fileobj=buf, mtime=0)
+    zfile.write(content)
+    zfile.close()
+    return buf.getvalue()
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Collect the static files with hashed names and compressed versions'
+
+    def write(self, name, content, manifest):
+        "Write a collected file and its compressed versions"
+        manifest[name] = hashedName(name, content)
+        path = os.path.join(settings.ASSETS_ROOT, manifest[name])
+        if os.path.exists(path):
+            # same name: same content
+            return
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        writeFile(path, content)
+        self.stdout.write('%s\n' % manifest[name])
+        if os.path.splitext(name)[1] not in COMPRESSED_EXTENSIONS:
+            return
+        variants = [('.gz', compress)]
+        if brotli:
+            variants.append(('.br', brotli.compress))
+        for extension, fct in variants:
+            compressed = fct(content)
+            if len(compressed) < len(content):
+                writeFile(path + extension, compressed)
+
+    def handle(self, *args, **options):
+        files = sourceFiles()
+        manifest = {}
+        stylesheets = {}
+        for name in sorted(files):
+            with open(files[name], 'rb') as source:
+                content = source.read()
+            if name.endswith('.css'):
+                stylesheets[name] = content
+                continue
+            self.write(name, content, manifest)
+        # stylesheets after the files they refer to - @import included
+        while stylesheets:
+            ready = [name for name in sorted(stylesheets)
+                     if not [url for url in cssUrls(name, stylesheets[name])
+                             if url in stylesheets and url != name]]
+            # circular imports are written as they are
+            for name in ready or sorted(stylesheets):
+                self.write(name, rewriteCss(name, stylesheets.pop(name),
+                                            manifest), manifest)
+        writeFile(os.path.join(settings.ASSETS_ROOT, ASSETS_MANIFEST),
+                  json.dumps(manifest))
+        self.stdout.write('%d file(s) collected\n' % len(manifest))
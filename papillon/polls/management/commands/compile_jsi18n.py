@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Write the javascript catalog of each language in a static file
+'''
+
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test.client import RequestFactory
+from django.utils import translation
+from django.views.i18n import javascript_catalog
+
+from papillon.polls.assets import JS_CATALOG_DIR, JS_CATALOG_MANIFEST, \
+                                  hashedName, writeFile
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Write the javascript catalog of each language in a static file'
+
+    def handle(self, *args, **options):
+        path = os.path.join(settings.MEDIA_ROOT, JS_CATALOG_DIR)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        catalogs = {}
+        request = RequestFactory().get('/')
+        for language, label in settings.LANGUAGES:
+            with translation.override(language):
+                content = javascript_catalog(request).content
+            # previous files are kept for the pages already in caches
+            name = hashedName('%s.js' % language, content)
+            writeFile(os.path.join(path, name), content)
+            catalogs[language] = name
+            self.stdout.write('%s\n' % name)
+        writeFile(os.path.join(path, JS_CATALOG_MANIFEST), json.dumps(catalogs))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Deliver the events queued for the webhooks
+'''
+
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from papillon.polls.routers import pollDatabases
+from papillon.polls.webhooks import Deliverer, deliverDueEvents
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Deliver the events queued for the webhooks'
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop',
+            default=False, help='Keep delivering the new events'),
+        make_option('--interval', type='int', dest='interval', default=5,
+            help='Seconds between two checks of the queue with --loop'),
+        )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        deliverer = Deliverer(settings.WEBHOOKS_THREADS,
+                              settings.WEBHOOKS_ENDPOINT_CONCURRENCY,
+                              settings.WEBHOOKS_TIMEOUT)
+        reported = (0, 0)
+        try:
+            while True:
+                # the events of the endpoints busy now are not claimed: their
+                # deliveries ending meanwhile are not missed
+                ended, busy = deliverer.getEnded(), deliverer.isBusy()
+                started, postponed = 0, 0
+                for alias in pollDatabases():
+                    counts = deliverDueEvents(deliverer, alias)
+                    started += counts[0]
+                    postponed += counts[1]
+                if postponed:
+                    # the busy endpoints are now known: claim other events
+                    continue
+                if started or busy:
+                    # more events may be started at the end of a delivery
+                    deliverer.wait(options['interval'], ended)
+                    continue
+                stats = deliverer.getStats()
+                if verbosity and stats != reported:
+                    self.stdout.write('%d event(s) delivered, %d failed\n'
+                                      % stats)
+                    reported = stats
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+        finally:
+            deliverer.close()
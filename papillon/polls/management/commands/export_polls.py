@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Export polls with their choices, voters, votes and comments in JSON lines
+'''
+
+import json
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from papillon.polls.models import Poll, Choice, Voter, Vote, Comment
+from papillon.polls.routers import pollDatabases
+
+# rows read at once - voters are read with their votes
+CHUNK_SIZE = 500
+
+POLL_FIELDS = ('base_url', 'admin_url', 'author_name', 'name', 'description',
+               'type', 'dated_choices', 'public', 'opened_admin',
+               'hide_choices', 'open')
+CHOICE_FIELDS = ('id', 'name', 'order', 'limit', 'available', 'ballot_index')
+
+def dumpDate(date):
+    return date.isoformat() if date else None
+
+def dumpUser(user):
+    if not user:
+        return None
+    return {'name':user.name, 'email':user.email, 'password':user.password,
+            'modification_date':dumpDate(user.modification_date)}
+
+def iterChunks(queryset):
+    "Iterate over the rows of a queryset read by chunks of increasing ids"
+    last_id = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last_id is not None:
+            chunk = chunk.filter(pk__gt=last_id)
+        chunk = list(chunk[:CHUNK_SIZE])
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1].pk
+
+def iterPollLines(poll, using):
+    "Lines of the export of a poll"
+    record = dict([(field, getattr(poll, field)) for field in POLL_FIELDS])
+    record.update({'model':'poll', 'author':dumpUser(poll.author),
+                   'category':poll.category.name if poll.category else None,
+                   'enddate':dumpDate(poll.enddate),
+                   'creation_date':dumpDate(poll.creation_date),
+                   'modification_date':dumpDate(poll.modification_date)})
+    yield record
+    for choice in Choice.objects.using(using).filter(poll=poll):
+        record = dict([(field, getattr(choice, field))
+                       for field in CHOICE_FIELDS])
+        record['model'] = 'choice'
+        yield record
+    voters = Voter.objects.using(using).filter(poll=poll).select_related(
+                                                                     'user')
+    for chunk in iterChunks(voters):
+        votes = {}
+        for voter_id, choice_id, value in Vote.objects.using(using).filter(
+                    voter__in=[voter.pk for voter in chunk]).values_list(
+                    'voter_id', 'choice_id', 'value'):
+            votes.setdefault(voter_id, []).append([choice_id, value])
+        for voter in chunk:
+            yield {'model':'voter', 'user':dumpUser(voter.user),
+                   'creation_date':dumpDate(voter.creation_date),
+                   'modification_date':dumpDate(voter.modification_date),
+                   'ballot':voter.ballot, 'votes':votes.get(voter.pk, [])}
+    for chunk in iterChunks(Comment.objects.using(using).filter(poll=poll)):
+        for comment in chunk:
+            yield {'model':'comment', 'author_name':comment.author_name,
+                   'text':comment.text, 'date':dumpDate(comment.date)}
+
+class Command(BaseCommand):
+    args = '[base_url ...]'
+    help = 'Export polls (all of them by default) with their choices, '\
+           'voters, votes and comments: one JSON object by line'
+    option_list = BaseCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+            help='File written instead of the standard output'),
+        )
+
+    def handle(self, *args, **options):
+        output = open(options['output'], 'wb') if options['output'] \
+                 else sys.stdout
+        exported = 0
+        try:
+            for alias in pollDatabases():
+                polls = Poll.objects.using(alias).select_related('author',
+                                                                 'category')
+                if args:
+                    polls = polls.filter(base_url__in=args)
+                for chunk in iterChunks(polls):
+                    for poll in chunk:
+                        for record in iterPollLines(poll, alias):
+                            output.write(json.dumps(record) + '\n')
+                        exported += 1
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        if int(options.get('verbosity', 1)):
+            self.stderr.write('%d poll(s) exported\n' % exported)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Import polls exported by "./manage.py export_polls"
+'''
+
+import datetime
+import json
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.db.models import F
+
+from papillon.polls.models import Poll, PollUser, Category, Choice, Voter, \
+                                  Vote, Comment, BallotEvent, getPoll, \
+                                  genRandomURL, packValues, saveWithDates, \
+                                  insertWithDates
+from papillon.polls.routers import shardFor
+from papillon.polls.management.commands.export_polls import POLL_FIELDS, \
+                                                            CHOICE_FIELDS
+
+def loadDate(value):
+    if not value:
+        return None
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            continue
+    raise ValueError('Invalid date: %s' % value)
+
+def loadUser(record, using):
+    user = PollUser(name=record['name'], email=record['email'],
+                    password=record['password'],
+                    modification_date=loadDate(record['modification_date']))
+    saveWithDates(user, using)
+    return user
+
+class Importer(object):
+    '''Import the lines of an export: the rows of a poll are inserted by
+    batches of batch_size voters or comments, each batch in a transaction.
+    Only the ids of the choices of the current poll are kept in memory.
+    '''
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.poll, self.using = None, None
+        self.choices, self.voters, self.comments = [], [], []
+        self.choice_ids, self.indexes = {}, {}
+        self.polls, self.renamed = 0, 0
+
+    def freeURL(self, url):
+        "The url or a new one if it is already used"
+        if getPoll(base_url=url) or getPoll(admin_url=url):
+            self.renamed += 1
+            return genRandomURL()
+        return url
+
+    def startPoll(self, record):
+        self.flush()
+        poll = Poll(**dict([(field, record[field]) for field in POLL_FIELDS]))
+        poll.base_url = self.freeURL(poll.base_url)
+        poll.admin_url = self.freeURL(poll.admin_url)
+        poll.enddate = loadDate(record['enddate'])
+        # missing in the exports made before the statistics
+        poll.creation_date = loadDate(record.get('creation_date'))
+        poll.modification_date = loadDate(record['modification_date'])
+        if record['category']:
+            categories = Category.objects.using(DEFAULT_DB_ALIAS).filter(
+                                                     name=record['category'])
+            poll.category = categories[0] if categories else \
+                            Category.objects.create(name=record['category'])
+        self.using = shardFor(poll.base_url)
+        with transaction.commit_on_success(using=self.using):
+            if record['author']:
+                poll.author = loadUser(record['author'], self.using)
+            saveWithDates(poll, self.using)
+        self.poll, self.choice_ids, self.indexes = poll, {}, {}
+        self.polls += 1
+
+    def add(self, record):
+        if record['model'] == 'poll':
+            self.startPoll(record)
+            return
+        if not self.poll:
+            raise CommandError('%s before the first poll' % record['model'])
+        if record['model'] == 'choice':
+            self.choices.append(record)
+        elif record['model'] == 'voter':
+            self.voters.append(record)
+        elif record['model'] == 'comment':
+            self.comments.append(record)
+        else:
+            raise CommandError('Unknown model: %s' % record['model'])
+        if len(self.voters) >= self.batch_size \
+           or len(self.comments) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        "Insert the waiting rows of the current poll"
+        if not self.poll:
+            return
+        using = self.using
+        with transaction.commit_on_success(using=using):
+            for record in self.choices:
+                choice = Choice(poll_id=self.poll.pk, **dict([(field,
+                        record[field]) for field in CHOICE_FIELDS[1:]]))
+                choice.save(using=using)
+                self.choice_ids[record['id']] = choice.pk
+                self.indexes[record['id']] = choice.ballot_index
+            votes, events = [], []
+            for record in self.voters:
+                voter = Voter(poll_id=self.poll.pk, ballot=record['ballot'],
+                          user=loadUser(record['user'], using),
+                          creation_date=loadDate(record['creation_date']),
+                          modification_date=loadDate(
+                                                record['modification_date']))
+                saveWithDates(voter, using)
+                ballot = voter.ballot
+                if ballot is None:
+                    ballot = packValues(dict([(self.indexes[choice_id], value)
+                                  for choice_id, value in record['votes']]))
+                events.append(BallotEvent(poll_id=self.poll.pk, kind='C',
+                                voter_id=voter.pk, name=voter.user.name,
+                                ballot=ballot, date=voter.modification_date))
+                votes += [Vote(voter_id=voter.pk, choice_id=self.choice_ids[
+                                                             choice_id],
+                               value=value)
+                          for choice_id, value in record['votes']]
+            Vote.objects.using(using).bulk_create(votes)
+            # the imported ballots start the log of the poll
+            insertWithDates(BallotEvent, events, using)
+            insertWithDates(Comment, [Comment(
+                    poll_id=self.poll.pk, author_name=record['author_name'],
+                    text=record['text'], date=loadDate(record['date']))
+                for record in self.comments], using)
+            if self.comments:
+                Poll.objects.using(using).filter(pk=self.poll.pk).update(
+                       comment_count=F('comment_count') + len(self.comments))
+        self.choices, self.voters, self.comments = [], [], []
+
+class Command(BaseCommand):
+    args = '[file ...]'
+    help = 'Import polls exported by "./manage.py export_polls" from files '\
+           'or from the standard input. Addresses already used by a poll '\
+           'are replaced by new ones.'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=1000, help='Voters or comments inserted by transaction'),
+        )
+
+    def handle(self, *args, **options):
+        importer = Importer(options['batch_size'])
+        for name in args or ('-',):
+            lines = sys.stdin if name == '-' else open(name, 'rb')
+            try:
+                for line in lines:
+                    if line.strip():
+                        importer.add(json.loads(line))
+                importer.flush()
+            finally:
+                if lines is not sys.stdin:
+                    lines.close()
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('%d poll(s) imported, %d address(es) replaced\n'
+                              % (importer.polls, importer.renamed))
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Convert votes between one row by choice and packed ballots
+'''
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from papillon.polls.models import Poll, Choice, Voter, Vote, packValue, \
+                                  unpackBallot, BALLOT_VALUES
+from papillon.polls.routers import pollDatabases, useShard
+
+def packPoll(poll_id, using):
+    "Pack the votes of the voters of a poll. Return the number of voters"
+    absent_value = Poll.objects.using(using).get(pk=poll_id).getAbsentValue()
+    indexes = dict(Choice.objects.using(using).filter(poll=poll_id
+                                   ).values_list('id', 'ballot_index'))
+    votes = Vote.objects.using(using).filter(voter__poll=poll_id,
+                                             voter__ballot__isnull=True)
+    ballots = {}
+    for voter_id, choice_id, value in votes.values_list('voter_id',
+                                                        'choice_id', 'value'):
+        ballot = ballots.setdefault(voter_id, [])
+        if value not in BALLOT_VALUES or value == absent_value:
+            # absent or a value which cannot be given with the forms
+            continue
+        index = indexes[choice_id]
+        if index >= len(ballot):
+            ballot += [None] * (index - len(ballot) + 1)
+        ballot[index] = value
+    voter_ids = list(Voter.objects.using(using).filter(poll=poll_id,
+                            ballot__isnull=True).values_list('id', flat=True))
+    Vote.objects.using(using).filter(voter__in=voter_ids).delete()
+    for voter_id in voter_ids:
+        ballot = ''.join([packValue(value)
+                          for value in ballots.get(voter_id, [])])
+        # update to keep the modification date of the voter
+        Voter.objects.using(using).filter(pk=voter_id).update(ballot=ballot)
+    return len(voter_ids)
+
+def unpackPoll(poll_id, using):
+    "Store packed votes in one row by choice. Return the number of voters"
+    absent_value = Poll.objects.using(using).get(pk=poll_id).getAbsentValue()
+    choices = list(Choice.objects.using(using).filter(poll=poll_id))
+    voters = Voter.objects.using(using).filter(poll=poll_id,
+                                               ballot__isnull=False)
+    votes = []
+    for voter_id, ballot in voters.values_list('id', 'ballot'):
+        values = unpackBallot(ballot)
+        votes += [Vote(voter_id=voter_id, choice=choice,
+                       value=values[choice.ballot_index])
+                  for choice in choices if choice.ballot_index < len(values)
+                       and values[choice.ballot_index] not in (None,
+                                                               absent_value)]
+    Vote.objects.using(using).bulk_create(votes)
+    return voters.update(ballot=None)
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Pack the votes of each voter in one row'
+    option_list = BaseCommand.option_list + (
+        make_option('--unpack', action='store_true', dest='unpack',
+            default=False, help='Store packed votes in one row by choice'),
+        )
+
+    def handle(self, *args, **options):
+        convert = unpackPoll if options['unpack'] else packPoll
+        converted = 0
+        for alias in pollDatabases():
+            useShard(alias)
+            for poll_id in Poll.objects.using(alias).values_list('id',
+                                                                 flat=True):
+                with transaction.commit_on_success(using=alias):
+                    converted += convert(poll_id, alias)
+        self.stdout.write('%d voter(s) converted\n' % converted)
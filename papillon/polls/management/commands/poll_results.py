@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Display the results of a poll at a date replayed from its ballot log
+'''
+
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from papillon.polls.models import Choice, BallotEvent, getPoll, getTally
+
+class Command(BaseCommand):
+    args = 'poll_address'
+    help = 'Display the results of a poll at a date (now by default) '\
+           'replayed from the log of its ballots'
+    option_list = BaseCommand.option_list + (
+        make_option('--date', dest='date', default=None,
+            help='Date of the results: "YYYY-MM-DD HH:MM:SS"'),
+        make_option('--log', action='store_true', dest='log', default=False,
+            help='Display the ballot events until the date'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the address of a poll')
+        poll = getPoll(base_url=args[0])
+        if not poll:
+            raise CommandError('Unknown poll: %s' % args[0])
+        date = None
+        if options['date']:
+            try:
+                date = datetime.datetime.strptime(options['date'],
+                                                  '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                raise CommandError('Invalid date: %s' % options['date'])
+        if options['log']:
+            events = BallotEvent.objects.using(poll._state.db).filter(
+                                                                  poll=poll)
+            if date:
+                events = events.filter(date__lte=date)
+            for event in events.iterator():
+                self.stdout.write(u'%s %s %s %s -> %s\n' % (event.date,
+                        event.get_kind_display(), event.name,
+                        event.previous or '-', event.ballot or '-'))
+        # the current choices
+        choices = list(Choice.objects.using(poll._state.db).filter(poll=poll))
+        for choice, sum in zip(choices, getTally(poll, choices, date)):
+            self.stdout.write(u'%s: %s\n' % (choice.name,
+                              sum / 2 if poll.type == 'B' else sum))
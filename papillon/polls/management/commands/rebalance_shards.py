@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Move the polls which are not on their shard
+'''
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction, DEFAULT_DB_ALIAS
+
+from papillon.polls.models import Poll, PollUser, Choice, Voter, Vote, \
+                                  Comment, Notification, Webhook, \
+                                  WebhookEvent, BallotEvent, TallySnapshot, \
+                                  saveWithDates
+from papillon.polls.routers import shardFor
+
+def copy(obj, target, **values):
+    "Insert a copy of obj with a new id on target and return both ids"
+    old_id = obj.pk
+    obj.pk = None
+    for key in values:
+        setattr(obj, key, values[key])
+    saveWithDates(obj, target, force_insert=True)
+    return old_id, obj.pk
+
+def movePoll(poll, source, target):
+    '''Copy a poll with its choices, voters, users, votes, comments,
+    notifications, webhooks and ballot log from source to target then delete it from
+    source.'''
+    poll_id = poll.pk
+    user_ids = list(Voter.objects.using(source).filter(poll=poll
+                                           ).values_list('user_id', flat=True))
+    if poll.author_id:
+        user_ids.append(poll.author_id)
+    # an interrupted move may have already copied the poll
+    if not Poll.objects.using(target).filter(base_url=poll.base_url).count():
+        choices = list(Choice.objects.using(source).filter(poll=poll))
+        voters = list(Voter.objects.using(source).filter(poll=poll))
+        votes = list(Vote.objects.using(source).filter(voter__poll=poll))
+        comments = list(Comment.objects.using(source).filter(poll=poll))
+        notifications = list(Notification.objects.using(source).filter(
+                                                                 poll=poll))
+        webhooks = list(Webhook.objects.using(source).filter(poll=poll))
+        events = list(WebhookEvent.objects.using(source).filter(
+                                                         webhook__poll=poll))
+        ballot_events = list(BallotEvent.objects.using(source).filter(
+                                                                 poll=poll))
+        snapshots = list(TallySnapshot.objects.using(source).filter(
+                                                                 poll=poll))
+        with transaction.commit_on_success(using=target):
+            users = dict([copy(user, target) for user in
+                    PollUser.objects.using(source).filter(pk__in=user_ids)])
+            # the comment count is updated by the copy of the comments
+            new_poll_id = copy(poll, target, comment_count=0,
+                               author_id=users.get(poll.author_id))[1]
+            choice_ids = dict([copy(choice, target, poll_id=new_poll_id)
+                               for choice in choices])
+            voter_ids = dict([copy(voter, target, poll_id=new_poll_id,
+                                   user_id=users[voter.user_id])
+                              for voter in voters])
+            for vote in votes:
+                copy(vote, target, voter_id=voter_ids[vote.voter_id],
+                     choice_id=choice_ids[vote.choice_id])
+            for comment in comments:
+                copy(comment, target, poll_id=new_poll_id)
+            for notification in notifications:
+                copy(notification, target, poll_id=new_poll_id)
+            webhook_ids = dict([copy(webhook, target, poll_id=new_poll_id)
+                                for webhook in webhooks])
+            for event in events:
+                copy(event, target, webhook_id=webhook_ids[event.webhook_id])
+            # the log keeps the order of the events
+            ballot_event_ids = dict([copy(event, target, poll_id=new_poll_id,
+                                     voter_id=voter_ids.get(event.voter_id))
+                                     for event in ballot_events])
+            for snapshot in snapshots:
+                copy(snapshot, target, poll_id=new_poll_id,
+                     event_id=ballot_event_ids[snapshot.event_id])
+    with transaction.commit_on_success(using=source):
+        Poll.objects.using(source).get(pk=poll_id).delete()
+        PollUser.objects.using(source).filter(pk__in=user_ids,
+                            voter__isnull=True, poll__isnull=True).delete()
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Move the polls stored on another database than their shard'
+    option_list = BaseCommand.option_list + (
+        make_option('--from', action='append', dest='sources', default=[],
+            help='Another database to empty (a removed shard for instance)'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False, help='Only display the polls to move'),
+        )
+
+    def handle(self, *args, **options):
+        if not settings.SHARD_DATABASES:
+            raise CommandError('SHARD_DATABASES is not set')
+        sources = [DEFAULT_DB_ALIAS] + list(settings.SHARD_DATABASES) \
+                  + options['sources']
+        moved = 0
+        for source in sorted(set(sources)):
+            polls = list(Poll.objects.using(source).values_list('id',
+                                                                'base_url'))
+            for poll_id, base_url in polls:
+                target = shardFor(base_url)
+                if target == source:
+                    continue
+                self.stdout.write('%s: %s -> %s\n' % (base_url, source,
+                                                      target))
+                if not options['dry_run']:
+                    movePoll(Poll.objects.using(source).get(pk=poll_id),
+                             source, target)
+                moved += 1
+        self.stdout.write('%d poll(s) to move\n' % moved if options['dry_run']
+                          else '%d poll(s) moved\n' % moved)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Roll up the statistics of the days completed since the last rolled up day
+'''
+
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max, Min
+
+from papillon.polls.models import Poll, BallotEvent, Comment, DailyStats, \
+                                  rollupDay
+from papillon.polls.routers import pollDatabases, useShard
+
+def getFirstDay(using):
+    "Day of the oldest activity of a database or None"
+    dates = [Poll.objects.using(using).aggregate(first=Min('creation_date')),
+             BallotEvent.objects.using(using).aggregate(first=Min('date')),
+             Comment.objects.using(using).aggregate(first=Min('date'))]
+    dates = [date['first'] for date in dates if date['first']]
+    return min(dates).date() if dates else None
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Roll up the daily statistics of the days completed since the '\
+           'last rolled up day - to be run every night with cron for instance'
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since', default=None,
+            help='Roll up again the days since this one: "YYYY-MM-DD"'),
+        )
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = datetime.datetime.strptime(options['since'],
+                                                   '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('Invalid day: %s' % options['since'])
+        # only the complete days
+        last_day = datetime.date.today() - datetime.timedelta(days=1)
+        rolled_up = 0
+        for alias in pollDatabases():
+            useShard(alias)
+            day = since
+            if not day:
+                last = DailyStats.objects.using(alias).aggregate(
+                                                     last=Max('day'))['last']
+                day = last + datetime.timedelta(days=1) if last \
+                      else getFirstDay(alias)
+            while day and day <= last_day:
+                rollupDay(day, using=alias)
+                day += datetime.timedelta(days=1)
+                rolled_up += 1
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('%d day(s) rolled up\n' % rolled_up)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Execute the deferred tasks
+'''
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from papillon.polls.routers import pollDatabases
+from papillon.polls.tasks import TaskRunner, runTasks, getQueueStats
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Execute the deferred tasks (reordering of choices, availability '\
+           'of choices, cleaning of old polls) - set TASKS_THREADS to 0 when '\
+           'they are executed by this command'
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop',
+            default=False, help='Keep executing the new tasks'),
+        make_option('--interval', type='int', dest='interval', default=None,
+            help='Seconds between two checks of the queue with --loop '
+                 '(TASKS_INTERVAL by default)'),
+        make_option('--threads', type='int', dest='threads', default=4,
+            help='Threads executing the tasks'),
+        make_option('--stats', action='store_true', dest='stats',
+            default=False, help='Only display the queue depth and the age '
+                                'of the oldest task of each database'),
+        )
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            for alias in pollDatabases():
+                depth, age = getQueueStats(alias)
+                self.stdout.write('%s%d task(s) queued, oldest: %ds\n' % (
+                             alias + ': ' if alias else '', depth, age))
+            return
+        runner = TaskRunner(options['threads'])
+        try:
+            runTasks(runner, options['interval'] or settings.TASKS_INTERVAL,
+                     loop=options['loop'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            runner.close()
+        if int(options.get('verbosity', 1)):
+            stats = runner.getStats()
+            self.stdout.write('%(executed)d task(s) executed, %(failed)d '
+                              'failed, latency: %(latency).1fs average, '
+                              '%(max_latency).1fs max\n' % stats)
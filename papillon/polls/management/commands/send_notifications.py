@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Send to the authors of polls the digests of their queued notifications
+'''
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.management.base import BaseCommand
+from django.core.urlresolvers import reverse
+from django.template.loader import render_to_string
+from django.utils import translation
+from django.utils.translation import ugettext as _
+
+from papillon.polls.models import Notification
+from papillon.polls.routers import pollDatabases
+
+def getEmails():
+    "E-mails of the authors of the polls with queued notifications"
+    emails = set()
+    for alias in pollDatabases():
+        emails.update(Notification.objects.using(alias).filter(
+                         poll__author__isnull=False).order_by().values_list(
+                         'poll__author__email', flat=True).distinct())
+    return sorted(emails)
+
+def getDigests(emails):
+    '''Gather by e-mail the queued notifications of the polls of the authors
+    with these e-mails. Return a list of (email, notification ids by database,
+    polls)
+    '''
+    digests = {}
+    for alias in pollDatabases():
+        notifications = Notification.objects.using(alias).filter(
+                                      poll__author__email__in=emails
+                                      ).select_related('poll', 'poll__author')
+        for notification in notifications.iterator():
+            poll = notification.poll
+            ids, polls = digests.setdefault(poll.author.email, ({}, {}))
+            ids.setdefault(alias, []).append(notification.pk)
+            if (alias, poll.pk) not in polls:
+                poll.new_votes, poll.new_comments = [], []
+                polls[(alias, poll.pk)] = poll
+            poll = polls[(alias, poll.pk)]
+            if notification.kind == 'V':
+                poll.new_votes.append(notification.name)
+            else:
+                poll.new_comments.append(notification.name)
+    return [(email, ids, sorted(polls.values(), key=lambda poll:poll.name))
+            for email, (ids, polls) in digests.items()]
+
+def getMessage(email, polls, domain):
+    for poll in polls:
+        poll.url = 'http://%s%s' % (domain, reverse('poll',
+                                                    args=[poll.base_url]))
+    body = render_to_string('notification_digest.txt', {'polls':polls})
+    return mail.EmailMessage(_("New votes and comments on your polls"), body,
+                             settings.DEFAULT_FROM_EMAIL, [email])
+
+def deleteNotifications(ids):
+    "Delete the notifications of a sent batch: they are not sent again"
+    for alias in ids:
+        for idx in xrange(0, len(ids[alias]), 500):
+            Notification.objects.using(alias).filter(
+                                   pk__in=ids[alias][idx:idx + 500]).delete()
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Send to the authors of polls the digests of the new votes and '\
+           'comments - to be run regularly (every 10 minutes with cron for '\
+           'instance)'
+
+    def handle(self, *args, **options):
+        translation.activate(settings.LANGUAGE_CODE)
+        domain = Site.objects.get_current().domain
+        # the notifications are read for NOTIFICATIONS_BATCH_SIZE authors at
+        # once
+        emails = getEmails()
+        batch_size = settings.NOTIFICATIONS_BATCH_SIZE
+        sent = 0
+        # one SMTP connection for all the digests
+        connection = mail.get_connection()
+        if emails:
+            connection.open()
+        try:
+            for idx in xrange(0, len(emails), batch_size):
+                batch = getDigests(emails[idx:idx + batch_size])
+                # without e-mail the notifications are deleted without being
+                # sent
+                messages = [getMessage(email, polls, domain)
+                            for email, ids, polls in batch if email]
+                if messages:
+                    sent += connection.send_messages(messages) or 0
+                batch_ids = {}
+                for email, ids, polls in batch:
+                    for alias in ids:
+                        batch_ids.setdefault(alias, []).extend(ids[alias])
+                deleteNotifications(batch_ids)
+        finally:
+            connection.close()
+        # nobody to send them to
+        for alias in pollDatabases():
+            Notification.objects.using(alias).filter(
+                                        poll__author__isnull=True).delete()
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('%d digest(s) sent\n' % sent)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Snapshot the tallies of the polls with many new ballot events
+'''
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from papillon.polls.models import BallotEvent, TallySnapshot, snapshotTally
+from papillon.polls.routers import pollDatabases, useShard
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Snapshot the tally of the polls with at least TALLY_SNAPSHOT_'\
+           'EVENTS ballot events since their last snapshot - to be run '\
+           'regularly (every hour with cron for instance)'
+    option_list = BaseCommand.option_list + (
+        make_option('--events', type='int', dest='events', default=None,
+            help='Minimum number of new events (TALLY_SNAPSHOT_EVENTS by '
+                 'default)'),
+        )
+
+    def handle(self, *args, **options):
+        minimum = options['events'] or settings.TALLY_SNAPSHOT_EVENTS
+        made = 0
+        for alias in pollDatabases():
+            useShard(alias)
+            # no ordering: it would be part of the grouping
+            snapshots = dict(TallySnapshot.objects.using(alias).order_by(
+                ).values('poll').annotate(last=Max('event')).values_list(
+                                                              'poll', 'last'))
+            for poll_id, last in BallotEvent.objects.using(alias).order_by(
+                    ).values('poll').annotate(last=Max('id')).values_list(
+                                                              'poll', 'last'):
+                if last == snapshots.get(poll_id):
+                    continue
+                events = BallotEvent.objects.using(alias).filter(poll=poll_id,
+                                         pk__gt=snapshots.get(poll_id) or 0)
+                if events.count() >= minimum \
+                   and snapshotTally(poll_id, using=alias):
+                    made += 1
+        if int(options.get('verbosity', 1)):
+            self.stdout.write('%d snapshot(s) made\n' % made)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Middlewares
+'''
+
+from django.conf import settings
+from django.core import signing
+from django.core.urlresolvers import resolve, Resolver404
+
+from papillon.polls.routers import resetState, readFromReplica, hasWritten
+from papillon.polls.limits import isPost, throttle
+from papillon.polls.overload import load, isEnabled, getKeptPage, \
+                                    overloadedResponse
+
+PRIMARY_COOKIE = 'papillon_primary'
+KNOWN_VOTES_COOKIE = 'papillon_known'
+
+class ThrottleMiddleware(object):
+    '''Refuse the votes and comments above POST_RATE_BY_CLIENT and
+    POST_RATE_BY_POLL. Set before the session middleware: the refused requests
+    don't access the database.
+    '''
+    def process_request(self, request):
+        if not (settings.POST_RATE_BY_CLIENT or settings.POST_RATE_BY_POLL) \
+           or not isPost(request):
+            return
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return
+        if match.url_name in ('poll', 'vote'):
+            return throttle(request, match.kwargs.get('poll_url')
+                                     or match.args[0])
+
+class OverloadMiddleware(object):
+    '''Count the requests in progress. When the process is overloaded (see
+    polls.overload) the poll pages are served from their last rendering and
+    the posts are refused with "503 Service Unavailable". Set before the
+    session middleware: these requests don't access the database.
+    '''
+    def process_request(self, request):
+        if not isEnabled():
+            return
+        load.start()
+        request.load_counted = True
+        if not load.isDegraded():
+            return
+        if request.method not in ('GET', 'HEAD'):
+            return overloadedResponse()
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return
+        if match.url_name in ('poll', 'vote'):
+            poll_url = match.kwargs.get('poll_url') or match.args[0]
+            return getKeptPage(request, poll_url.split('_')[0]) \
+                   or overloadedResponse()
+
+    def process_response(self, request, response):
+        if getattr(request, 'load_counted', False):
+            load.end()
+            request.load_counted = False
+        return response
+
+class ReplicaMiddleware(object):
+    '''Read from the replica database for read-only views.
+    After a write the browser reads from the primary database for
+    REPLICA_STICKY_TIME seconds to not miss its own modifications while the
+    replica is late.
+    '''
+    def process_request(self, request):
+        resetState()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not settings.REPLICA_DATABASE \
+           or request.method not in ('GET', 'HEAD') \
+           or PRIMARY_COOKIE in request.COOKIES:
+            return
+        if request.resolver_match.url_name in settings.REPLICA_VIEWS:
+            readFromReplica(settings.REPLICA_DATABASE)
+
+    def process_response(self, request, response):
+        if settings.REPLICA_DATABASE and hasWritten():
+            response.set_cookie(PRIMARY_COOKIE, '1',
+                                max_age=settings.REPLICA_STICKY_TIME)
+        resetState()
+        return response
+
+def setKnownVote(request, poll):
+    "The results of the hidden poll can now be displayed to the browser"
+    if not settings.KNOWN_VOTES_COOKIE:
+        request.session['knowned_vote_' + poll.base_url] = 1
+        return
+    if poll.base_url in request.known_votes:
+        return
+    # only the most recent polls are kept to limit the size of the cookie
+    request.known_votes = (request.known_votes + [poll.base_url]
+                           )[-settings.KNOWN_VOTES_MAX:]
+    request.known_votes_changed = True
+
+def isKnownVote(request, poll):
+    "Check if the results of the hidden poll can be displayed to the browser"
+    if not settings.KNOWN_VOTES_COOKIE:
+        return 'knowned_vote_' + poll.base_url in request.session
+    return poll.base_url in request.known_votes
+
+class KnownVotesMiddleware(object):
+    '''With KNOWN_VOTES_COOKIE, the hidden polls whose results can be
+    displayed to the browser are kept in a signed cookie instead of the
+    session: voting doesn't write the session in the database.
+    '''
+    salt = 'papillon.polls.known_votes'
+
+    def process_request(self, request):
+        request.known_votes, request.known_votes_changed = [], False
+        if not settings.KNOWN_VOTES_COOKIE \
+           or KNOWN_VOTES_COOKIE not in request.COOKIES:
+            return
+        try:
+            known_votes = signing.loads(request.COOKIES[KNOWN_VOTES_COOKIE],
+                                        salt=self.salt)
+        except signing.BadSignature:
+            return
+        if isinstance(known_votes, list):
+            request.known_votes = known_votes
+
+    def process_response(self, request, response):
+        if getattr(request, 'known_votes_changed', False):
+            response.set_cookie(KNOWN_VOTES_COOKIE,
+                            signing.dumps(request.known_votes, salt=self.salt,
+                                          compress=True),
+                            max_age=settings.SESSION_COOKIE_AGE, httponly=True)
+        return response
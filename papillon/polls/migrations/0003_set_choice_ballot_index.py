@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import datetime
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Give each choice its position in packed ballots"
+        # each shard is migrated with --database
+        using = db.db_alias
+        for poll in orm['polls.Poll'].objects.using(using).all():
+            choices = orm['polls.Choice'].objects.using(using).filter(
+                                                   poll=poll).order_by('id')
+            for idx, choice in enumerate(choices):
+                choice.ballot_index = idx
+                choice.save(using=using)
+
+    def backwards(self, orm):
+        "Nothing to do: the column is removed by the previous migration"
+
+    models = {
+        u'polls.category': {
+            'Meta': {'object_name': 'Category'},
+            'description': ('django.db.models.fields.TextField', [], {}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'polls.choice': {
+            'Meta': {'ordering': "['order']", 'object_name': 'Choice'},
+            'available': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'ballot_index': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'limit': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'order': ('django.db.models.fields.IntegerField', [], {}),
+            'poll': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['polls.Poll']"})
+        },
+        u'polls.comment': {
+            'Meta': {'ordering': "['date']", 'object_name': 'Comment'},
+            'author_name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'poll': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'comments'", 'to': u"orm['polls.Poll']"}),
+            'text': ('django.db.models.fields.CharField', [], {'max_length': '1000'})
+        },
+        u'polls.poll': {
+            'Meta': {'ordering': "['-modification_date']", 'object_name': 'Poll'},
+            'admin_url': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'author': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['polls.PollUser']", 'null': 'True', 'blank': 'True'}),
+            'author_name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'base_url': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'category': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['polls.Category']", 'null': 'True', 'blank': 'True'}),
+            'dated_choices': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'description': ('django.db.models.fields.CharField', [], {'max_length': '1000'}),
+            'enddate': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'blank': 'True'}),
+            'hide_choices': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modification_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '200'}),
+            'open': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'opened_admin': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'public': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'type': ('django.db.models.fields.CharField', [], {'max_length': '1'})
+        },
+        u'polls.polluser': {
+            'Meta': {'object_name': 'PollUser'},
+            'email': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modification_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'polls.vote': {
+            'Meta': {'object_name': 'Vote'},
+            'choice': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['polls.Choice']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'value': ('django.db.models.fields.IntegerField', [], {'null': 'True', 'blank': 'True'}),
+            'voter': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['polls.Voter']"})
+        },
+        u'polls.voter': {
+            'Meta': {'ordering': "['creation_date']", 'object_name': 'Voter'},
+            'ballot': ('django.db.models.fields.TextField', [], {'null': 'True', 'blank': 'True'}),
+            'creation_date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'modification_date': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'poll': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['polls.Poll']"}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['polls.PollUser']"})
+        }
+    }
+
+    complete_apps = ['polls']
@@ -22,11 +22,26 @@ Models management
 '''
 
 import datetime
+import json
+import os
+import string
+import time
+from random import choice as random_choice
 
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, router, transaction, connections, \
+                      IntegrityError, DEFAULT_DB_ALIAS
+from django.db.models import F, Count
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import gettext_lazy as _
 
 from papillon.settings import DAYS_TO_LIVE
+from papillon.polls.database import setSqlitePragmas
+from papillon.polls.routers import lookupDatabases, useShard
+
+connection_created.connect(setSqlitePragmas)
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
@@ -34,6 +49,41 @@ class Category(models.Model):
     def __unicode__(self):
         return self.name
 
+def copyCategory(sender, instance, raw=False, using=None, **kwargs):
+    "Copy categories on each shard as polls refer to them"
+    if using != DEFAULT_DB_ALIAS:
+        return
+    for alias in settings.SHARD_DATABASES:
+        if alias != DEFAULT_DB_ALIAS:
+            instance.save(using=alias)
+    instance._state.db = using
+
+def deleteCategory(sender, instance, using=None, **kwargs):
+    if using != DEFAULT_DB_ALIAS:
+        return
+    for alias in settings.SHARD_DATABASES:
+        if alias != DEFAULT_DB_ALIAS:
+            Category.objects.using(alias).filter(pk=instance.pk).delete()
+
+post_save.connect(copyCategory, sender=Category)
+post_delete.connect(deleteCategory, sender=Category)
+
+CATEGORIES_CACHE_KEY = 'papillon_has_categories'
+
+def hasCategories():
+    "Is there at least one category? Cached until a category is modified"
+    has_categories = cache.get(CATEGORIES_CACHE_KEY)
+    if has_categories is None:
+        has_categories = Category.objects.exists()
+        cache.set(CATEGORIES_CACHE_KEY, has_categories)
+    return has_categories
+
+def forgetCategories(sender, **kwargs):
+    cache.delete(CATEGORIES_CACHE_KEY)
+
+post_save.connect(forgetCategories, sender=Category)
+post_delete.connect(forgetCategories, sender=Category)
+
 class PollUser(models.Model):
     name = models.CharField(max_length=100)
     email = models.CharField(max_length=100)
@@ -70,9 +120,12 @@ different choices
 """))
     dated_choices = models.BooleanField(verbose_name=_("Choices are dates"),
         default=False, help_text=_("Check this option to choose between dates"))
-    enddate = models.DateTimeField(null=True, blank=True,
+    enddate = models.DateTimeField(null=True, blank=True, db_index=True,
 verbose_name=_("Closing date"), help_text=_("Closing date for participating to \
 the poll"))
+    # unknown for the polls created before the statistics
+    creation_date = models.DateTimeField(auto_now_add=True, null=True,
+                                         blank=True, db_index=True)
     modification_date = models.DateTimeField(auto_now=True)
     public = models.BooleanField(default=False,
 verbose_name=_("Display the poll on main page"), help_text=_("Check this \
@@ -86,6 +139,36 @@ hide poll results to new users"))
     open = models.BooleanField(default=True,
 verbose_name=_("State of the poll"), help_text=_("Uncheck this option to close \
 the poll/check this option to reopen it"))
+    # number of comments - updated with the comments
+    comment_count = models.IntegerField(default=0, editable=False)
+    # never saved with the poll
+    COUNTERS = ('comment_count',)
+
+    def getAbsentValue(self):
+        '''Value of a choice without vote: only explicit answers are stored.
+        It is "no" except for Yes/No/Maybe polls where "no" is explicit.
+        '''
+        if self.type == 'B':
+            return None
+        return 0
+
+    def isDue(self):
+        "Is the poll still open after its closing date?"
+        return bool(self.open and self.enddate
+                    and self.enddate <= datetime.datetime.now())
+
+    def touch(self):
+        "Update the modification date: the version of the poll pages"
+        self.modification_date = datetime.datetime.now()
+        Poll.objects.filter(pk=self.pk).update(
+                                    modification_date=self.modification_date)
+
+    def saveEdited(self, using=None):
+        '''Save an edited poll without its counters: they are updated in the
+        database by other requests meanwhile'''
+        self.save(using=using, update_fields=[field.name
+                  for field in self._meta.fields if not field.primary_key
+                  and field.name not in self.COUNTERS])
 
     def getTypeLabel(self):
         idx = [type[0] for type in self.TYPE].index(self.type)
@@ -100,16 +183,43 @@ the poll/check this option to reopen it"))
         if self.modification_date + dtl > now:
             return
         voters = Voter.objects.filter(poll=self)
-        for voter in voters:
-            if voter.modification_date + dtl > now:
-                return
+        if voters.filter(modification_date__gt=now - dtl).exists():
+            return
         for voter in voters:
             voter.user.delete()
             voter.delete()
         comments = Comment.objects.filter(poll=self)
         for comment in comments:
             comment.delete()
+        author_id = self.author_id
         self.delete()
+        if author_id:
+            getLeftAuthors([author_id]).delete()
+
+    def getSums(self, choices):
+        '''Get the sum of votes for each choice: packed ballots are summed
+        directly, others in the database.'''
+        sums = dict([(vote['choice'], vote['sum']) for vote in
+                     Vote.objects.filter(choice__in=choices, value__isnull=False
+                           ).values('choice').annotate(sum=models.Sum('value'))])
+        ballots = Voter.objects.filter(poll=self, ballot__isnull=False
+                                       ).values_list('ballot', flat=True)
+        packed_sums = sumBallots(list(ballots),
+                                 [choice.ballot_index for choice in choices])
+        return [sums.get(choice.id, 0) + packed_sum
+                for choice, packed_sum in zip(choices, packed_sums)]
+
+    def checkAvailability(self, choices, sums):
+        '''Set the availability of the choices from their sums - halved for
+        Yes/No/Maybe polls. Return the choices whose availability has changed.
+        '''
+        changed_choices = []
+        for choice, sum in zip(choices, sums):
+            available = not choice.limit or sum < choice.limit
+            if choice.available != available:
+                choice.available = available
+                changed_choices.append(choice)
+        return changed_choices
 
     def getChoices(self):
         """
@@ -126,8 +236,10 @@ the poll/check this option to reopen it"))
                                                        '%Y-%m-%d %H:%M:%S')
         choices = sorted(choices, key=sort_fct)
         for idx, choice in enumerate(choices):
-            choice.order = idx
-            choice.save()
+            if choice.order != idx:
+                # only the moved choices are written
+                choice.order = idx
+                Choice.objects.filter(pk=choice.pk).update(order=idx)
 
     class Admin:
         pass
@@ -136,31 +248,265 @@ the poll/check this option to reopen it"))
     def __unicode__(self):
         return self.name
 
+def getPoll(**filters):
+    '''Get the poll matching filters or None.
+    With sharding the poll is looked up on its shard first and this shard is
+    used until the end of the request.
+    '''
+    for alias in lookupDatabases(filters.get('base_url')):
+        try:
+            poll = Poll.objects.using(alias).filter(**filters)[0]
+        except IndexError:
+            continue
+        useShard(alias)
+        if poll.isDue():
+            # not closed yet by "./manage.py close_polls"
+            poll.open = False
+        return poll
+
+def genRandomURL():
+    "Generation of a random url not used by another poll"
+    url = ''
+    while not url or getPoll(base_url=url) or getPoll(admin_url=url):
+        url = ''
+        chars = string.letters + string.digits
+        for i in xrange(6):
+            url += random_choice(chars)
+        url += str(int(time.time()))
+    return url
+
 class Comment(models.Model):
     '''Comment for a poll'''
     poll = models.ForeignKey(Poll, related_name='comments')
     author_name = models.CharField(max_length=100)
     text = models.CharField(max_length=1000)
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
+    class Meta:
+        ordering = ['date']
+
+def countComment(sender, instance, created=False, raw=False, using=None,
+                 **kwargs):
+    "Update the comment count of the poll in the transaction of the comment"
+    if not created or raw:
+        return
+    Poll.objects.using(using).filter(pk=instance.poll_id).update(
+                                          comment_count=F('comment_count') + 1)
+
+def uncountComment(sender, instance, using=None, **kwargs):
+    Poll.objects.using(using).filter(pk=instance.poll_id).update(
+                                          comment_count=F('comment_count') - 1)
+
+post_save.connect(countComment, sender=Comment)
+post_delete.connect(uncountComment, sender=Comment)
+
+class Notification(models.Model):
+    '''New vote or comment waiting to be sent to the author of the poll in a
+    digest by "./manage.py send_notifications"'''
+    poll = models.ForeignKey(Poll)
+    KIND = (('V', _('Vote')),
+            ('C', _('Comment')),)
+    kind = models.CharField(max_length=1, choices=KIND)
+    # name of the voter or of the author of the comment
+    name = models.CharField(max_length=100)
     date = models.DateTimeField(auto_now_add=True)
     class Meta:
         ordering = ['date']
 
+def notifyAuthor(poll, kind, name):
+    "Queue a notification if the author of the poll has given an e-mail"
+    if poll.author_id:
+        Notification.objects.create(poll=poll, kind=kind, name=name)
+
+def newSecret():
+    return os.urandom(16).encode('hex')
+
+class Webhook(models.Model):
+    '''Address called on the events of a poll. The body of the requests is
+    signed with the secret.'''
+    poll = models.ForeignKey(Poll)
+    url = models.URLField(verbose_name=_("Address"))
+    secret = models.CharField(max_length=32, default=newSecret)
+
+class WebhookEvent(models.Model):
+    '''Event waiting to be delivered to a webhook by
+    "./manage.py deliver_webhooks"'''
+    webhook = models.ForeignKey(Webhook)
+    event = models.CharField(max_length=20)
+    payload = models.TextField()
+    date = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+
+def queueWebhookEvents(webhooks, event, **data):
+    '''Queue an event for each webhook of a queryset - in the transaction of
+    the modification. Return the number of queued events.'''
+    now = datetime.datetime.now()
+    events = []
+    for webhook in webhooks.select_related('poll'):
+        payload = dict(data, event=event, date=now.isoformat(),
+                       poll={'url':webhook.poll.base_url,
+                             'name':webhook.poll.name})
+        events.append(WebhookEvent(webhook=webhook, event=event,
+                                   payload=json.dumps(payload),
+                                   next_attempt=now))
+    if events:
+        WebhookEvent.objects.using(webhooks.db).bulk_create(events)
+    return len(events)
+
+class Task(models.Model):
+    '''Deferred work executed by a task runner (see polls.tasks). A task is
+    queued once by key: its key is changed when it is started.'''
+    key = models.CharField(max_length=200, unique=True)
+    # name of the function in polls.tasks
+    name = models.CharField(max_length=50)
+    # JSON list of the arguments
+    args = models.TextField()
+    date = models.DateTimeField(auto_now_add=True)
+    attempts = models.IntegerField(default=0)
+    next_attempt = models.DateTimeField(db_index=True)
+
+def queueTask(name, *args, **kwargs):
+    '''Queue the task name with args - JSON values - in the transaction of
+    the modification unless the same task is waiting. The task is executed
+    after delay seconds (keyword argument). Return if it has been queued.
+    '''
+    key = u':'.join([name] + [unicode(arg) for arg in args])
+    if Task.objects.filter(key=key).exists():
+        return False
+    using = router.db_for_write(Task)
+    next_attempt = datetime.datetime.now() + datetime.timedelta(
+                                            seconds=kwargs.get('delay', 0))
+    savepoint = transaction.savepoint(using=using)
+    try:
+        Task.objects.using(using).create(key=key, name=name,
+                          args=json.dumps(args), next_attempt=next_attempt)
+    except IntegrityError:
+        # queued meanwhile
+        transaction.savepoint_rollback(savepoint, using=using)
+        return False
+    transaction.savepoint_commit(savepoint, using=using)
+    return True
+
+# packed ballots: one character by choice at the ballot index of the choice
+NO_ANSWER = '.'
+# tries to give a new choice a ballot index taken by no other choice
+BALLOT_INDEX_ATTEMPTS = 10
+BALLOT_VALUES = range(-1, 10)
+
+def packValue(value):
+    if value is None:
+        return NO_ANSWER
+    if value not in BALLOT_VALUES:
+        raise ValueError
+    return chr(ord('B') + value)
+
+def packValues(values):
+    "Pack a dict of values by ballot index"
+    ballot = [None] * (max(values) + 1 if values else 0)
+    for index in values:
+        ballot[index] = values[index]
+    return ''.join([packValue(value) for value in ballot])
+
+def unpackBallot(ballot):
+    "Get the list of values of a packed ballot"
+    return [None if code == NO_ANSWER else ord(code) - ord('B')
+            for code in ballot]
+
+def sumBallots(ballots, indexes):
+    '''Sum of the values of packed ballots for each ballot index.
+    Ballots are read column by column: each value is counted in a column.
+    '''
+    if not indexes:
+        return []
+    length = max(indexes) + 1
+    columns = zip(*[ballot[:length].ljust(length, NO_ANSWER)
+                    for ballot in ballots])
+    sums = []
+    for index in indexes:
+        if not columns:
+            sums.append(0)
+            continue
+        column = ''.join(columns[index])
+        sums.append(sum([value * column.count(packValue(value))
+                         for value in BALLOT_VALUES if value]))
+    return sums
+
 class Voter(models.Model):
     user = models.ForeignKey(PollUser)
     poll = models.ForeignKey(Poll)
     creation_date = models.DateTimeField(auto_now_add=True)
     modification_date = models.DateTimeField(auto_now=True)
+    # packed votes - if null votes are stored in Vote
+    ballot = models.TextField(null=True, blank=True)
     class Meta:
         ordering = ['creation_date']
     def __unicode__(self):
         return _("Vote from %(user)s") % {'user':self.user.name}
-    def getVotes(self, choice_ids):
-        '''Get votes for a subset of choices
+    def getVotes(self, choices, absent_value=None):
+        '''Get votes for a list of choices in the same order.
+        Missing votes are unsaved votes with the absent value of the poll.
         '''
-        query = Vote.objects.filter(voter=self)
-        query = query.extra(where=['choice_id IN (%s)' \
-                     % ",".join([str(choice_id) for choice_id in choice_ids])])
-        return list(query.order_by('choice'))
+        if self.ballot is not None:
+            values = unpackBallot(self.ballot)
+            votes = []
+            for choice in choices:
+                value = None
+                if choice.ballot_index < len(values):
+                    value = values[choice.ballot_index]
+                if value is None:
+                    value = absent_value
+                votes.append(Vote(voter=self, choice=choice, value=value))
+            return votes
+        votes = dict([(vote.choice_id, vote) for vote in
+                      Vote.objects.filter(voter=self, choice__in=choices)])
+        for choice in choices:
+            if choice.id in votes:
+                votes[choice.id].choice = choice
+            else:
+                votes[choice.id] = Vote(voter=self, choice=choice,
+                                        value=absent_value)
+        return [votes[choice.id] for choice in choices]
+
+    def setVotes(self, values):
+        '''Set votes from a dict of explicit values by choice - other choices
+        get the absent value - and save the voter.
+        New votes are packed if PACKED_BALLOTS is set. The change is appended
+        to the ballot log of the poll.
+        '''
+        kind, previous = ('M', self.getBallot()) if self.pk else ('C', '')
+        ballot = packValues(dict([(choice.ballot_index, values[choice])
+                                  for choice in values]))
+        self.storeVotes(values, ballot)
+        logBallot(self, kind, previous, ballot)
+
+    def getBallot(self):
+        "Packed values of the voter whatever the storage of its votes"
+        if self.ballot is not None:
+            return self.ballot
+        if not self.pk:
+            return ''
+        return packValues(dict(Vote.objects.filter(voter=self).values_list(
+                                             'choice__ballot_index', 'value')))
+
+    def storeVotes(self, values, ballot):
+        "Store the votes in one row by choice or the packed ballot"
+        if self.ballot is None and not settings.PACKED_BALLOTS:
+            self.save()
+            votes = dict([(vote.choice_id, vote)
+                          for vote in Vote.objects.filter(voter=self)])
+            Vote.objects.filter(voter=self).exclude(
+                             choice__in=[choice.id for choice in values]).delete()
+            for choice in values:
+                vote = votes.get(choice.id) or Vote(voter=self, choice=choice)
+                if vote.value != values[choice] or not vote.id:
+                    vote.value = values[choice]
+                    vote.save()
+            return
+        if self.ballot is None and self.pk:
+            # the votes are now packed
+            Vote.objects.filter(voter=self).delete()
+        self.ballot = ballot
+        self.save()
 
 class Choice(models.Model):
     poll = models.ForeignKey(Poll)
@@ -168,10 +514,50 @@ class Choice(models.Model):
     order = models.IntegerField()
     limit = models.IntegerField(null=True, blank=True)
     available = models.BooleanField(default=True)
+    # stable position of the choice in packed ballots
+    ballot_index = models.IntegerField(null=True, blank=True)
     class Admin:
         pass
     class Meta:
         ordering = ['order']
+        unique_together = (('poll', 'ballot_index'),)
+
+    def save(self, *args, **kwargs):
+        if self.ballot_index is not None:
+            return super(Choice, self).save(*args, **kwargs)
+        # the next index: it can be taken by a choice added meanwhile
+        using = kwargs.get('using') or router.db_for_write(Choice,
+                                                           instance=self)
+        tried = -1
+        for attempt in range(BALLOT_INDEX_ATTEMPTS):
+            index = Choice.objects.using(using).filter(poll=self.poll_id
+                        ).aggregate(models.Max('ballot_index'))['ballot_index__max']
+            # higher at each attempt even if the database shows an old state
+            tried = max(tried + 1, 0 if index is None else index + 1)
+            self.ballot_index = tried
+            savepoint = transaction.savepoint(using=using)
+            try:
+                super(Choice, self).save(*args, **kwargs)
+            except IntegrityError:
+                transaction.savepoint_rollback(savepoint, using=using)
+                if attempt == BALLOT_INDEX_ATTEMPTS - 1:
+                    self.ballot_index = None
+                    raise
+                continue
+            transaction.savepoint_commit(savepoint, using=using)
+            return
+
+    def delete(self, *args, **kwargs):
+        BallotEvent.objects.create(poll_id=self.poll_id, kind='R',
+                      name=self.name[:100], ballot_index=self.ballot_index)
+        # clear the values of the choice: the ballot index can be reused
+        for voter in Voter.objects.filter(poll=self.poll, ballot__isnull=False):
+            if len(voter.ballot) > self.ballot_index:
+                ballot = voter.ballot[:self.ballot_index] + NO_ANSWER \
+                         + voter.ballot[self.ballot_index + 1:]
+                # update to keep the modification date of the voter
+                Voter.objects.filter(pk=voter.pk).update(ballot=ballot)
+        super(Choice, self).delete(*args, **kwargs)
 
     def get_date(self):
         if not self.poll.dated_choices:
@@ -187,9 +573,7 @@ class Choice(models.Model):
 
     def getSum(self, balanced_poll=None):
         '''Get the sum of votes for this choice'''
-        sum = 0
-        for vote in Vote.objects.filter(choice=self, value__isnull=False):
-            sum += vote.value
+        sum = self.poll.getSums([self])[0]
         if balanced_poll:
             return sum/2
         return sum
@@ -225,3 +609,242 @@ class Vote(models.Model):
             (0, (_('No'), _('Maybe')), ),
             (-1, (_('No'), _('No'))),)
     value = models.IntegerField(choices=VOTE, blank=True, null=True)
+
+class BallotEvent(models.Model):
+    '''Append-only log of the ballots of a poll: each new, modified or
+    deleted ballot is kept packed before and after the change. The removal of
+    a choice clears its ballot index.'''
+    poll = models.ForeignKey(Poll)
+    KIND = (('C', _('New vote')),
+            ('M', _('Modified vote')),
+            ('D', _('Deleted vote')),
+            ('R', _('Removed choice')),)
+    kind = models.CharField(max_length=1, choices=KIND)
+    # the voter may have been deleted since
+    voter_id = models.IntegerField(null=True, blank=True)
+    # name of the voter or of the removed choice
+    name = models.CharField(max_length=100)
+    previous = models.TextField(blank=True)
+    ballot = models.TextField(blank=True)
+    # index of the removed choice
+    ballot_index = models.IntegerField(null=True, blank=True)
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
+    class Meta:
+        ordering = ['id']
+
+def logBallot(voter, kind, previous, ballot):
+    "Append the change of the packed ballot of a voter to the log"
+    BallotEvent.objects.create(poll_id=voter.poll_id, kind=kind,
+                               voter_id=voter.pk, name=voter.user.name,
+                               previous=previous, ballot=ballot)
+
+class TallySnapshot(models.Model):
+    '''Sums by ballot index of the ballots of a poll after an event of its log
+    - made by "./manage.py snapshot_tallies"'''
+    poll = models.ForeignKey(Poll)
+    event = models.ForeignKey(BallotEvent)
+    # date of the event
+    date = models.DateTimeField(db_index=True)
+    # JSON list of the sums
+    tally = models.TextField()
+    class Meta:
+        ordering = ['event']
+
+def addBallot(sums, ballot, sign=1):
+    "Add the values of a packed ballot to sums by ballot index"
+    for index, value in enumerate(unpackBallot(ballot)):
+        if not value:
+            continue
+        if index >= len(sums):
+            sums += [0] * (index - len(sums) + 1)
+        sums[index] += sign * value
+
+def replayTally(poll_id, date=None, using=None):
+    '''Sums by ballot index of the ballots of a poll at a date - now by
+    default - replayed from the nearest snapshot. Return the sums and the
+    last replayed event or None.
+    '''
+    snapshots = TallySnapshot.objects.using(using).filter(poll=poll_id)
+    events = BallotEvent.objects.using(using).filter(poll=poll_id)
+    if date:
+        snapshots = snapshots.filter(date__lte=date)
+        events = events.filter(date__lte=date)
+    sums, last = [], None
+    snapshots = list(snapshots.order_by('-event')[:1])
+    if snapshots:
+        sums, last = json.loads(snapshots[0].tally), snapshots[0].event_id
+        events = events.filter(pk__gt=last)
+    for last, kind, previous, ballot, index in events.values_list('id',
+                      'kind', 'previous', 'ballot', 'ballot_index').iterator():
+        if kind == 'R':
+            if index < len(sums):
+                sums[index] = 0
+            continue
+        addBallot(sums, previous, -1)
+        addBallot(sums, ballot)
+    return sums, last
+
+def getTally(poll, choices, date=None):
+    "Sums of votes for each choice at a date replayed from the ballot log"
+    sums = replayTally(poll.pk, date, poll._state.db)[0]
+    return [sums[choice.ballot_index] if choice.ballot_index < len(sums)
+            else 0 for choice in choices]
+
+def snapshotTally(poll_id, using=None):
+    "Save a snapshot of the current tally of a poll"
+    sums, last = replayTally(poll_id, using=using)
+    if last is None:
+        return
+    event = BallotEvent.objects.using(using).get(pk=last)
+    return TallySnapshot.objects.using(using).create(poll_id=poll_id,
+                             event=event, date=event.date, tally=json.dumps(sums))
+
+class DailyStats(models.Model):
+    '''Activity of a day for a category - the row without category, written
+    for every day, counts the polls without category. Made by
+    "./manage.py rollup_stats" on each database.'''
+    day = models.DateField(db_index=True)
+    category = models.ForeignKey(Category, null=True, blank=True,
+                                 on_delete=models.SET_NULL)
+    # created polls
+    polls = models.IntegerField(default=0)
+    # new ballots
+    votes = models.IntegerField(default=0)
+    # polls with a new, modified or deleted ballot or a comment
+    active_polls = models.IntegerField(default=0)
+    comments = models.IntegerField(default=0)
+    class Meta:
+        ordering = ['day']
+
+def rollupDay(day, using=None):
+    '''Write the statistics of a day from the polls, ballot events and
+    comments of the day: only these rows are read (by indexed dates).
+    '''
+    start = datetime.datetime.combine(day, datetime.time())
+    end = start + datetime.timedelta(days=1)
+    stats = {None:DailyStats(day=day)}
+    def getStats(category_id):
+        if category_id not in stats:
+            stats[category_id] = DailyStats(day=day, category_id=category_id)
+        return stats[category_id]
+    # no ordering: it would be part of the grouping
+    polls = Poll.objects.using(using).filter(creation_date__gte=start,
+                                             creation_date__lt=end).order_by()
+    for category_id, count in polls.values('category').annotate(
+                    count=Count('id')).values_list('category', 'count'):
+        getStats(category_id).polls = count
+    events = BallotEvent.objects.using(using).filter(date__gte=start,
+                                date__lt=end).exclude(kind='R').order_by()
+    for category_id, count in events.filter(kind='C').values(
+                 'poll__category').annotate(count=Count('id')).values_list(
+                 'poll__category', 'count'):
+        getStats(category_id).votes = count
+    comments = Comment.objects.using(using).filter(date__gte=start,
+                                                   date__lt=end).order_by()
+    for category_id, count in comments.values('poll__category').annotate(
+                 count=Count('id')).values_list('poll__category', 'count'):
+        getStats(category_id).comments = count
+    active = set(events.values_list('poll', 'poll__category').distinct()) \
+             | set(comments.values_list('poll', 'poll__category').distinct())
+    for poll_id, category_id in active:
+        getStats(category_id).active_polls += 1
+    with transaction.commit_on_success(using=using):
+        # the day can be rolled up again
+        DailyStats.objects.using(using).filter(day=day).delete()
+        DailyStats.objects.using(using).bulk_create(stats.values())
+
+def closeDuePolls(using=DEFAULT_DB_ALIAS):
+    '''Close the open polls whose closing date has passed with a single
+    update. Return the number of closed polls.
+    '''
+    now = datetime.datetime.now()
+    polls = Poll.objects.using(using).filter(open=True, enddate__lte=now)
+    with transaction.commit_on_success(using=using):
+        queueWebhookEvents(Webhook.objects.using(using).filter(
+                                poll__in=polls.values('pk')), 'closed')
+        # the modification date is the version of the pages of the poll
+        return polls.update(open=False, modification_date=now)
+
+PURGE_CHUNK_SIZE = 100
+
+def getLeftAuthors(author_ids, using=None):
+    "The authors - and their e-mail - among author_ids left without poll"
+    using = using or router.db_for_write(PollUser)
+    kept = Poll.objects.using(using).filter(author__in=author_ids
+                                            ).values_list('author_id', flat=True)
+    return PollUser.objects.using(using).filter(pk__in=author_ids).exclude(
+                                                           pk__in=list(kept))
+
+def purgePolls(polls, using=DEFAULT_DB_ALIAS):
+    '''Delete the polls of a queryset with their choices, voters, votes,
+    comments, notifications, webhooks, ballot logs and authors left without
+    poll by a few queries for each chunk of polls - no signal is sent. Return
+    the number of deleted polls.
+    '''
+    poll_ids = list(polls.using(using).values_list('id', flat=True))
+    for idx in xrange(0, len(poll_ids), PURGE_CHUNK_SIZE):
+        ids = poll_ids[idx:idx + PURGE_CHUNK_SIZE]
+        with transaction.commit_on_success(using=using):
+            voters = Voter.objects.using(using).filter(poll__in=ids)
+            user_ids = list(voters.values_list('user_id', flat=True))
+            author_ids = list(Poll.objects.using(using).filter(pk__in=ids,
+                   author__isnull=False).values_list('author_id', flat=True))
+            # the rows referring to others first
+            Vote.objects.using(using).filter(voter__poll__in=ids
+                                             )._raw_delete(using)
+            voters._raw_delete(using)
+            for jdx in xrange(0, len(user_ids), PURGE_CHUNK_SIZE):
+                PollUser.objects.using(using).filter(
+                  pk__in=user_ids[jdx:jdx + PURGE_CHUNK_SIZE])._raw_delete(using)
+            Comment.objects.using(using).filter(poll__in=ids)._raw_delete(using)
+            Notification.objects.using(using).filter(poll__in=ids
+                                                     )._raw_delete(using)
+            TallySnapshot.objects.using(using).filter(poll__in=ids
+                                                      )._raw_delete(using)
+            BallotEvent.objects.using(using).filter(poll__in=ids
+                                                    )._raw_delete(using)
+            WebhookEvent.objects.using(using).filter(webhook__poll__in=ids
+                                                     )._raw_delete(using)
+            Webhook.objects.using(using).filter(poll__in=ids)._raw_delete(using)
+            Choice.objects.using(using).filter(poll__in=ids)._raw_delete(using)
+            Poll.objects.using(using).filter(pk__in=ids)._raw_delete(using)
+            getLeftAuthors(author_ids, using)._raw_delete(using)
+    return len(poll_ids)
+
+def getAutoDates(obj):
+    "Values of the dates of an object set automatically at the save"
+    return dict([(field.attname, getattr(obj, field.attname))
+                 for field in obj._meta.fields
+                 if (getattr(field, 'auto_now', False)
+                     or getattr(field, 'auto_now_add', False))
+                 and (getattr(obj, field.attname) is not None or field.null)])
+
+def saveWithDates(obj, using, **kwargs):
+    '''Save an imported or copied object keeping its dates: they are set again
+    after the insert'''
+    dates = getAutoDates(obj)
+    obj.save(using=using, **kwargs)
+    if dates:
+        obj.__class__._default_manager.using(using).filter(pk=obj.pk
+                                                           ).update(**dates)
+        for attname in dates:
+            setattr(obj, attname, dates[attname])
+
+def insertWithDates(model, objs, using):
+    '''Insert imported or copied objects by batches keeping their dates -
+    like bulk_create without the automatic dates. To be called in a
+    transaction.'''
+    using = using or router.db_for_write(model)
+    fields = [field for field in model._meta.local_fields
+              if not isinstance(field, models.AutoField)]
+    for obj in objs:
+        for field in fields:
+            # missing date: the one of the insert
+            if (getattr(field, 'auto_now', False)
+                or getattr(field, 'auto_now_add', False)) \
+               and getattr(obj, field.attname) is None and not field.null:
+                field.pre_save(obj, True)
+    size = max(connections[using].ops.bulk_batch_size(fields, objs), 1)
+    for idx in xrange(0, len(objs), size):
+        model._base_manager._insert(objs[idx:idx + size], fields=fields,
+                                    using=using, raw=True)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Overload protection: when too many requests are in progress in the process
+or when the database is slow, the poll pages are served from their last
+rendering kept in the cache and the posts are refused until the load falls.
+'''
+
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils import translation
+from django.utils.translation import ugettext as _
+
+# replaced by the banner in the kept renderings of the poll pages
+BANNER_MARK = u'<!-- overload -->'
+
+class Load(object):
+    '''Load of the process: requests in progress and average latency of the
+    database. Above OVERLOAD_REQUESTS or OVERLOAD_LATENCY the process is
+    degraded for OVERLOAD_RETRY seconds, then the latency is measured again.
+    '''
+    # weight of a new measure in the average latency
+    weight = 0.2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.latency = 0.
+        self.degraded_until = 0
+
+    def start(self):
+        with self.lock:
+            self.requests += 1
+
+    def end(self):
+        with self.lock:
+            self.requests -= 1
+
+    def observe(self, seconds):
+        with self.lock:
+            self.latency += self.weight * (seconds - self.latency)
+
+    def isDegraded(self):
+        now = time.time()
+        if now < self.degraded_until:
+            return True
+        if not (settings.OVERLOAD_REQUESTS
+                and self.requests > settings.OVERLOAD_REQUESTS) \
+           and not (settings.OVERLOAD_LATENCY
+                    and self.latency > settings.OVERLOAD_LATENCY):
+            return False
+        with self.lock:
+            self.degraded_until = now + settings.OVERLOAD_RETRY
+            # measured again with the requests let through after the pause
+            self.latency = 0.
+        return True
+
+    def retryAfter(self):
+        return max(1, int(self.degraded_until - time.time()) + 1)
+
+load = Load()
+
+def isEnabled():
+    return bool(settings.OVERLOAD_REQUESTS or settings.OVERLOAD_LATENCY)
+
+@contextmanager
+def measured():
+    "Add the duration of the database accesses of the block to the latency"
+    start = time.time()
+    try:
+        yield
+    finally:
+        load.observe(time.time() - start)
+
+def getPageKey(base_url, language):
+    return 'papillon_page_%s_%s' % (base_url, language)
+
+def keepPage(poll, response):
+    "Keep the rendering of a poll page to serve it when the site is overloaded"
+    if not isEnabled() or response.status_code != 200 or response.streaming:
+        return
+    cache.set(getPageKey(poll.base_url, translation.get_language()),
+              response.content, settings.OVERLOAD_PAGE_TIMEOUT)
+
+def getKeptPage(request, base_url):
+    '''The kept rendering of a poll page with a banner or None. The language
+    of the session cannot be read: the language of the browser is used.
+    '''
+    languages = [translation.get_language_from_request(request),
+                 settings.LANGUAGE_CODE] \
+                + [language for language, label in settings.LANGUAGES]
+    for language in languages:
+        content = cache.get(getPageKey(base_url, language))
+        if content is None:
+            continue
+        with translation.override(language):
+            banner = u"<p class='alert'>%s</p>" % _("The site is "
+                "overloaded: this page may be out of date and votes are "
+                "suspended for a few minutes.")
+        return HttpResponse(content.replace(BANNER_MARK.encode('utf-8'),
+                                            banner.encode('utf-8')))
+
+def overloadedResponse():
+    "Refuse a request until the site is no longer overloaded"
+    response = HttpResponse(_("The site is overloaded: try again in a few "
+                              "minutes."), status=503,
+                            content_type='text/plain; charset=utf-8')
+    response['Retry-After'] = str(load.retryAfter())
+    return response
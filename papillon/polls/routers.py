@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Database routers
+'''
+
+import hashlib
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# state of the request handled by the current thread - set by
+# papillon.polls.middleware.ReplicaMiddleware and by the views
+_state = threading.local()
+
+def resetState():
+    "Read from the primary database and forget previous writes and shard"
+    _state.replica = None
+    _state.written = False
+    _state.shard = None
+
+def readFromReplica(alias):
+    "Read from the replica alias until the end of the current request"
+    _state.replica = alias
+
+def onReplica():
+    "Check if the current thread reads from a replica"
+    return bool(getattr(_state, 'replica', None))
+
+def pinPrimary():
+    "Read from the primary database until the end of the current request"
+    _state.replica = None
+
+def markWritten():
+    _state.written = True
+
+def hasWritten():
+    return getattr(_state, 'written', False)
+
+@contextmanager
+def primary():
+    "Read from the primary database inside the block"
+    replica = getattr(_state, 'replica', None)
+    _state.replica = None
+    try:
+        yield
+    finally:
+        _state.replica = replica
+
+def saveState():
+    "Replica and shard of the current request - see restoredState"
+    return getattr(_state, 'replica', None), currentShard()
+
+@contextmanager
+def restoredState(state):
+    '''Read from the replica and the shard of a saved state inside the block:
+    streamed responses are read after the end of the request.
+    '''
+    previous = saveState()
+    _state.replica, _state.shard = state
+    try:
+        yield
+    finally:
+        _state.replica, _state.shard = previous
+
+def pollDatabases():
+    "Databases where polls are stored - None is the routed database"
+    return settings.SHARD_DATABASES or (None,)
+
+def shardFor(base_url):
+    "Shard of a poll: stable hash of its base url"
+    if not settings.SHARD_DATABASES:
+        return None
+    digest = hashlib.md5(base_url.encode('utf-8')).hexdigest()
+    return settings.SHARD_DATABASES[int(digest[:8], 16) %
+                                    len(settings.SHARD_DATABASES)]
+
+def lookupDatabases(base_url=None):
+    '''Databases where to look for a poll: its shard first then the others as
+    a poll can be on another shard until it is moved by rebalance_shards.
+    '''
+    databases = list(pollDatabases())
+    shard = base_url and shardFor(base_url)
+    if shard:
+        databases.remove(shard)
+        databases.insert(0, shard)
+    return databases
+
+def useShard(alias):
+    "Read and write papillon models on alias until the end of the request"
+    _state.shard = alias
+
+def currentShard():
+    return getattr(_state, 'shard', None)
+
+@contextmanager
+def onShard(alias):
+    "Use the shard alias inside the block"
+    shard = currentShard()
+    _state.shard = alias
+    try:
+        yield
+    finally:
+        _state.shard = shard
+
+def gather(queryset):
+    '''Get the results of queryset on every shard (scatter-gather) sorted with
+    the default ordering of the model. Without sharding the queryset is
+    returned.
+    '''
+    if not settings.SHARD_DATABASES:
+        return queryset
+    results = []
+    for alias in settings.SHARD_DATABASES:
+        results += list(queryset.using(alias))
+    # successive stable sorts from the last ordering key to the first
+    for key in reversed(queryset.model._meta.ordering):
+        reverse = key.startswith('-')
+        key = key.lstrip('-')
+        results.sort(key=lambda obj:getattr(obj, key), reverse=reverse)
+    return results
+
+def isSharded(model):
+    "Models stored with their poll - categories are copied on each shard"
+    return model._meta.app_label == 'polls' \
+           and model._meta.object_name != 'Category'
+
+class ShardRouter(object):
+    '''Store each poll with its choices, voters, votes and comments on one of
+    SHARD_DATABASES chosen by a hash of its base url.
+    The shard of the current request is set by the views when the poll is
+    found (see papillon.polls.models.getPoll).
+    '''
+    def db_for_read(self, model, **hints):
+        if not settings.SHARD_DATABASES or not isSharded(model):
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return currentShard()
+
+    def db_for_write(self, model, **hints):
+        if not settings.SHARD_DATABASES or not isSharded(model):
+            return None
+        markWritten()
+        instance = hints.get('instance')
+        if instance is not None:
+            # a new poll can get the database of its category
+            if model._meta.object_name == 'Poll' and instance._state.adding \
+               and instance.base_url:
+                return shardFor(instance.base_url)
+            if instance._state.db:
+                return instance._state.db
+        return currentShard()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if settings.SHARD_DATABASES and obj1._meta.app_label == 'polls' \
+           and obj2._meta.app_label == 'polls':
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        return None
+
+class ReplicaRouter(object):
+    '''Send the reads of the read-only views to REPLICA_DATABASE and all the
+    other queries to the default database.
+    '''
+    def is_papillon(self, model):
+        return model._meta.app_label == 'polls'
+
+    def db_for_read(self, model, **hints):
+        if not self.is_papillon(model):
+            return None
+        return getattr(_state, 'replica', None)
+
+    def db_for_write(self, model, **hints):
+        if not self.is_papillon(model):
+            return None
+        markWritten()
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica is a copy of the default database
+        if self.is_papillon(obj1) and self.is_papillon(obj2):
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if settings.REPLICA_DATABASE and db == settings.REPLICA_DATABASE:
+            return False
+        return None
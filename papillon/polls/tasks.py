@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Deferred maintenance work: the views queue tasks in the database and return
+at once, the tasks are executed by a bounded pool of threads of the process
+or by "./manage.py run_tasks".
+'''
+
+import datetime
+import json
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db.models import Min
+
+from papillon.polls.models import Poll, Choice, Task, queueTask
+from papillon.polls.database import write
+from papillon.polls.routers import pollDatabases, useShard
+
+TASKS = {}
+
+def task(fct):
+    "Register a function executable as a task"
+    TASKS[fct.__name__] = fct
+    return fct
+
+@task
+def reorderChoices(poll_id):
+    "Sort the dated choices of a poll"
+    polls = Poll.objects.filter(pk=poll_id)
+    if polls:
+        polls[0].reorder()
+        polls[0].touch()
+
+@task
+def saveAvailability(poll_id):
+    "Save the availability of the choices of a poll according to their limit"
+    polls = Poll.objects.filter(pk=poll_id)
+    if not polls:
+        return
+    choices = list(Choice.objects.filter(poll=poll_id))
+    sums = polls[0].getSums(choices)
+    if polls[0].type == 'B':
+        sums = [sum/2 for sum in sums]
+    for choice in polls[0].checkAvailability(choices, sums):
+        Choice.objects.filter(pk=choice.pk).update(available=choice.available)
+
+@task
+def cleanPolls(after_id=0):
+    '''Erase the old polls among the TASKS_CLEANING_CHUNK next ones after
+    after_id - in one transaction - then queue the cleaning of the following
+    ones or the next cleaning'''
+    limit = datetime.datetime.now() \
+            - datetime.timedelta(days=settings.DAYS_TO_LIVE)
+    polls = list(Poll.objects.filter(modification_date__lte=limit,
+                                     pk__gt=after_id).order_by('pk')[
+                                     :settings.TASKS_CLEANING_CHUNK])
+    last_id = polls[-1].pk if polls else after_id
+    for poll in polls:
+        poll.checkForErasement()
+    if len(polls) == settings.TASKS_CLEANING_CHUNK:
+        queueTask('cleanPolls', last_id)
+    else:
+        queueTask('cleanPolls', delay=settings.TASKS_CLEANING_INTERVAL)
+
+class TaskRunner(object):
+    '''Execute the due tasks with a bounded pool of threads. The number of
+    executed and failed tasks and their latency - from their queuing to their
+    end - are kept.
+    '''
+    def __init__(self, threads):
+        self.pool = ThreadPool(threads)
+        self.lock = threading.Lock()
+        self.executed, self.failed = 0, 0
+        self.latency, self.max_latency = 0., 0.
+
+    def execute(self, args):
+        "Execute a task on its database and return if it has succeeded"
+        task, using = args
+        useShard(using)
+        try:
+            write(TASKS[task.name], *json.loads(task.args))
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            with self.lock:
+                self.failed += 1
+            return False
+        latency = (datetime.datetime.now() - task.date).total_seconds()
+        with self.lock:
+            self.executed += 1
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        return True
+
+    def executeTasks(self, tasks, using):
+        "Execute tasks and return if each of them has succeeded"
+        return self.pool.map(self.execute, [(task, using) for task in tasks],
+                             chunksize=1)
+
+    def getStats(self):
+        "Executed and failed tasks, average and maximum latency in seconds"
+        with self.lock:
+            return {'executed':self.executed, 'failed':self.failed,
+                    'latency':self.latency / self.executed
+                              if self.executed else 0.,
+                    'max_latency':self.max_latency}
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+def claimDueTasks(using):
+    '''Start a batch of the tasks due on a database: their key is changed so
+    the same work can be queued again while they are executed, and they are
+    executed again after TASKS_LEASE seconds if the runner has stopped.
+    '''
+    now = datetime.datetime.now()
+    lease = now + datetime.timedelta(seconds=settings.TASKS_LEASE)
+    claimed = []
+    for task in Task.objects.using(using).filter(next_attempt__lte=now
+                  ).order_by('next_attempt', 'id')[:settings.TASKS_BATCH_SIZE]:
+        suffix = u'@%d' % task.pk
+        key = task.key if task.key.endswith(suffix) else task.key + suffix
+        # not claimed meanwhile by another runner
+        if Task.objects.using(using).filter(pk=task.pk,
+                    next_attempt=task.next_attempt).update(key=key,
+                                                           next_attempt=lease):
+            claimed.append(task)
+    return claimed
+
+def runDueTasks(runner, using):
+    '''Execute a batch of the tasks due on a database: executed tasks are
+    deleted, the others are tried again later with a doubled delay. Return
+    the number of executed and failed tasks.
+    '''
+    tasks = claimDueTasks(using)
+    if not tasks:
+        return 0, 0
+    executed, failed = [], []
+    for task, succeeded in zip(tasks, runner.executeTasks(tasks, using)):
+        if succeeded:
+            executed.append(task.pk)
+        else:
+            failed.append(task)
+    Task.objects.using(using).filter(pk__in=executed).delete()
+    now = datetime.datetime.now()
+    for task in failed:
+        task.attempts += 1
+        if task.attempts >= settings.TASKS_MAX_ATTEMPTS:
+            # abandoned
+            Task.objects.using(using).filter(pk=task.pk).delete()
+            continue
+        delay = settings.TASKS_RETRY_DELAY * 2 ** (task.attempts - 1)
+        Task.objects.using(using).filter(pk=task.pk).update(
+                  attempts=task.attempts,
+                  next_attempt=now + datetime.timedelta(seconds=delay))
+    return len(executed), len(failed)
+
+def getQueueStats(using):
+    "Number of queued tasks and age in seconds of the oldest one"
+    tasks = Task.objects.using(using).order_by()
+    oldest = tasks.aggregate(oldest=Min('date'))['oldest']
+    return tasks.count(), (datetime.datetime.now() - oldest).total_seconds() \
+                          if oldest else 0.
+
+def scheduleCleaning(using):
+    "Queue the cleaning of the old polls if it is not waiting or in progress"
+    if settings.DAYS_TO_LIVE and not Task.objects.using(using).filter(
+                                                 name='cleanPolls').exists():
+        useShard(using)
+        write(queueTask, 'cleanPolls')
+
+def runTasks(runner, interval, loop=True):
+    '''Execute the due tasks of every database - until the queues are empty
+    if loop is False'''
+    for alias in pollDatabases():
+        scheduleCleaning(alias)
+    while True:
+        started = False
+        for alias in pollDatabases():
+            executed, failed = runDueTasks(runner, alias)
+            started = started or bool(executed + failed)
+        if started:
+            # more tasks may be waiting or queued by the executed ones
+            continue
+        if not loop:
+            return
+        time.sleep(interval)
+
+class RunnerThread(threading.Thread):
+    '''Execute the tasks in the process with TASKS_THREADS threads - see
+    startRunner'''
+    def __init__(self):
+        threading.Thread.__init__(self, name='papillon-tasks')
+        self.daemon = True
+        self.runner = TaskRunner(settings.TASKS_THREADS)
+
+    def run(self):
+        while True:
+            try:
+                runTasks(self.runner, settings.TASKS_INTERVAL)
+            except Exception:
+                # the database may be unavailable for a while
+                traceback.print_exc(file=sys.stderr)
+                time.sleep(settings.TASKS_INTERVAL)
+
+_runner = None
+_runner_lock = threading.Lock()
+
+def startRunner():
+    "Start the task runner of the process unless TASKS_THREADS is 0"
+    global _runner
+    if not settings.TASKS_THREADS:
+        return
+    with _runner_lock:
+        if not _runner or not _runner.is_alive():
+            _runner = RunnerThread()
+            _runner.start()
+
+def defer(name, *args, **kwargs):
+    '''Queue a task from a view - in the transaction of the modification -
+    and make sure the runner of the process is started'''
+    queueTask(name, *args, **kwargs)
+    startRunner()
@@ -0,0 +1,17 @@
+from django.template import Library
+
+from papillon.polls.assets import getAssetUrl
+
+register = Library()
+
+@register.simple_tag
+def asset(name):
+    """
+        Tag - returns the url of a static file: its collected copy if
+        "./manage.py collect_assets" has been run
+        Usage (in template):
+
+            <link rel="stylesheet" href="{% asset "styles.css" %}" />
+            <script type="text/javascript" src="{% asset "admin/js/core.js" %}">
+    """
+    return getAssetUrl(name)
@@ -0,0 +1,1597 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Tests of papillon - ./manage.py test polls --settings=test_settings
+'''
+
+import BaseHTTPServer
+import datetime
+import gzip
+import json
+import os
+import shutil
+import re
+import sys
+import SocketServer
+import StringIO
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core import mail, signing
+from django.core.cache import cache
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import translation
+
+from papillon.polls import assets, limits
+from papillon.polls.database import write
+from papillon.polls.forms import CreatePollForm, AdminPollForm, \
+                                 WebhookForm, CommentForm
+from papillon.polls.handlers import PapillonHandler
+from papillon.polls.middleware import PRIMARY_COOKIE, KNOWN_VOTES_COOKIE, \
+                                      KnownVotesMiddleware
+from papillon.polls.models import Poll, PollUser, Category, Choice, Voter, \
+                                  Vote, Comment, Notification, Webhook, \
+                                  WebhookEvent, BallotEvent, getPoll, \
+                                  queueWebhookEvents, packValue, packValues, \
+                                  unpackBallot, sumBallots, \
+                                  TallySnapshot, Task, DailyStats, getTally, \
+                                  queueTask
+from papillon.polls.overload import load
+from papillon.polls.routers import readFromReplica, resetState, shardFor
+from papillon.polls.tasks import TASKS, TaskRunner, claimDueTasks, \
+                                 runDueTasks
+from papillon.polls.views import CellRenderer, iterVoters
+from papillon.polls.webhooks import sign, claimDueEvents, isPublicAddress
+
+def createPoll(base_url, using=None, **values):
+    fields = {'base_url':base_url, 'admin_url':base_url + '_admin',
+              'author_name':'author', 'name':'Poll', 'description':'Poll',
+              'type':'P'}
+    fields.update(values)
+    poll = Poll(**fields)
+    poll.save(using=using)
+    return poll
+
+def addChoices(poll, number):
+    return [Choice.objects.create(poll=poll, name='choice %d' % idx,
+                                  order=idx) for idx in xrange(number)]
+
+def addVoter(poll, name, values):
+    "Vote on the poll: values by choice"
+    voter = Voter(poll=poll, user=PollUser.objects.create(name=name))
+    voter.setVotes(values)
+    return voter
+
+def countQueries(alias, fct, *args, **kwargs):
+    "Call fct and return the number of queries it has made on alias"
+    wrapper = connections[alias]
+    debug = wrapper.use_debug_cursor
+    wrapper.use_debug_cursor = True
+    del wrapper.queries[:]
+    try:
+        fct(*args, **kwargs)
+        return len(wrapper.queries)
+    finally:
+        wrapper.use_debug_cursor = debug
+
+def runThreads(target, number):
+    "Run target(idx) in number threads at once and wait for them"
+    def run(idx):
+        try:
+            target(idx)
+        finally:
+            connection.close()
+    threads = [threading.Thread(target=run, args=(idx,))
+               for idx in xrange(number)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+@override_settings(SINGLE_WRITER=True)
+class SingleWriterTest(TransactionTestCase):
+    def setUp(self):
+        self.poll = createPoll('writer')
+        self.writers = []
+
+    def addComment(self, idx):
+        self.writers.append(threading.current_thread().name)
+        return Comment.objects.create(poll_id=self.poll.pk,
+                                      author_name='voter %d' % idx, text='-')
+
+    def testConcurrentWrites(self):
+        runThreads(lambda idx:write(self.addComment, idx), 20)
+        self.assertEqual(set(self.writers), set(['papillon-writer']))
+        self.assertEqual(Comment.objects.filter(poll=self.poll).count(), 20)
+        self.assertEqual(Poll.objects.get(pk=self.poll.pk).comment_count, 20)
+
+    def testFailedWrite(self):
+        def fail():
+            self.addComment(0)
+            raise ValueError('failed')
+        # the error is raised in the calling thread and rolled back
+        self.assertRaises(ValueError, write, fail)
+        self.assertFalse(Comment.objects.filter(poll=self.poll).count())
+        # the writer goes on
+        comment = write(self.addComment, 1)
+        self.assertEqual(list(Comment.objects.filter(poll=self.poll)),
+                         [comment])
+
+@override_settings(REPLICA_DATABASE='replica', REPLICA_STICKY_TIME=30)
+class ReplicaTest(TransactionTestCase):
+    '''"replica" reads the test database of "default": the rows written by a
+    test are seen on both'''
+    def setUp(self):
+        self.poll = createPoll('replica')
+        self.choice = Choice.objects.create(poll=self.poll, name='choice',
+                                            order=0)
+        self.url = reverse('poll', kwargs={'poll_url':'replica'})
+
+    def tearDown(self):
+        resetState()
+
+    def testRouting(self):
+        readFromReplica('replica')
+        self.assertEqual(Poll.objects.all().db, 'replica')
+        self.assertEqual(Poll.objects.get(pk=self.poll.pk)._state.db,
+                         'replica')
+        # the writes are made on the primary database
+        comment = Comment.objects.create(poll=self.poll, author_name='a',
+                                         text='-')
+        self.assertEqual(comment._state.db, 'default')
+        resetState()
+        self.assertEqual(Poll.objects.all().db, 'default')
+
+    def testReadOnlyView(self):
+        self.assertTrue(countQueries('replica', self.client.get, self.url))
+        # other views read from the primary database
+        self.assertFalse(countQueries('replica', self.client.get,
+                reverse('edit', kwargs={'admin_url':self.poll.admin_url})))
+        self.assertFalse(PRIMARY_COOKIE in self.client.cookies)
+
+    def testStickiness(self):
+        response = self.client.post(reverse('vote',
+                                            kwargs={'poll_url':'replica'}),
+                          {'author_name':'voter',
+                           'choice_%d' % self.choice.pk:'on'})
+        self.assertEqual(self.poll.voter_set.count(), 1)
+        cookie = response.cookies[PRIMARY_COOKIE]
+        self.assertEqual(cookie['max-age'], 30)
+        # the voter reads its own ballot from the primary database
+        self.assertFalse(countQueries('replica', self.client.get, self.url))
+        # once the cookie has expired the replica is used again
+        del self.client.cookies[PRIMARY_COOKIE]
+        self.assertTrue(countQueries('replica', self.client.get, self.url))
+
+SHARDS = ('default', 'shard1', 'shard2')
+
+def urlOn(alias, prefix):
+    "A poll url stored on the shard alias"
+    idx = 0
+    while shardFor('%s%d' % (prefix, idx)) != alias:
+        idx += 1
+    return '%s%d' % (prefix, idx)
+
+@override_settings(SHARD_DATABASES=SHARDS, ALLOW_FRONTPAGE_POLL=True)
+class ShardTest(TransactionTestCase):
+    multi_db = True
+
+    def tearDown(self):
+        resetState()
+
+    def testRouting(self):
+        for alias in SHARDS:
+            url = urlOn(alias, 'routing')
+            poll = createPoll(url)
+            self.assertEqual(poll._state.db, alias)
+            resetState()
+            # found on its shard which is then used by the request
+            self.assertEqual(getPoll(base_url=url).pk, poll.pk)
+            choice = Choice.objects.create(poll=poll, name='choice', order=0)
+            self.assertEqual(choice._state.db, alias)
+            self.assertEqual(list(Choice.objects.filter(poll=poll)), [choice])
+            resetState()
+            for other in SHARDS:
+                self.assertEqual(Poll.objects.using(other).filter(
+                        base_url=url).count(), int(other == alias))
+
+    def testVote(self):
+        url = urlOn('shard2', 'vote')
+        poll = createPoll(url)
+        choice = Choice(poll=poll, name='choice', order=0)
+        choice.save(using='shard2')
+        self.client.post(reverse('vote', kwargs={'poll_url':url}),
+                         {'author_name':'voter', 'choice_%d' % choice.pk:'on'})
+        self.assertEqual(Voter.objects.using('shard2').filter(poll=poll
+                                                              ).count(), 1)
+        self.assertFalse(Voter.objects.using('default').count())
+
+    def testScatterGather(self):
+        names = []
+        for idx, alias in enumerate(SHARDS):
+            names.append('Listed poll %d' % idx)
+            createPoll(urlOn(alias, 'listed'), public=True, name=names[-1])
+        content = self.client.get(reverse('index')).content
+        for name in names:
+            self.assertTrue(name in content)
+
+    def testRebalance(self):
+        url = urlOn('shard1', 'moved')
+        # stored on the default database before shard1 was added
+        poll = Poll(base_url=url, admin_url=url + '_admin',
+                    author_name='author', name='Poll', description='Poll',
+                    type='P')
+        poll.save(using='default')
+        choice = Choice(poll=poll, name='choice', order=0)
+        choice.save(using='default')
+        Comment(poll=poll, author_name='commenter', text='-').save(
+                                                            using='default')
+        self.assertEqual(getPoll(base_url=url).pk, poll.pk)
+        resetState()
+        with open(os.devnull, 'w') as output:
+            call_command('rebalance_shards', stdout=output)
+        self.assertFalse(Poll.objects.using('default').filter(base_url=url
+                                                              ).count())
+        moved = Poll.objects.using('shard1').get(base_url=url)
+        self.assertEqual(moved.comment_count, 1)
+        self.assertEqual(list(Choice.objects.using('shard1').filter(
+                poll=moved).values_list('name', flat=True)), ['choice'])
+        self.assertFalse(Choice.objects.using('default').count())
+        self.assertFalse(Comment.objects.using('default').count())
+        # found on its shard
+        self.assertEqual(getPoll(base_url=url)._state.db, 'shard1')
+
+class CategoryFieldTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def testNewCategory(self):
+        self.assertFalse('category' in CreatePollForm().fields)
+        self.assertFalse('category' in AdminPollForm().fields)
+        # seen without a restart
+        Category.objects.create(name='category', description='-')
+        self.assertTrue('category' in CreatePollForm().fields)
+        self.assertTrue('category' in AdminPollForm().fields)
+        Category.objects.all().delete()
+        self.assertFalse('category' in CreatePollForm().fields)
+
+class CountingEmailBackend(EmailBackend):
+    "In memory mails counting the connections to the mail server"
+    opened = 0
+
+    def open(self):
+        CountingEmailBackend.opened += 1
+        return super(CountingEmailBackend, self).open()
+
+@override_settings(NOTIFICATIONS_BATCH_SIZE=2,
+                   EMAIL_BACKEND='papillon.polls.tests.CountingEmailBackend')
+class NotificationTest(TestCase):
+    def setUp(self):
+        CountingEmailBackend.opened = 0
+        self.polls = []
+        for idx, email in enumerate(('a@example.org', 'b@example.org',
+                                     'c@example.org', 'a@example.org', '')):
+            author = PollUser.objects.create(name='author', email=email)
+            poll = createPoll('notified%d' % idx, author=author,
+                              name='Poll %d' % idx)
+            Choice.objects.create(poll=poll, name='choice', order=0)
+            self.polls.append(poll)
+
+    def vote(self, poll, name):
+        choice = Choice.objects.get(poll=poll)
+        self.client.post(reverse('vote', kwargs={'poll_url':poll.base_url}),
+                         {'author_name':name, 'choice_%d' % choice.pk:'on'})
+
+    def comment(self, poll, name):
+        self.client.post(reverse('vote', kwargs={'poll_url':poll.base_url}),
+                         {'comment_author':name, 'comment':'-'})
+
+    def sendNotifications(self):
+        with open(os.devnull, 'w') as output:
+            call_command('send_notifications', stdout=output)
+
+    def testQueue(self):
+        self.vote(self.polls[0], 'voter')
+        self.comment(self.polls[0], 'commenter')
+        # sent later
+        self.assertFalse(mail.outbox)
+        self.assertEqual(sorted(Notification.objects.filter(
+                poll=self.polls[0]).values_list('kind', 'name')),
+                [('C', 'commenter'), ('V', 'voter')])
+        # without author nobody is notified
+        poll = createPoll('anonymous')
+        self.comment(poll, 'commenter')
+        self.assertFalse(Notification.objects.filter(poll=poll).count())
+
+    def testDigests(self):
+        for poll in self.polls:
+            self.vote(poll, 'voter of %s' % poll.name)
+        self.comment(self.polls[3], 'commenter')
+        self.sendNotifications()
+        # one digest by author, by batches of 2 authors on one connection
+        self.assertEqual(CountingEmailBackend.opened, 1)
+        self.assertEqual(sorted([message.to for message in mail.outbox]),
+                         [['a@example.org'], ['b@example.org'],
+                          ['c@example.org']])
+        digest = [message for message in mail.outbox
+                  if message.to == ['a@example.org']][0]
+        for text in ('Poll 0', 'voter of Poll 0', 'Poll 3', 'voter of Poll 3',
+                     'commenter', reverse('poll', args=['notified3'])):
+            self.assertTrue(text in digest.body)
+        self.assertFalse('Poll 1' in digest.body)
+        # sent once, the ones without e-mail are dropped
+        self.assertFalse(Notification.objects.count())
+        self.sendNotifications()
+        self.assertEqual(len(mail.outbox), 3)
+
+class Receiver(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Webhook endpoint answering with the status of its server after its delay"
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with server.lock:
+            server.requests.append((time.time(), self.client_address[1],
+                                    dict(self.headers), body))
+            server.running += 1
+            server.max_running = max(server.running, server.max_running)
+        time.sleep(server.delay)
+        with server.lock:
+            server.running -= 1
+        self.send_response(server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+class ReceiverServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    "Local HTTP server standing for the receivers of the webhooks"
+    daemon_threads = True
+
+    def __init__(self, status=200, delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Receiver)
+        self.status, self.delay = status, delay
+        self.lock = threading.Lock()
+        self.requests, self.running, self.max_running = [], 0, 0
+        self.url = 'http://127.0.0.1:%d/hook' % self.server_port
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+@override_settings(WEBHOOKS_THREADS=6, WEBHOOKS_ENDPOINT_CONCURRENCY=2,
+                   WEBHOOKS_TIMEOUT=5, WEBHOOKS_RETRY_DELAY=30,
+                   WEBHOOKS_MAX_ATTEMPTS=3, WEBHOOKS_LEASE=600,
+                   WEBHOOKS_ALLOWED_HOSTS=('127.0.0.1',))
+class WebhookTest(TransactionTestCase):
+    def setUp(self):
+        self.poll = createPoll('hooked')
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def subscribe(self, events, **options):
+        "Start a receiver and queue events for it"
+        server = ReceiverServer(**options)
+        self.servers.append(server)
+        webhook = Webhook.objects.create(poll=self.poll, url=server.url)
+        for idx in xrange(events):
+            queueWebhookEvents(Webhook.objects.filter(pk=webhook.pk), 'vote',
+                               voter='voter %d' % idx)
+        return server, webhook
+
+    def deliver(self):
+        with open(os.devnull, 'w') as output:
+            call_command('deliver_webhooks', stdout=output)
+
+    def testDelivery(self):
+        server, webhook = self.subscribe(3)
+        self.deliver()
+        self.assertFalse(WebhookEvent.objects.count())
+        self.assertEqual(len(server.requests), 3)
+        voters = set()
+        for date, port, headers, body in server.requests:
+            self.assertEqual(headers['x-papillon-event'], 'vote')
+            self.assertTrue(abs(int(headers['x-papillon-timestamp'])
+                                - time.time()) < 60)
+            self.assertEqual(headers['x-papillon-signature'],
+                    sign(webhook.secret, headers['x-papillon-timestamp'],
+                         body))
+            voters.add(json.loads(body)['voter'])
+        self.assertEqual(voters, set(['voter 0', 'voter 1', 'voter 2']))
+        # the connections are kept open between the events
+        self.assertTrue(len(set([request[1] for request in server.requests]))
+                        <= 2)
+
+    def testRetries(self):
+        server, webhook = self.subscribe(1, status=500)
+        for attempts, delay in ((1, 30), (2, 60)):
+            self.deliver()
+            event = WebhookEvent.objects.get()
+            self.assertEqual(event.attempts, attempts)
+            # doubled at each failure
+            wait = event.next_attempt - datetime.datetime.now()
+            self.assertTrue(delay - 5 < wait.days * 86400 + wait.seconds
+                            <= delay)
+            # not due yet
+            self.deliver()
+            self.assertEqual(len(server.requests), attempts)
+            WebhookEvent.objects.update(
+                                    next_attempt=datetime.datetime.now())
+        # abandoned after WEBHOOKS_MAX_ATTEMPTS
+        self.deliver()
+        self.assertEqual(len(server.requests), 3)
+        self.assertFalse(WebhookEvent.objects.count())
+
+    def testEndpointConcurrency(self):
+        slow = self.subscribe(6, delay=0.5)[0]
+        fast = self.subscribe(4)[0]
+        self.deliver()
+        self.assertFalse(WebhookEvent.objects.count())
+        self.assertEqual(len(slow.requests), 6)
+        self.assertEqual(slow.max_running, 2)
+        # the fast endpoint doesn't wait for the slow one
+        self.assertEqual(len(fast.requests), 4)
+        self.assertTrue(max([request[0] for request in fast.requests])
+                        < sorted([request[0] for request in slow.requests])[2])
+
+    def testLocalAddresses(self):
+        server = self.subscribe(1)[0]
+        # refused on a local address: tried again later
+        for host in ('127.0.0.1', 'localhost'):
+            Webhook.objects.update(url=server.url.replace('127.0.0.1', host))
+            with self.settings(WEBHOOKS_ALLOWED_HOSTS=()):
+                self.deliver()
+            self.assertFalse(server.requests)
+            WebhookEvent.objects.update(next_attempt=datetime.datetime.now())
+        # allowed host
+        with self.settings(WEBHOOKS_ALLOWED_HOSTS=('LocalHost',)):
+            self.deliver()
+        self.assertEqual(len(server.requests), 1)
+        self.assertFalse(WebhookEvent.objects.count())
+
+    def testAddresses(self):
+        for address in ('93.184.216.34', '2606:2800:220:1::248',
+                        '::ffff:93.184.216.34'):
+            self.assertTrue(isPublicAddress(address))
+        for address in ('127.0.0.1', '10.1.2.3', '172.31.0.1', '192.168.0.1',
+                        '169.254.169.254', '100.64.0.1', '0.0.0.0',
+                        '255.255.255.255', '224.0.0.1', '::1', '::',
+                        'fe80::1%eth0', 'fd00::1', 'ff02::1',
+                        '::ffff:127.0.0.1', 'localhost'):
+            self.assertFalse(isPublicAddress(address))
+
+    def testForm(self):
+        for url in ('http://example.com/hook', 'https://93.184.216.34/',
+                    'http://127.0.0.1:8000/hook', ''):
+            self.assertTrue(WebhookForm({'url':url}).is_valid())
+        for url in ('ftp://example.com/hook', 'http://10.0.0.1/hook',
+                    'http://169.254.169.254/latest/'):
+            self.assertFalse(WebhookForm({'url':url}).is_valid())
+
+    def testLease(self):
+        self.subscribe(3)
+        self.assertEqual(len(claimDueEvents(None, 10, [])), 3)
+        # claimed: another worker doesn't get them before the end of the lease
+        self.assertFalse(claimDueEvents(None, 10, []))
+        for event in WebhookEvent.objects.all():
+            self.assertTrue(event.next_attempt > datetime.datetime.now()
+                            + datetime.timedelta(seconds=590))
+
+@override_settings(DUPLICATE_BALLOTS=('name', 'client'))
+class DuplicateBallotTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.poll = createPoll('duplicates')
+        self.choice = Choice.objects.create(poll=self.poll, name='choice',
+                                            order=0)
+
+    def vote(self, name, browser, **values):
+        values.update({'author_name':name,
+                       'choice_%d' % self.choice.pk:'on'})
+        return self.client.post(reverse('vote',
+                                        kwargs={'poll_url':'duplicates'}),
+                                values, HTTP_USER_AGENT=browser)
+
+    def testDuplicates(self):
+        self.vote(u'Jos\xe9', 'browser')
+        self.assertEqual(self.poll.voter_set.count(), 1)
+        # same name from another browser: refused
+        response = self.vote(u'jose', 'other browser')
+        self.assertEqual(self.poll.voter_set.count(), 1)
+        self.assertFalse('confirm_vote' in response.content)
+        # same browser - maybe another voter behind the same address: to be
+        # confirmed
+        response = self.vote('Other', 'browser')
+        self.assertEqual(self.poll.voter_set.count(), 1)
+        self.assertTrue('confirm_vote' in response.content)
+        self.vote('Other', 'browser', confirm_vote='1')
+        self.assertEqual(self.poll.voter_set.count(), 2)
+
+class ImportTest(TestCase):
+    def testDates(self):
+        old = datetime.datetime(2012, 3, 4, 5, 6, 7)
+        poll = createPoll('exported')
+        choice = Choice.objects.create(poll=poll, name='choice', order=0)
+        self.client.post(reverse('vote', kwargs={'poll_url':'exported'}),
+                         {'author_name':'voter', 'choice_%d' % choice.pk:'on',
+                          'comment_author':'commenter', 'comment':'-'})
+        Poll.objects.update(creation_date=old, modification_date=old)
+        Voter.objects.update(creation_date=old, modification_date=old)
+        PollUser.objects.update(modification_date=old)
+        Comment.objects.update(date=old)
+        BallotEvent.objects.update(date=old)
+        with tempfile.NamedTemporaryFile() as export:
+            with open(os.devnull, 'w') as output:
+                call_command('export_polls', output=export.name,
+                             stderr=output)
+                call_command('import_polls', export.name, stdout=output)
+        imported = Poll.objects.exclude(pk=poll.pk).get()
+        self.assertEqual((imported.creation_date, imported.modification_date),
+                         (old, old))
+        voter = Voter.objects.get(poll=imported)
+        self.assertEqual((voter.creation_date, voter.modification_date,
+                          voter.user.modification_date), (old, old, old))
+        self.assertEqual(Comment.objects.get(poll=imported).date, old)
+        self.assertEqual(BallotEvent.objects.get(poll=imported).date, old)
+        # the dates of the other saves are still automatic
+        poll.save()
+        self.assertTrue(Poll.objects.get(pk=poll.pk).modification_date > old)
+
+class PackedBallotTest(TestCase):
+    def testPacking(self):
+        values = {0:1, 2:-1, 3:9, 5:0}
+        ballot = packValues(values)
+        self.assertEqual(ballot, 'C.AK.B')
+        self.assertEqual(unpackBallot(ballot), [1, None, -1, 9, None, 0])
+        self.assertEqual(packValues(dict([(index, value) for index, value
+                                in enumerate(unpackBallot(ballot))])), ballot)
+        self.assertEqual(packValues({}), '')
+        self.assertEqual(unpackBallot(''), [])
+        self.assertRaises(ValueError, packValue, 10)
+
+    def testSums(self):
+        # the short ballots have no answer for the last choices
+        self.assertEqual(sumBallots(['C', 'CAK', '', '.CC.C'], [0, 1, 2, 3, 4]),
+                         [2, 0, 10, 0, 1])
+        # order of the choices
+        self.assertEqual(sumBallots(['CAK'], [2, 0]), [9, 1])
+        self.assertEqual(sumBallots(['CAK'], []), [])
+        self.assertEqual(sumBallots([], [0, 1]), [0, 0])
+
+    def checkStorages(self, poll_type):
+        poll = createPoll('packed' + poll_type, type=poll_type)
+        choices = addChoices(poll, 3)
+        values = {choices[0]:1, choices[2]:-1}
+        with self.settings(PACKED_BALLOTS=False):
+            rows = addVoter(poll, 'rows', values)
+        with self.settings(PACKED_BALLOTS=True):
+            packed = addVoter(poll, 'packed', values)
+        self.assertEqual(rows.ballot, None)
+        self.assertEqual(packed.ballot, 'C.A')
+        self.assertEqual(rows.getBallot(), packed.getBallot())
+        absent_value = poll.getAbsentValue()
+        expected = [1, absent_value, -1]
+        for voter in (rows, packed):
+            voter = Voter.objects.get(pk=voter.pk)
+            self.assertEqual([vote.value for vote in voter.getVotes(choices,
+                              absent_value)], expected)
+        self.assertEqual(poll.getSums(choices), [2, 0, -2])
+        # a modification keeps the storage of the voter
+        for voter in (rows, packed):
+            voter.setVotes({choices[1]:1})
+        self.assertEqual(rows.ballot, None)
+        self.assertEqual(Vote.objects.filter(voter=packed).count(), 0)
+        self.assertEqual(poll.getSums(choices), [0, 2, 0])
+        # a new choice is after the end of the packed ballots
+        choices += addChoices(poll, 1)
+        for voter in (rows, packed):
+            self.assertEqual([vote.value for vote in voter.getVotes(choices,
+                  absent_value)], [absent_value, 1, absent_value, absent_value])
+        self.assertEqual(poll.getSums(choices), [0, 2, 0, 0])
+
+    def testStorages(self):
+        for poll_type in ('P', 'B'):
+            self.checkStorages(poll_type)
+
+    def testPackCommand(self):
+        poll = createPoll('converted', type='B')
+        choices = addChoices(poll, 4)
+        with self.settings(PACKED_BALLOTS=False):
+            for idx in xrange(5):
+                addVoter(poll, 'voter %d' % idx, dict([(choice,
+                         (idx + jdx) % 3 - 1) for jdx, choice in
+                         enumerate(choices) if (idx + jdx) % 4]))
+        sums = poll.getSums(choices)
+        votes = [[vote.value for vote in voter.getVotes(choices)]
+                 for voter in Voter.objects.filter(poll=poll).order_by('id')]
+        with open(os.devnull, 'w') as output:
+            call_command('pack_ballots', stdout=output)
+        self.assertFalse(Vote.objects.count())
+        self.assertFalse(Voter.objects.filter(ballot__isnull=True).count())
+        self.assertEqual(poll.getSums(choices), sums)
+        self.assertEqual([[vote.value for vote in voter.getVotes(choices)]
+                 for voter in Voter.objects.filter(poll=poll).order_by('id')],
+                 votes)
+        # and back
+        with open(os.devnull, 'w') as output:
+            call_command('pack_ballots', unpack=True, stdout=output)
+        self.assertFalse(Voter.objects.filter(ballot__isnull=False).count())
+        self.assertEqual(poll.getSums(choices), sums)
+
+class AbsentVoteTest(TestCase):
+    def checkVote(self, poll_type, values, rows):
+        "Vote with the posted values by choice index"
+        poll = createPoll('absent' + poll_type, type=poll_type)
+        choices = addChoices(poll, 3)
+        posted = {'author_name':'voter'}
+        for idx, value in values.items():
+            posted['choice_%d' % choices[idx].pk] = value
+        url = reverse('vote', kwargs={'poll_url':poll.base_url})
+        with self.settings(PACKED_BALLOTS=False):
+            self.client.post(url, posted)
+        # only the explicit answers are stored
+        self.assertEqual(sorted(Vote.objects.filter(choice__poll=poll
+                          ).values_list('choice__order', 'value')), rows)
+        absent_value = poll.getAbsentValue()
+        votes = Voter.objects.get(poll=poll).getVotes(choices, absent_value)
+        expected = [int(values[idx]) if idx in values else absent_value
+                    for idx in xrange(3)]
+        self.assertEqual([vote.value for vote in votes], expected)
+        self.assertEqual(poll.getSums(choices),
+                         [value or 0 for value in expected])
+        # displayed as the absent value
+        with translation.override(settings.LANGUAGE_CODE):
+            cells = CellRenderer(poll).render([Vote(value=value)
+                                               for value in expected])
+        self.assertTrue(cells in self.client.get(url).content.decode('utf-8'))
+
+    def testYesNo(self):
+        # no: not stored
+        self.checkVote('P', {0:'1'}, [(0, 1)])
+
+    def testYesNoMaybe(self):
+        # maybe is an explicit answer, the third choice has no answer
+        self.checkVote('B', {0:'1', 1:'0'}, [(0, 1), (1, 0)])
+
+@override_settings(MAX_COMMENT_NB=3)
+class CommentCountTest(TestCase):
+    def comment(self, poll, text):
+        self.client.post(reverse('vote', kwargs={'poll_url':poll.base_url}),
+                         {'author_name':'', 'comment_author':'commenter',
+                          'comment':text})
+
+    def getCount(self, poll):
+        return Poll.objects.get(pk=poll.pk).comment_count
+
+    def testCount(self):
+        poll, other = createPoll('commented'), createPoll('other')
+        addChoices(poll, 1)
+        for idx in xrange(2):
+            self.comment(poll, 'comment %d' % idx)
+        Comment.objects.create(poll=other, author_name='commenter', text='-')
+        self.assertEqual(self.getCount(poll), 2)
+        self.assertEqual(self.getCount(other), 1)
+        Comment.objects.filter(poll=poll)[0].delete()
+        self.assertEqual(self.getCount(poll), 1)
+        # the count limits the number of comments
+        for idx in xrange(2, 6):
+            self.comment(poll, 'comment %d' % idx)
+        self.assertEqual(Comment.objects.filter(poll=poll).count(), 3)
+        self.assertEqual(self.getCount(poll), 3)
+        # the imported comments are counted
+        with tempfile.NamedTemporaryFile() as export:
+            with open(os.devnull, 'w') as output:
+                call_command('export_polls', output=export.name,
+                             stderr=output)
+                call_command('import_polls', export.name, stdout=output)
+        self.assertEqual(sorted(Poll.objects.exclude(pk__in=(poll.pk, other.pk)
+                                ).values_list('comment_count', flat=True)),
+                         [1, 3])
+
+class TallyTest(TestCase):
+    def setUp(self):
+        self.poll = createPoll('tallied', type='B')
+        self.choices = addChoices(self.poll, 3)
+        self.url = reverse('vote', kwargs={'poll_url':'tallied'})
+
+    def vote(self, name, values, voter=None):
+        "Post a vote with values by choice index - deleted without name"
+        posted = {'author_name':name}
+        if voter:
+            posted['voter'] = voter.pk
+        for idx, value in values.items():
+            posted['choice_%d' % self.choices[idx].pk] = value
+        self.client.post(self.url, posted)
+
+    def checkTally(self, date=None, sums=None):
+        "The replayed tally is the sum of the current votes"
+        if sums is None:
+            sums = self.poll.getSums(self.choices)
+        self.assertEqual(getTally(self.poll, self.choices, date), sums)
+        output = StringIO.StringIO()
+        options = {'date':date.strftime('%Y-%m-%d %H:%M:%S')} if date else {}
+        call_command('poll_results', 'tallied', stdout=output, **options)
+        self.assertEqual(output.getvalue(), ''.join(['%s: %d\n' % (
+                choice.name, sum / 2) for choice, sum in zip(self.choices,
+                                                             sums)]))
+
+    def snapshot(self):
+        with open(os.devnull, 'w') as output:
+            call_command('snapshot_tallies', events=1, stdout=output)
+
+    def testReplay(self):
+        with self.settings(PACKED_BALLOTS=True):
+            self.vote('packed', {0:'1', 1:'-1', 2:'0'})
+        self.vote('rows', {0:'1', 2:'-1'})
+        self.vote('deleted', {1:'1', 2:'1'})
+        self.checkTally()
+        voters = dict([(voter.user.name, voter) for voter in
+                       Voter.objects.filter(poll=self.poll)])
+        with self.settings(PACKED_BALLOTS=True):
+            self.vote('packed', {0:'-1', 2:'1'}, voters['packed'])
+        self.vote('rows', {1:'1'}, voters['rows'])
+        self.vote('', {}, voters['deleted'])
+        self.checkTally()
+        self.choices.pop(1).delete()
+        self.checkTally()
+        # results at a past date
+        past = datetime.datetime(2012, 3, 4, 5, 6, 7)
+        BallotEvent.objects.update(date=past)
+        past_sums = self.poll.getSums(self.choices)
+        self.snapshot()
+        self.assertEqual(TallySnapshot.objects.count(), 1)
+        self.checkTally()
+        # new votes after the snapshot, on a new choice too
+        self.choices.append(Choice.objects.create(poll=self.poll,
+                                                  name='new', order=3))
+        self.vote('new', {0:'1', 2:'-1'})
+        with self.settings(PACKED_BALLOTS=True):
+            self.vote('packed', {2:'1'}, voters['packed'])
+        self.checkTally()
+        # the new choice had no vote
+        past_sums.append(0)
+        for date in (past, past + datetime.timedelta(seconds=1)):
+            self.checkTally(date, past_sums)
+        self.checkTally(past - datetime.timedelta(seconds=1), [0, 0, 0])
+        # without snapshot
+        TallySnapshot.objects.all().delete()
+        self.checkTally(past, past_sums)
+        self.checkTally()
+        # only the polls with new events are snapshotted
+        self.snapshot()
+        self.snapshot()
+        self.assertEqual(TallySnapshot.objects.count(), 1)
+        self.checkTally()
+
+class CreateApiTest(TestCase):
+    def create(self, data):
+        return self.client.post(reverse('create_api'),
+                                data if isinstance(data, str)
+                                else json.dumps(data),
+                                content_type='application/json')
+
+    def getErrors(self, response):
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return json.loads(response.content)['errors']
+
+    def testCreation(self):
+        response = self.create({'author_name':'author', 'name':'API',
+                                'description':'poll', 'type':'B',
+                                'author_email':'author@example.com',
+                                'choices':['one', {'name':'two', 'limit':2},
+                                           'three']})
+        self.assertEqual(response.status_code, 201)
+        urls = json.loads(response.content)
+        poll = Poll.objects.get(name='API')
+        self.assertTrue(urls['base_url'].startswith('http://'))
+        self.assertTrue(urls['base_url'].endswith(
+                                 reverse('poll', args=[poll.base_url])))
+        self.assertTrue(urls['admin_url'].endswith(
+                                 reverse('edit', args=[poll.admin_url])))
+        self.assertEqual(poll.author.email, 'author@example.com')
+        self.assertEqual([(choice.name, choice.limit, choice.order,
+                           choice.ballot_index) for choice in
+                          Choice.objects.filter(poll=poll)],
+                         [('one', None, 0, 0), ('two', 2, 1, 1),
+                          ('three', None, 2, 2)])
+        # the next choice gets the next ballot index
+        self.assertEqual(Choice.objects.create(poll=poll, name='four',
+                                               order=3).ballot_index, 3)
+
+    def testDatedChoices(self):
+        response = self.create({'author_name':'author', 'name':'dates',
+                                'description':'poll', 'type':'P',
+                                'dated_choices':True,
+                                'choices':['2013-05-02 10:00', '2013-05-01']})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(list(Choice.objects.values_list('name', 'order',
+                                                         'ballot_index')),
+                         [('2013-05-01 00:00:00', 0, 0),
+                          ('2013-05-02 10:00:00', 1, 1)])
+        self.assertTrue('choices' in self.getErrors(self.create({
+                        'author_name':'author', 'name':'dates',
+                        'description':'poll', 'type':'P',
+                        'dated_choices':True, 'choices':['tomorrow']})))
+
+    def testErrors(self):
+        poll = {'author_name':'author', 'name':'API', 'description':'poll',
+                'type':'P', 'choices':['one']}
+        errors = self.getErrors(self.create(dict(poll, type='X',
+                                                 author_name='')))
+        self.assertEqual(sorted(errors.keys()), ['author_name', 'type'])
+        for choices in (None, [], ['one', {'name':'two', 'limit':0}], [''],
+                        ['choice'] * (settings.API_MAX_CHOICES + 1)):
+            self.assertEqual(self.getErrors(self.create(dict(poll,
+                                        choices=choices))).keys(), ['choices'])
+        for body in ('{"name":', '["one"]', '', '"poll"'):
+            self.assertEqual(self.getErrors(self.create(body)).keys(),
+                             ['__all__'])
+        self.assertFalse(Poll.objects.count())
+        self.assertFalse(Choice.objects.count())
+
+    def testMethod(self):
+        response = self.client.get(reverse('create_api'))
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(response['Allow'], 'POST')
+
+@override_settings(OVERLOAD_REQUESTS=50, OVERLOAD_LATENCY=None,
+                   OVERLOAD_RETRY=30)
+class OverloadTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        load.degraded_until, load.latency = 0, 0.
+        self.poll = createPoll('loaded', name='Loaded poll')
+        self.choice = addChoices(self.poll, 1)[0]
+        self.urls = [reverse(name, kwargs={'poll_url':'loaded'})
+                     for name in ('poll', 'vote')]
+
+    def tearDown(self):
+        load.degraded_until, load.latency = 0, 0.
+
+    def testDegraded(self):
+        # rendering kept for the overloads
+        response = self.client.get(self.urls[0])
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse("class='alert'" in response.content)
+        load.degraded_until = time.time() + 30
+        for url in self.urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue('Loaded poll' in response.content)
+            self.assertTrue("class='alert'" in response.content)
+            self.assertEqual(load.requests, 0)
+        # not read from the database
+        self.assertEqual(countQueries('default', self.client.get,
+                                      self.urls[0]), 0)
+        for url in self.urls:
+            response = self.client.post(url, {'author_name':'voter',
+                                    'choice_%d' % self.choice.pk:'on'})
+            self.assertEqual(response.status_code, 503)
+            self.assertTrue(0 < int(response['Retry-After']) <= 31)
+            self.assertEqual(load.requests, 0)
+        self.assertFalse(Voter.objects.count())
+        # no kept rendering
+        response = self.client.get(reverse('poll',
+                                           kwargs={'poll_url':'unknown'}))
+        self.assertEqual(response.status_code, 503)
+        # back to normal
+        load.degraded_until = 0
+        self.client.post(self.urls[1], {'author_name':'voter',
+                                        'choice_%d' % self.choice.pk:'on'})
+        self.assertEqual(Voter.objects.count(), 1)
+        self.assertEqual(load.requests, 0)
+
+    def testLatency(self):
+        with self.settings(OVERLOAD_LATENCY=2):
+            load.latency = 3.
+            response = self.client.post(self.urls[1])
+            self.assertEqual(response.status_code, 503)
+            # measured again after OVERLOAD_RETRY seconds
+            self.assertEqual(load.latency, 0.)
+            self.assertTrue(load.degraded_until > time.time() + 25)
+        self.assertEqual(load.requests, 0)
+
+@override_settings(TASKS_THREADS=0, TASKS_RETRY_DELAY=30, TASKS_MAX_ATTEMPTS=3,
+                   TASKS_LEASE=600, TASKS_CLEANING_CHUNK=2)
+class TaskTest(TransactionTestCase):
+    def setUp(self):
+        self.runner = TaskRunner(2)
+        self.attempts = 0
+        TASKS['failing'] = self.failing
+
+    def tearDown(self):
+        self.runner.close()
+        del TASKS['failing']
+
+    def failing(self, failures):
+        "Task failing failures times"
+        self.attempts += 1
+        if self.attempts <= failures:
+            raise ValueError('failure %d' % self.attempts)
+
+    def runTasks(self):
+        with open(os.devnull, 'w') as output:
+            call_command('run_tasks', stdout=output)
+
+    def testTransaction(self):
+        def modify():
+            queueTask('saveAvailability', 1)
+            raise ValueError
+        self.assertRaises(ValueError, write, modify)
+        self.assertFalse(Task.objects.count())
+        write(queueTask, 'saveAvailability', 1)
+        # queued once
+        self.assertFalse(write(queueTask, 'saveAvailability', 1))
+        self.assertEqual(Task.objects.get().key, 'saveAvailability:1')
+
+    def testClaims(self):
+        for poll_id in (1, 2):
+            queueTask('saveAvailability', poll_id)
+        tasks = claimDueTasks(None)
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(sorted(Task.objects.values_list('key', flat=True)),
+                         ['saveAvailability:1@%d' % tasks[0].pk,
+                          'saveAvailability:2@%d' % tasks[1].pk])
+        # leased: not claimed by another runner
+        self.assertFalse(claimDueTasks(None))
+        # the same work can be queued while the task is executed
+        self.assertTrue(queueTask('saveAvailability', 1))
+        self.assertEqual([task.key for task in claimDueTasks(None)],
+                         ['saveAvailability:1'])
+        # end of the lease of a stopped runner
+        Task.objects.filter(pk=tasks[0].pk).update(
+                  next_attempt=datetime.datetime.now())
+        self.assertEqual([task.key for task in claimDueTasks(None)],
+                         ['saveAvailability:1@%d' % tasks[0].pk])
+
+    def runFailing(self):
+        "Run the due tasks without the traces of the failures"
+        stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')
+        try:
+            return runDueTasks(self.runner, None)
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+
+    def testRetries(self):
+        queueTask('failing', 1)
+        self.assertEqual(self.runFailing(), (0, 1))
+        task = Task.objects.get()
+        self.assertEqual(task.attempts, 1)
+        wait = task.next_attempt - datetime.datetime.now()
+        self.assertTrue(25 < wait.seconds <= 30)
+        # not due yet
+        self.assertEqual(self.runFailing(), (0, 0))
+        Task.objects.update(next_attempt=datetime.datetime.now())
+        self.assertEqual(self.runFailing(), (1, 0))
+        self.assertFalse(Task.objects.count())
+        # abandoned after TASKS_MAX_ATTEMPTS
+        self.attempts = 0
+        queueTask('failing', 5)
+        for attempt in xrange(3):
+            Task.objects.update(next_attempt=datetime.datetime.now())
+            self.assertEqual(self.runFailing(), (0, 1))
+        self.assertFalse(Task.objects.count())
+        self.assertEqual(self.runner.getStats()['failed'], 4)
+
+    def testAvailability(self):
+        for poll_type in ('P', 'B'):
+            poll = createPoll('limited' + poll_type, type=poll_type)
+            choices = addChoices(poll, 3)
+            for choice, limit in zip(choices, (1, 2, None)):
+                choice.limit = limit
+                choice.save()
+            url = reverse('vote', kwargs={'poll_url':poll.base_url})
+            for idx in xrange(2):
+                self.client.post(url, {'author_name':'voter %d' % idx,
+                                  'choice_%d' % choices[0].pk:'1',
+                                  'choice_%d' % choices[2].pk:'1'})
+            self.assertEqual(Task.objects.filter(name='saveAvailability'
+                                                 ).count(), 1)
+            self.runTasks()
+            # as the former inline computation of the poll page
+            sums = poll.getSums(choices)
+            if poll_type == 'B':
+                sums = [sum / 2 for sum in sums]
+            available = [choice.available for choice in
+                         Choice.objects.filter(poll=poll)]
+            self.assertEqual(available, [not choice.limit
+                                         or sum < choice.limit
+                                         for choice, sum in zip(choices, sums)])
+            self.assertEqual(available, [False, True, True])
+        self.assertFalse(Task.objects.exclude(name='cleanPolls').count())
+
+    def testCleaning(self):
+        now = datetime.datetime.now()
+        old = now - datetime.timedelta(days=settings.DAYS_TO_LIVE + 1)
+        kept, erased = [], []
+        for idx, (poll_date, voter_date) in enumerate(((old, None),
+                (old, old), (old, now), (None, None), (old, None),
+                (old, old))):
+            poll = createPoll('old%d' % idx)
+            if voter_date:
+                voter = addVoter(poll, 'voter', {})
+                Voter.objects.filter(pk=voter.pk).update(
+                                  modification_date=voter_date)
+                Comment.objects.create(poll=poll, author_name='voter',
+                                       text='-')
+            if poll_date:
+                Poll.objects.filter(pk=poll.pk).update(
+                                  modification_date=poll_date)
+            # the former cleaning script kept the polls modified or voted
+            # recently
+            if not poll_date or voter_date == now:
+                kept.append(poll.pk)
+            else:
+                erased.append(poll.pk)
+        self.runTasks()
+        self.assertEqual(sorted(Poll.objects.values_list('pk', flat=True)),
+                         kept)
+        self.assertFalse(Voter.objects.filter(poll__in=erased).count())
+        self.assertFalse(Comment.objects.filter(poll__in=erased).count())
+        # the cleaning by chunks is over: the next one is queued
+        task = Task.objects.get()
+        self.assertEqual((task.key, task.args), ('cleanPolls', '[]'))
+        self.assertTrue(task.next_attempt > datetime.datetime.now()
+                + datetime.timedelta(seconds=settings.TASKS_CLEANING_INTERVAL
+                                     - 60))
+
+class StatsTest(TestCase):
+    def setUp(self):
+        self.day = datetime.date.today() - datetime.timedelta(days=1)
+        self.category = Category.objects.create(name='category',
+                                                description='category')
+
+    def at(self, day, hour=12):
+        return datetime.datetime.combine(day, datetime.time(hour))
+
+    def addPoll(self, base_url, day, category=None):
+        poll = createPoll(base_url, category=category)
+        Poll.objects.filter(pk=poll.pk).update(creation_date=self.at(day))
+        addChoices(poll, 1)
+        return poll
+
+    def addActivity(self, poll, day, votes=0, modified=0, comments=0):
+        "New and modified votes and comments on poll during day"
+        for idx in xrange(votes):
+            voter = addVoter(poll, 'voter %d' % idx, {})
+            if idx < modified:
+                voter.setVotes({})
+        BallotEvent.objects.filter(poll=poll, date__gt=self.at(day, 23)
+                                   ).update(date=self.at(day))
+        for idx in xrange(comments):
+            Comment.objects.create(poll=poll, author_name='commenter',
+                                   text='-')
+        Comment.objects.filter(poll=poll, date__gt=self.at(day, 23)
+                               ).update(date=self.at(day))
+
+    def rollup(self, **options):
+        with open(os.devnull, 'w') as output:
+            call_command('rollup_stats', stdout=output, **options)
+
+    def getStats(self):
+        return sorted([(stats.day, stats.category_id, stats.polls, stats.votes,
+                        stats.active_polls, stats.comments)
+                       for stats in DailyStats.objects.all()])
+
+    def testRollup(self):
+        before = self.day - datetime.timedelta(days=2)
+        old = self.addPoll('old', before, self.category)
+        categorized = self.addPoll('categorized', self.day, self.category)
+        self.addPoll('empty', self.day, self.category)
+        other = self.addPoll('other', self.day)
+        self.addActivity(old, before, votes=1)
+        self.addActivity(old, self.day, comments=2)
+        self.addActivity(categorized, self.day, votes=3, modified=2,
+                         comments=1)
+        self.addActivity(other, self.day, votes=1)
+        # today is not complete
+        self.addActivity(self.addPoll('today', datetime.date.today()),
+                         datetime.date.today(), votes=1, comments=1)
+        self.rollup()
+        middle = before + datetime.timedelta(days=1)
+        # a row without category for every day
+        expected = [(before, None, 0, 0, 0, 0),
+                    (before, self.category.pk, 1, 1, 1, 0),
+                    (middle, None, 0, 0, 0, 0),
+                    (self.day, None, 1, 1, 1, 0),
+                    (self.day, self.category.pk, 2, 3, 2, 3)]
+        self.assertEqual(self.getStats(), expected)
+        # nothing new
+        self.rollup()
+        self.assertEqual(self.getStats(), expected)
+        # rolled up again: replaced
+        self.addActivity(other, self.day, comments=1)
+        self.rollup(since=middle.strftime('%Y-%m-%d'))
+        expected[3] = (self.day, None, 1, 1, 1, 1)
+        self.assertEqual(self.getStats(), expected)
+
+    def testView(self):
+        self.addActivity(self.addPoll('poll', self.day, self.category),
+                         self.day, votes=2, comments=1)
+        self.rollup()
+        url = reverse('stats')
+        for username, is_staff in ((None, False), ('user', False),
+                                   ('inactive', True)):
+            if username:
+                User.objects.create_user(username, password='secret')
+                self.client.login(username=username, password='secret')
+                # inactive after the login
+                User.objects.filter(username=username).update(
+                           is_staff=is_staff, is_active=not is_staff)
+            response = self.client.get(url)
+            self.assertTemplateUsed(response, 'admin/login.html')
+            self.assertFalse('days' in response.context)
+        User.objects.create_user('staff', password='secret')
+        User.objects.filter(username='staff').update(is_staff=True)
+        self.client.login(username='staff', password='secret')
+        response = self.client.get(url)
+        self.assertTemplateUsed(response, 'stats.html')
+        self.assertEqual([(row['day'], row['polls'], row['votes'],
+                           row['active_polls'], row['comments'])
+                          for row in response.context['days']],
+                         [(self.day, 1, 2, 1, 1)])
+        # polls without category first
+        self.assertEqual(response.context['categories'],
+                         [{'name':None, 'polls':0, 'votes':0,
+                           'active_polls':0, 'comments':0},
+                          {'name':'category', 'polls':1, 'votes':2,
+                           'active_polls':1, 'comments':1}])
+
+class VoterPagesTest(TestCase):
+    def setUp(self):
+        self.poll = createPoll('big')
+        addChoices(self.poll, 2)
+        # voters created at the same time are ordered by id
+        date = datetime.datetime(2013, 1, 1)
+        for idx, minutes in enumerate((0, 0, 0, 1, 1, 2, 2, 2, 3)):
+            voter = addVoter(self.poll, 'voter-%d' % idx, {})
+            Voter.objects.filter(pk=voter.pk).update(creation_date=date
+                                    + datetime.timedelta(minutes=minutes))
+        # not created in the order of the ids
+        Voter.objects.filter(user__name='voter-0').update(
+                                 creation_date=datetime.datetime(2013, 1, 2))
+        self.voters = Voter.objects.filter(poll=self.poll)
+        self.names = list(self.voters.order_by('creation_date', 'id'
+                                               ).values_list('user__name',
+                                                             flat=True))
+
+    def getNames(self, content):
+        return re.findall(r'<td>(voter-\d+)</td>', content)
+
+    def testIteration(self):
+        for chunk_size in (1, 2, 3, 4, 9, 20):
+            chunks = list(iterVoters(self.voters, chunk_size=chunk_size))
+            self.assertTrue(all([0 < len(chunk) <= chunk_size
+                                 for chunk in chunks]))
+            self.assertEqual([voter.user.name for chunk in chunks
+                              for voter in chunk], self.names)
+        voters = list(self.voters.order_by('creation_date', 'id'))
+        for idx, after in enumerate(voters):
+            for included in (False, True):
+                start = idx if included else idx + 1
+                self.assertEqual([voter.user.name for chunk in iterVoters(
+                                  self.voters, after, 2, included)
+                                  for voter in chunk], self.names[start:])
+
+    def testPages(self):
+        url = reverse('poll', kwargs={'poll_url':'big'})
+        names, query = [], {}
+        with self.settings(VOTERS_PER_PAGE=2):
+            while True:
+                response = self.client.get(url, query)
+                names += self.getNames(response.content)
+                if 'next_voters' not in response.context:
+                    break
+                query = {'voters_after':response.context['next_voters']}
+            self.assertEqual(names, self.names)
+            # the page of an edited voter starts with it
+            voter = self.voters.get(user__name=self.names[3])
+            response = self.client.get(url, {'voter':voter.pk})
+            self.assertEqual(self.getNames(response.content),
+                             self.names[4:5])
+            self.assertTrue("value='%s'" % str(self.names[3])
+                            in response.content)
+
+    def testStream(self):
+        url = reverse('poll', kwargs={'poll_url':'big'})
+        with self.settings(STREAM_VOTERS=True, VOTERS_CHUNK_SIZE=2,
+                           VOTERS_PER_PAGE=None):
+            response = self.client.get(url)
+            self.assertTrue(response.streaming)
+            content = ''.join(response.streaming_content)
+        self.assertEqual(self.getNames(content), self.names)
+        self.assertTrue(content.rstrip().endswith('</html>'))
+
+class ConditionalTest(TestCase):
+    def setUp(self):
+        self.poll = createPoll('cached')
+        self.choice = addChoices(self.poll, 1)[0]
+        self.url = reverse('poll', kwargs={'poll_url':'cached'})
+
+    def get(self, url, etag=None):
+        if etag:
+            return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        return self.client.get(url)
+
+    def checkUnchanged(self, url):
+        "Return the ETag of an unchanged page"
+        response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        response = self.get(url, etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+        self.assertEqual(response['ETag'], etag)
+        # compressed by the gzip middleware
+        self.assertEqual(self.get(url, etag[:-1] + ';gzip"').status_code,
+                         304)
+        return etag
+
+    def vote(self):
+        self.client.post(reverse('vote', kwargs={'poll_url':'cached'}),
+                         {'author_name':'voter',
+                          'choice_%d' % self.choice.pk:'on'})
+
+    def testPoll(self):
+        etag = self.checkUnchanged(self.url)
+        self.assertEqual(self.get(self.url, '"other"').status_code, 200)
+        # other page of the poll
+        self.assertNotEqual(self.checkUnchanged(self.url + '?voters_after=1'),
+                            etag)
+        self.vote()
+        response = self.get(self.url, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(self.checkUnchanged(self.url), response['ETag'])
+
+    def testHiddenPoll(self):
+        Poll.objects.filter(pk=self.poll.pk).update(hide_choices=True)
+        etag = self.checkUnchanged(self.url)
+        self.vote()
+        other = self.client_class()
+        # the results are now displayed to the voter only
+        self.assertEqual(other.get(self.url,
+                                   HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        self.assertNotEqual(self.checkUnchanged(self.url),
+                            other.get(self.url)['ETag'])
+
+    def testListings(self):
+        category = Category.objects.create(name='category',
+                                           description='category')
+        with self.settings(ALLOW_FRONTPAGE_POLL=True):
+            for url, values in ((reverse('index'), {}),
+                                (reverse('category', args=[category.pk]),
+                                 {'category':category})):
+                etag = self.checkUnchanged(url)
+                createPoll('new%d' % len(values), public=True, **values)
+                self.assertEqual(self.get(url, etag).status_code, 200)
+                self.checkUnchanged(url)
+
+@override_settings(KNOWN_VOTES_COOKIE=True, KNOWN_VOTES_MAX=2)
+class KnownVotesTest(TestCase):
+    def setUp(self):
+        self.polls = []
+        for idx in xrange(3):
+            poll = createPoll('hidden%d' % idx, hide_choices=True)
+            addChoices(poll, 1)
+            self.polls.append(poll)
+
+    def vote(self, poll):
+        self.client.post(reverse('vote', kwargs={'poll_url':poll.base_url}),
+                         {'author_name':'voter',
+                          'choice_%d' % poll.choice_set.get().pk:'on'})
+
+    def isHidden(self, poll):
+        return self.client.get(reverse('poll', kwargs={
+                            'poll_url':poll.base_url})).context['hide_vote']
+
+    def setCookie(self, value):
+        self.client.cookies[KNOWN_VOTES_COOKIE] = value
+
+    def testCookie(self):
+        self.assertTrue(self.isHidden(self.polls[0]))
+        self.vote(self.polls[0])
+        self.assertFalse(self.isHidden(self.polls[0]))
+        self.assertTrue(self.isHidden(self.polls[1]))
+        # not kept in the session
+        self.assertFalse(Session.objects.count())
+        self.assertEqual(signing.loads(
+                    self.client.cookies[KNOWN_VOTES_COOKIE].value,
+                    salt=KnownVotesMiddleware.salt), ['hidden0'])
+        # only the last KNOWN_VOTES_MAX polls
+        for poll in self.polls[1:]:
+            self.vote(poll)
+        self.assertEqual([self.isHidden(poll) for poll in self.polls],
+                         [True, False, False])
+
+    def testTampered(self):
+        self.vote(self.polls[0])
+        value = self.client.cookies[KNOWN_VOTES_COOKIE].value
+        for forged in (value[:-1] + ('A' if value[-1] != 'A' else 'B'),
+                       signing.dumps(['hidden1'], salt='other'),
+                       signing.dumps(['hidden1'], key='other key',
+                                     salt=KnownVotesMiddleware.salt),
+                       '["hidden1"]', 'garbage'):
+            self.setCookie(forged)
+            self.assertTrue(self.isHidden(self.polls[0]))
+            self.assertTrue(self.isHidden(self.polls[1]))
+        # not a list
+        self.setCookie(signing.dumps('hidden1', salt=KnownVotesMiddleware.salt))
+        self.assertTrue(self.isHidden(self.polls[1]))
+        self.setCookie(signing.dumps(['hidden1'],
+                                     salt=KnownVotesMiddleware.salt))
+        self.assertFalse(self.isHidden(self.polls[1]))
+
+    def testSession(self):
+        with self.settings(KNOWN_VOTES_COOKIE=False):
+            self.vote(self.polls[0])
+            self.assertFalse(self.isHidden(self.polls[0]))
+            self.assertFalse(KNOWN_VOTES_COOKIE in self.client.cookies)
+            self.assertEqual(Session.objects.count(), 1)
+
+class JsCatalogTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def compile(self):
+        output = StringIO.StringIO()
+        with self.settings(MEDIA_ROOT=self.root, ASSETS_ROOT=self.root):
+            call_command('compile_jsi18n', stdout=output)
+        return json.load(open(os.path.join(self.root, assets.JS_CATALOG_DIR,
+                                           assets.JS_CATALOG_MANIFEST)))
+
+    def testCatalogs(self):
+        catalogs = self.compile()
+        self.assertEqual(sorted(catalogs), sorted([language for language, label
+                                                   in settings.LANGUAGES]))
+        for language, name in catalogs.items():
+            with open(os.path.join(self.root, assets.JS_CATALOG_DIR,
+                                   name)) as catalog:
+                content = catalog.read()
+            self.assertEqual(name, assets.hashedName(language + '.js',
+                                                     content))
+            with translation.override(language):
+                self.assertEqual(content, self.client.get(
+                                        reverse('admin_i18n')).content)
+        self.assertNotEqual(catalogs['fr'], catalogs['en'])
+        # same content: same names
+        self.assertEqual(self.compile(), catalogs)
+
+    def testUrls(self):
+        url = reverse('poll', kwargs={'poll_url':'translated'})
+        addChoices(createPoll('translated'), 1)
+        with self.settings(MEDIA_ROOT=self.root, ASSETS_ROOT=self.root):
+            # not compiled: served by django
+            self.assertTrue('"%s"' % reverse('admin_i18n')
+                            in self.client.get(url).content)
+            catalogs = self.compile()
+            expected = {'fr':catalogs['fr'], 'fr-ca':catalogs['fr'],
+                        'en':catalogs['en'], 'de':None}
+            for language, name in expected.items():
+                self.assertEqual(assets.getJsCatalogUrl(language),
+                                 name and settings.MEDIA_URL
+                                 + assets.JS_CATALOG_DIR + '/' + name)
+            self.assertTrue('"%s%s/%s"' % (settings.MEDIA_URL,
+                                           assets.JS_CATALOG_DIR,
+                                           str(catalogs['fr']))
+                            in self.client.get(url).content)
+
+class AssetsTest(TestCase):
+    def setUp(self):
+        self.media, self.root = tempfile.mkdtemp(), tempfile.mkdtemp()
+        self.sources = {'textareas.js':'var textareas = 1;\n' * 50,
+                        'img/bg.jpg':os.urandom(200),
+                        'css/base.css':'body {background: url(../img/bg.jpg)}',
+                        'styles.css':'@import url("css/base.css");\n'
+                                     'p {background: url(http://x/a.png)}'}
+        for name, content in self.sources.items():
+            path = os.path.join(self.media, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as source:
+                source.write(content)
+        self.override = self.settings(MEDIA_ROOT=self.media,
+                                      ASSETS_ROOT=self.root)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        shutil.rmtree(self.media)
+        shutil.rmtree(self.root)
+
+    def collect(self):
+        output = StringIO.StringIO()
+        call_command('collect_assets', stdout=output)
+        with open(os.path.join(self.root, assets.ASSETS_MANIFEST)) as manifest:
+            return json.load(manifest), output.getvalue().splitlines()
+
+    def read(self, name):
+        with open(os.path.join(self.root, name), 'rb') as collected:
+            return collected.read()
+
+    def testCollect(self):
+        manifest, written = self.collect()
+        self.assertTrue(set(self.sources) < set(manifest))
+        self.assertTrue([name for name in manifest
+                         if name.startswith('admin/')])
+        for name in manifest:
+            self.assertEqual(manifest[name], assets.hashedName(name,
+                                                 self.read(manifest[name])))
+        for name in ('textareas.js', 'img/bg.jpg'):
+            self.assertEqual(self.read(manifest[name]), self.sources[name])
+        # the stylesheets refer to the collected files
+        self.assertEqual(self.read(manifest['css/base.css']),
+                         'body {background: url(../%s)}' % manifest['img/bg.jpg'])
+        self.assertEqual(self.read(manifest['styles.css']),
+                         '@import url("%s");\np {background: url(http://x/a.png)}'
+                         % manifest['css/base.css'])
+        # compressed copies of the texts only
+        compressed = gzip.GzipFile(fileobj=StringIO.StringIO(self.read(
+                                   manifest['textareas.js'] + '.gz'))).read()
+        self.assertEqual(compressed, self.sources['textareas.js'])
+        self.assertFalse(os.path.exists(os.path.join(self.root,
+                                          manifest['img/bg.jpg'] + '.gz')))
+        # unchanged: nothing written
+        self.assertEqual(self.collect(), (manifest, written[-1:]))
+
+    def testUrls(self):
+        for name, url in (('styles.css', settings.MEDIA_URL + 'styles.css'),
+                          ('admin/css/base.css',
+                           settings.ADMIN_MEDIA_PREFIX + 'css/base.css')):
+            self.assertEqual(assets.getAssetUrl(name), url)
+        self.assertFalse(str(settings.ASSETS_URL) in str(CommentForm().media))
+        manifest = self.collect()[0]
+        for name in ('styles.css', 'admin/css/base.css', 'unknown.js'):
+            self.assertEqual(assets.getAssetUrl(name), settings.ASSETS_URL
+                             + manifest[name] if name in manifest
+                             else settings.MEDIA_URL + name)
+        # the forms use the new names at once
+        self.assertTrue(str(settings.ASSETS_URL + manifest['textareas.js'])
+                        in str(CommentForm().media))
+
+    def testView(self):
+        manifest = self.collect()[0]
+        url = reverse('asset', args=[manifest['textareas.js']])
+        response = self.client.get(url)
+        self.assertEqual(''.join(response.streaming_content),
+                         self.sources['textareas.js'])
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertTrue('Accept-Encoding' in response['Vary'])
+        self.assertEqual(response['Cache-Control'],
+                         'public, max-age=31536000, immutable')
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='br;q=1, gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(''.join(response.streaming_content),
+                         self.read(manifest['textareas.js'] + '.gz'))
+        with self.settings(ASSETS_SENDFILE='X-Sendfile'):
+            response = self.client.get(url)
+            self.assertEqual(response['X-Sendfile'], os.path.join(self.root,
+                                                manifest['textareas.js']))
+        for path in ('../' + os.path.basename(self.media) + '/styles.css',
+                     'missing.js', ''):
+            self.assertEqual(self.client.get(reverse('asset', args=[path])
+                                             ).status_code, 404)
+
+    def testHandler(self):
+        "The WSGI handler sends the collected files without the middlewares"
+        manifest = self.collect()[0]
+        path = settings.ASSETS_URL + manifest['textareas.js']
+        request = RequestFactory().get(path, HTTP_ACCEPT_ENCODING='gzip')
+        started = []
+        content = ''.join(PapillonHandler()(request.environ,
+                          lambda status, headers: started.append((status,
+                                                          dict(headers)))))
+        status, headers = started[0]
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertFalse('Set-Cookie' in headers)
+        self.assertEqual(content, self.read(manifest['textareas.js'] + '.gz'))
+
+class Clock(object):
+    "Time of the limits set by the tests"
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+class RateTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.clock = Clock(6000.)
+        self.time, limits.time = limits.time, self.clock
+
+    def tearDown(self):
+        limits.time = self.time
+
+    def testWindows(self):
+        rate = (3, 60)
+        self.assertEqual([limits.countPost('key', rate) for idx in xrange(3)],
+                         [0, 0, 0])
+        # until the end of the window
+        self.clock.now += 15
+        self.assertEqual(limits.countPost('key', rate), 45)
+        # the refused posts are not counted
+        self.assertEqual(limits.countPost('key', rate), 45)
+        self.assertEqual(limits.countPost('other', rate), 0)
+        # a quarter of the previous window is still in the period
+        self.clock.now += 60
+        self.assertEqual(limits.countPost('key', rate), 5)
+        self.clock.now += 5
+        self.assertEqual(limits.countPost('key', rate), 0)
+        self.assertEqual(limits.countPost('key', rate), 20)
+        self.clock.now += 20
+        self.assertEqual(limits.countPost('key', rate), 0)
+        self.assertTrue(limits.countPost('key', rate))
+        # expired counter
+        self.clock.now += 120
+        cache.delete('key_%d' % (self.clock.now // 60))
+        self.assertEqual(limits.countPost('key', rate), 0)
+
+    def testConcurrentPosts(self):
+        "The posts are counted once each by simultaneous requests"
+        taken = []
+        runThreads(lambda idx:taken.append(limits.countPost('key', (50, 60))),
+                   20)
+        self.assertEqual(taken, [0] * 20)
+        self.assertEqual(cache.get('key_100'), 20)
+
+    @override_settings(POST_RATE_BY_CLIENT=(2, 60), POST_RATE_BY_POLL=(3, 60))
+    def testThrottle(self):
+        poll = createPoll('limited')
+        choice = addChoices(poll, 1)[0]
+        def post(address):
+            return self.client.post(reverse('vote',
+                                            kwargs={'poll_url':'limited'}),
+                                    {'author_name':'voter %s' % address,
+                                     'choice_%d' % choice.pk:'on'},
+                                    REMOTE_ADDR=address)
+        self.assertEqual([post('1.1.1.1').status_code for idx in xrange(3)],
+                         [200, 200, 429])
+        self.assertEqual(post('2.2.2.2').status_code, 200)
+        # by poll
+        response = post('3.3.3.3')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '61')
+        self.assertEqual(Voter.objects.count(), 3)
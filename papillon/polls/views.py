@@ -21,21 +21,52 @@
 Views management
 '''
 
-from random import choice as random_choice
-import string
+import hashlib
+import json
+import mimetypes
+import os
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import wraps
 
 from django.shortcuts import render_to_response
-from django.http import HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, \
+                        StreamingHttpResponse, HttpResponseNotModified, \
+                        HttpResponseNotAllowed, Http404
+from django.core.servers.basehttp import FileWrapper
+from django.contrib.admin.views.decorators import staff_member_required
+from django.utils.cache import patch_vary_headers
 from django.conf import settings
+from django.db import connections
+from django.db.models import Q, Max, Count, Sum
+from django.template import loader, Context
+from django.utils import translation
 from django.utils.translation import gettext_lazy as _
 from django.core.urlresolvers import reverse
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from django.utils.http import parse_etags, quote_etag
 
 from papillon.polls.models import Poll, PollUser, Choice, Voter, Vote, \
-                                  Category, Comment
+                                  Category, Comment, Webhook, DailyStats, \
+                                  getPoll, genRandomURL, notifyAuthor, \
+                                  logBallot, queueWebhookEvents, \
+                                  BALLOT_VALUES
 from papillon.polls.forms import CreatePollForm, AdminPollForm, ChoiceForm, \
-                                 DatedChoiceForm, CommentForm
+                                 DatedChoiceForm, CommentForm, WebhookForm, \
+                                 ApiPollForm
+from papillon.polls.database import write
+from papillon.polls.assets import getJsCatalogUrl
+from papillon.polls.middleware import setKnownVote, isKnownVote
+from papillon.polls.limits import isDuplicateBallot, addBallot
+from papillon.polls.overload import measured, keepPage, BANNER_MARK
+from papillon.polls.tasks import defer
+from papillon.polls.routers import onReplica, pinPrimary, gather, useShard, \
+                                   shardFor, saveState, restoredState, \
+                                   pollDatabases
+
+# replaced by the voter lines in streamed poll pages
+VOTERS_MARK = u'<!-- voters -->'
 
 def getBaseResponse(request):
     """Manage basic fields for the template
@@ -50,9 +81,190 @@ def getBaseResponse(request):
     languages = []
     for language_code, language_label in settings.LANGUAGES:
         languages.append((language_code, language_label))
+    js_catalog_url = getJsCatalogUrl(translation.get_language()) \
+                     or reverse('admin_i18n')
     return {'media_url':settings.MEDIA_URL, 'languages':languages,
-            'admin_url':settings.ADMIN_MEDIA_PREFIX,}, None
+            'admin_url':settings.ADMIN_MEDIA_PREFIX,
+            'js_catalog_url':js_catalog_url}, None
+
+class CellRenderer(object):
+    '''Render the vote cells of the voter lines of a poll.
+    A cell only depends on the vote value: its HTML is built once by distinct
+    value and the cells of a line are joined.
+    '''
+    def __init__(self, poll):
+        self.type = poll.type
+        self.cells = {}
+
+    def getClass(self, value):
+        "CSS class of a cell"
+        if self.type == 'V':
+            if value == 9:
+                return 'OK'
+            return 'KO' if value == 0 else 'OKO'
+        if value == 1:
+            return 'OK'
+        return 'OKO' if value == 0 else 'KO'
+
+    def getLabel(self, value):
+        "Label of a cell"
+        if self.type == 'V':
+            return unicode(value or 0)
+        # Yes/No/Maybe polls have their own labels
+        label_idx = 1 if self.type == 'B' else 0
+        for vote_value, labels in Vote.VOTE:
+            if vote_value == value:
+                return unicode(labels[label_idx])
+        return u''
+
+    def getCell(self, value):
+        if value not in self.cells:
+            self.cells[value] = u"<td class='%s'>%s</td>" % (
+                            self.getClass(value), escape(self.getLabel(value)))
+        return self.cells[value]
+
+    def render(self, votes):
+        "HTML of the cells of a list of votes"
+        return mark_safe(u''.join([self.getCell(vote.value)
+                                   for vote in votes]))
+
+def iterVoters(voters, after=None, chunk_size=100, included=False):
+    '''Iterate over chunks of voters ordered by creation date.
+    Each chunk is read from the last voter of the previous one (cursor) so the
+    voters are never all in memory. The iteration starts after the voter
+    after - or with it if included is set.
+    '''
+    voters = voters.select_related('user').order_by('creation_date', 'id')
+    while True:
+        chunk = voters
+        if after:
+            id_filter = {'id__gte' if included else 'id__gt':after.id}
+            chunk = chunk.filter(Q(creation_date__gt=after.creation_date) |
+                           Q(creation_date=after.creation_date, **id_filter))
+        chunk = list(chunk[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        after, included = chunk[-1], False
+
+def conditional(etag_func):
+    '''Answer "304 Not Modified" to GET requests with the ETag given by
+    etag_func - called with the arguments of the view - without executing the
+    view. etag_func returns None if the page cannot be validated.
+    '''
+    def decorator(view):
+        @wraps(view)
+        def inner(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            etag = etag_func(request, *args, **kwargs)
+            if not etag:
+                return view(request, *args, **kwargs)
+            try:
+                etags = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+            except ValueError:
+                etags = []
+            # the gzip middleware adds ";gzip" to the ETag of compressed pages
+            if etag in etags or etag + ';gzip' in etags:
+                response = HttpResponseNotModified()
+            else:
+                response = view(request, *args, **kwargs)
+            if response.status_code in (200, 304) \
+               and not response.has_header('ETag'):
+                response['ETag'] = quote_etag(etag)
+            return response
+        return inner
+    return decorator
 
+def getETag(request, *versions):
+    '''ETag of a page from the versions of its content, the language and the
+    address of the page'''
+    versions += (translation.get_language(), request.get_full_path())
+    return hashlib.md5(repr(versions)).hexdigest()
+
+def getPollsVersion(polls):
+    "Number and last modification of the polls of a queryset on every shard"
+    return [polls.using(alias).aggregate(Count('id'), Max('modification_date'))
+            for alias in pollDatabases()]
+
+def indexETag(request):
+    if not settings.ALLOW_FRONTPAGE_POLL:
+        return getETag(request)
+    return getETag(request, getPollsVersion(Poll.objects.filter(public=True,
+                                                                category=None)),
+                   list(Category.objects.values_list('id', 'name')))
+
+def categoryETag(request, category_id):
+    try:
+        category = Category.objects.get(id=int(category_id))
+    except (ValueError, Category.DoesNotExist):
+        return None
+    return getETag(request, category.name, category.description,
+                   getPollsVersion(Poll.objects.filter(public=True,
+                                                       category=category)))
+
+def pollETag(request, poll_url):
+    poll = getPoll(base_url=poll_url.split('_')[0])
+    if not poll:
+        return None
+    # results of hidden polls are displayed after a vote
+    knowned_vote = poll.hide_choices and isKnownVote(request, poll)
+    return getETag(request, poll.pk, poll.modification_date, poll.open,
+                   knowned_vote)
+
+def deferAvailability(poll):
+    '''Save in the background the availability of the choices of a poll with
+    limits - or made unavailable by a removed limit - after a modification'''
+    if Choice.objects.filter(Q(limit__gt=0) | Q(available=False),
+                             poll=poll).exists():
+        defer('saveAvailability', poll.pk)
+
+# precompressed versions of the collected files
+ASSET_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+def asset(request, path):
+    '''Send a file collected by "./manage.py collect_assets" - or its
+    precompressed version - cached forever: its name changes with its content.
+    With ASSETS_SENDFILE the file is sent by the web server. The WSGI handler
+    of Papillon calls it without the middlewares (see polls.handlers).
+    '''
+    root = os.path.normpath(settings.ASSETS_ROOT)
+    full_path = os.path.normpath(os.path.join(root, path))
+    if not full_path.startswith(root + os.sep) \
+       or not os.path.isfile(full_path):
+        raise Http404
+    content_type = mimetypes.guess_type(full_path)[0] \
+                   or 'application/octet-stream'
+    accepted = [encoding.split(';')[0].strip() for encoding in
+                request.META.get('HTTP_ACCEPT_ENCODING', '').split(',')]
+    variants = [(name, full_path + extension)
+                for name, extension in ASSET_ENCODINGS
+                if os.path.isfile(full_path + extension)]
+    encoding = None
+    for name, variant in variants:
+        if name in accepted:
+            encoding, full_path = name, variant
+            break
+    if settings.ASSETS_SENDFILE == 'X-Accel-Redirect':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.ASSETS_ACCEL_PREFIX + \
+                   os.path.relpath(full_path, root).replace(os.sep, '/')
+    elif settings.ASSETS_SENDFILE:
+        response = HttpResponse(content_type=content_type)
+        response[settings.ASSETS_SENDFILE] = full_path
+    else:
+        response = StreamingHttpResponse(FileWrapper(open(full_path, 'rb')),
+                                         content_type=content_type)
+        response['Content-Length'] = os.path.getsize(full_path)
+    if encoding:
+        response['Content-Encoding'] = encoding
+    if variants:
+        patch_vary_headers(response, ('Accept-Encoding',))
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@conditional(indexETag)
 def index(request):
     "Main page"
     response_dct, redirect = getBaseResponse(request)
@@ -60,13 +272,15 @@ def index(request):
         return redirect
     response_dct['public'] = settings.ALLOW_FRONTPAGE_POLL
     if response_dct['public']:
-        response_dct['polls'] = Poll.objects.filter(public=True, category=None)
+        response_dct['polls'] = gather(Poll.objects.filter(public=True,
+                                                           category=None))
         response_dct['categories'] = Category.objects.all()
     error = ''
     if 'bad_poll' in request.GET:
         response_dct['error'] = _("The poll requested don't exist (anymore?)")
     return render_to_response('main.html', response_dct)
 
+@conditional(categoryETag)
 def category(request, category_id):
     "Page for a category"
     response_dct, redirect = getBaseResponse(request)
@@ -74,23 +288,56 @@ def category(request, category_id):
         return redirect
     category = Category.objects.get(id=int(category_id))
     response_dct['category'] = category
-    response_dct['polls'] = Poll.objects.filter(public=True, category=category)
+    response_dct['polls'] = gather(Poll.objects.filter(public=True,
+                                                       category=category))
     return render_to_response('category.html', response_dct)
 
+STATS_FIELDS = ('polls', 'votes', 'active_polls', 'comments')
+
+@staff_member_required
+def stats(request):
+    '''Activity by day and by category for the operators - only read from the
+    rollups made by "./manage.py rollup_stats"
+    '''
+    response_dct, redirect = getBaseResponse(request)
+    if redirect:
+        return redirect
+    try:
+        days = max(1, int(request.GET.get('days', 30)))
+    except ValueError:
+        days = 30
+    first_day = datetime.now().date() - timedelta(days=days)
+    by_day, by_category = {}, {}
+    sums = dict([(field, Sum(field)) for field in STATS_FIELDS])
+    for alias in pollDatabases():
+        # no ordering: it would be part of the grouping
+        for row in DailyStats.objects.using(alias).filter(day__gte=first_day
+                ).order_by().values('day', 'category').annotate(**sums):
+            for totals in (by_day.setdefault(row['day'], {}),
+                           by_category.setdefault(row['category'], {})):
+                for field in STATS_FIELDS:
+                    totals[field] = totals.get(field, 0) + row[field]
+    names = dict(Category.objects.values_list('id', 'name'))
+    response_dct['days'] = [dict(by_day[day], day=day)
+                            for day in sorted(by_day, reverse=True)]
+    # polls without category first
+    response_dct['categories'] = sorted([dict(by_category[category_id],
+                                              name=names.get(category_id))
+                                         for category_id in by_category],
+                                        key=lambda totals:totals['name'])
+    response_dct['period'] = days
+    return render_to_response('stats.html', response_dct)
+
 def create(request):
     '''Creation of a poll.
     '''
-    def genRandomURL():
-        "Generation of a random url"
-        url = ''
-        while not url or Poll.objects.filter(base_url=url).count() or\
-              Poll.objects.filter(admin_url=url).count():
-            url = ''
-            chars = string.letters + string.digits
-            for i in xrange(6):
-                url += random_choice(chars)
-            url += str(int(time.time()))
-        return url
+    def savePoll(poll, email):
+        "Save the poll with its author if notifications are asked"
+        if email:
+            author = PollUser(name=poll.author_name, email=email)
+            author.save()
+            poll.author = author
+        poll.save()
 
     response_dct, redirect = getBaseResponse(request)
     if redirect:
@@ -99,10 +346,12 @@ def create(request):
     if request.method == 'POST':
         form = CreatePollForm(request.POST)
         if form.is_valid():
-            poll = form.save()
+            # urls are set before the first save as they give the shard
+            poll = form.save(commit=False)
             poll.admin_url = genRandomURL()
             poll.base_url = genRandomURL()
-            poll.save()
+            useShard(shardFor(poll.base_url))
+            write(savePoll, poll, form.cleaned_data.get('author_email'))
             return HttpResponseRedirect(reverse('edit_choices_admin',
                                                 args=[poll.admin_url]))
     else:
@@ -110,29 +359,143 @@ def create(request):
     response_dct['form'] = form
     return render_to_response('create.html', response_dct)
 
+def getApiChoices(data, dated):
+    '''Choices of a poll created with the API: list of (name, limit) sorted by
+    date for dated choices. Raise ValueError with a message if invalid.
+    '''
+    if not isinstance(data, list) or not data:
+        raise ValueError(_("A list of choices is required"))
+    if len(data) > settings.API_MAX_CHOICES:
+        raise ValueError(_("Too many choices"))
+    choices = []
+    for item in data:
+        if not isinstance(item, dict):
+            item = {'name':item}
+        name, limit = item.get('name'), item.get('limit')
+        if not name or not isinstance(name, basestring) or len(name) > 200:
+            raise ValueError(_("Invalid choice name"))
+        if limit is not None and (type(limit) not in (int, long)
+                                  or limit < 1):
+            raise ValueError(_("Invalid choice limit"))
+        if dated:
+            date = None
+            for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+                try:
+                    date = datetime.strptime(name, format)
+                    break
+                except ValueError:
+                    continue
+            if not date:
+                raise ValueError(_('Invalid date format: YYYY-MM-DD HH:MM:SS'))
+            name = date.strftime('%Y-%m-%d %H:%M:%S')
+        choices.append((name, limit))
+    if dated:
+        choices.sort()
+    return choices
+
+def createApi(request):
+    '''Creation of a poll with its choices from a JSON object. Return the
+    addresses of the poll.
+    '''
+    def savePoll(poll, email, choices):
+        "Save the poll with its author and its choices"
+        if email:
+            author = PollUser(name=poll.author_name, email=email)
+            author.save()
+            poll.author = author
+        poll.save()
+        Choice.objects.bulk_create([Choice(poll=poll, name=name, limit=limit,
+                                           order=idx, ballot_index=idx)
+                                for idx, (name, limit) in enumerate(choices)])
+
+    def jsonResponse(data, status):
+        return HttpResponse(json.dumps(data), status=status,
+                            content_type='application/json')
+
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        data = json.loads(request.body)
+        assert isinstance(data, dict)
+    except (ValueError, AssertionError):
+        return jsonResponse({'errors':{'__all__':[unicode(
+                                           _("Invalid JSON object"))]}}, 400)
+    form = ApiPollForm(data)
+    if not form.is_valid():
+        return jsonResponse({'errors':dict([(key, map(unicode, errors))
+                               for key, errors in form.errors.items()])}, 400)
+    try:
+        choices = getApiChoices(data.get('choices'),
+                                form.cleaned_data['dated_choices'])
+    except ValueError, error:
+        return jsonResponse({'errors':{'choices':[unicode(error.args[0])]}},
+                            400)
+    # urls are set before the first save as they give the shard
+    poll = form.save(commit=False)
+    poll.admin_url = genRandomURL()
+    poll.base_url = genRandomURL()
+    useShard(shardFor(poll.base_url))
+    write(savePoll, poll, form.cleaned_data['author_email'], choices)
+    return jsonResponse({
+        'base_url':request.build_absolute_uri(reverse('poll',
+                                                      args=[poll.base_url])),
+        'admin_url':request.build_absolute_uri(reverse('edit',
+                                                       args=[poll.admin_url]))
+        }, 201)
+
 def edit(request, admin_url):
     '''Edition of a poll.
     '''
+    def savePoll(form, was_open):
+        "Save the poll and queue the events of its webhooks"
+        poll = form.save(commit=False)
+        poll.saveEdited()
+        webhooks = Webhook.objects.filter(poll=poll)
+        queueWebhookEvents(webhooks, 'edited')
+        if was_open and not poll.open:
+            queueWebhookEvents(webhooks, 'closed')
+        return poll
+
+    def saveWebhooks(poll, webhook_form, delete_ids):
+        "Add and delete webhooks"
+        if delete_ids:
+            Webhook.objects.filter(poll=poll, pk__in=delete_ids).delete()
+        if webhook_form.cleaned_data['url']:
+            webhook = webhook_form.save(commit=False)
+            webhook.poll = poll
+            webhook.save()
+
     response_dct, redirect = getBaseResponse(request)
     if redirect:
         return redirect
-    try:
-        poll = Poll.objects.filter(admin_url=admin_url)[0]
-    except IndexError:
+    poll = getPoll(admin_url=admin_url)
+    if not poll:
         # if the poll don't exist redirect to the creation page
         return HttpResponseRedirect(reverse('create'))
     Form = AdminPollForm
 
-    if request.method == 'POST':
+    webhook_form = WebhookForm()
+    form = Form(instance=poll)
+    if request.method == 'POST' and 'webhooks' in request.POST:
+        webhook_form = WebhookForm(request.POST)
+        if webhook_form.is_valid():
+            delete_ids = [int(webhook_id) for webhook_id
+                          in request.POST.getlist('delete_webhook')
+                          if webhook_id.isdigit()]
+            write(saveWebhooks, poll, webhook_form, delete_ids)
+            return HttpResponseRedirect(reverse('edit',
+                                        args=[poll.admin_url]))
+    elif request.method == 'POST':
+        was_open = poll.open
         form = Form(request.POST, instance=poll)
         if form.is_valid():
-            poll = form.save()
+            poll = write(savePoll, form, was_open)
             return HttpResponseRedirect(reverse('edit',
                                         args=[poll.admin_url]))
-    else:
-        form = Form(instance=poll)
     response_dct['form'] = form
     response_dct['poll'] = poll
+    response_dct['webhook_form'] = webhook_form
+    response_dct['webhooks'] = Webhook.objects.filter(poll=poll)
     response_dct['base_url'] = request.build_absolute_uri(reverse('poll',
                                                         args=[poll.base_url]))
     response_dct['edit_url'] = request.build_absolute_uri(reverse('edit',
@@ -145,9 +508,8 @@ def editChoicesAdmin(request, admin_url):
     response_dct, redirect = getBaseResponse(request)
     if redirect:
         return redirect
-    try:
-        poll = Poll.objects.filter(admin_url=admin_url)[0]
-    except IndexError:
+    poll = getPoll(admin_url=admin_url)
+    if not poll:
         # if the poll don't exist redirect to the main page
         return HttpResponseRedirect(reverse('index'))
     response_dct['poll'] = poll
@@ -157,10 +519,7 @@ def editChoicesUser(request, poll_url):
     response_dct, redirect = getBaseResponse(request)
     if redirect:
         return redirect
-    try:
-        poll = Poll.objects.filter(base_url=poll_url)[0]
-    except IndexError:
-        poll = None
+    poll = getPoll(base_url=poll_url)
     if not poll or not poll.opened_admin:
         # if the poll don't exist redirect to the main page
         return HttpResponseRedirect(reverse('index'))
@@ -184,15 +543,25 @@ def editChoices(request, response_dct, admin=False):
         order = 0
     form = Form(initial={'poll':poll.id, 'order':str(order)})
 
-    if request.method == 'POST':
+    def deferReorder():
+        "Sort the dated choices in the background"
+        if poll.dated_choices:
+            defer('reorderChoices', poll.pk)
+
+    def updateChoices(request):
+        '''Manage submitted choices.
+        Return the new choice form if it is not valid.
+        '''
+        invalid_form = None
         # if a new choice is submitted
         if 'add' in request.POST and request.POST['poll'] == str(poll.id):
             f = Form(request.POST)
             if f.is_valid():
                 choice = f.save()
-                poll.reorder()
+                deferReorder()
+                poll.touch()
             else:
-                form = f
+                invalid_form = f
         if admin and 'edit' in request.POST \
            and request.POST['poll'] == str(poll.id):
             try:
@@ -202,7 +571,8 @@ def editChoices(request, response_dct, admin=False):
                 f = Form(request.POST, instance=choice)
                 if f.is_valid():
                     choice = f.save()
-                    poll.reorder()
+                    deferReorder()
+                    poll.touch()
             except (Choice.DoesNotExist, ValueError):
                 pass
         if admin:
@@ -215,8 +585,20 @@ def editChoices(request, response_dct, admin=False):
                             raise ValueError
                         Vote.objects.filter(choice=choice).delete()
                         choice.delete()
+                        poll.touch()
                     except (Choice.DoesNotExist, ValueError):
                         pass
+        deferAvailability(poll)
+        return invalid_form
+
+    def moveChoice(choice, idx):
+        "Change the order of a choice"
+        choice.changeOrder(idx)
+        deferReorder()
+        poll.touch()
+
+    if request.method == 'POST':
+        form = write(updateChoices, request) or form
     # check if the order of a choice has to be changed
     if admin and request.method == 'GET':
         for key in request.GET:
@@ -229,16 +611,14 @@ def editChoices(request, response_dct, admin=False):
                     choice = Choice.objects.get(id=int(request.GET[key]))
                     if choice.poll != poll:
                         raise ValueError
-                    choice.changeOrder(-1)
-                    poll.reorder()
+                    write(moveChoice, choice, -1)
                     # redirect in order to avoid a change with a refresh
                     return HttpResponseRedirect(current_url)
                 if 'down_choice' in key:
                     choice = Choice.objects.get(id=int(request.GET[key]))
                     if choice.poll != poll:
                         raise ValueError
-                    choice.changeOrder(1)
-                    poll.reorder()
+                    write(moveChoice, choice, 1)
                     # redirect in order to avoid a change with a refresh
                     return HttpResponseRedirect(current_url)
             except (ValueError, Choice.DoesNotExist):
@@ -252,6 +632,63 @@ def editChoices(request, response_dct, admin=False):
     response_dct['form_new_choice'] = form
     return render_to_response(tpl, response_dct)
 
+def getComments(poll, before=None):
+    '''Get the last COMMENTS_ON_PAGE comments of a poll - before the comment
+    id before - and the id of the previous comment if any'''
+    comments = Comment.objects.filter(poll=poll)
+    if before:
+        comments = comments.filter(id__lt=before)
+    comments = list(comments.order_by('-id')[:settings.COMMENTS_ON_PAGE + 1])
+    previous_comments = None
+    if len(comments) > settings.COMMENTS_ON_PAGE:
+        comments = comments[:settings.COMMENTS_ON_PAGE]
+        previous_comments = comments[-1].id
+    comments.reverse()
+    return {'comments':comments, 'previous_comments':previous_comments}
+
+# seconds between two checks of a request waiting for new comments
+COMMENTS_WAIT_STEP = 2
+
+def commentsETag(request, poll_url):
+    if settings.COMMENTS_WAIT and 'after' in request.GET:
+        # the request waits for new comments
+        return None
+    return pollETag(request, poll_url)
+
+@conditional(commentsETag)
+def comments(request, poll_url):
+    '''Comments of a poll newer than the comment id "after" or the previous
+    ones of the comment id "before" as list items.
+    Without newer comments the request waits for them up to COMMENTS_WAIT
+    seconds (long polling).
+    '''
+    poll = getPoll(base_url=poll_url)
+    if not poll or not settings.MAX_COMMENT_NB \
+       or (poll.hide_choices and not isKnownVote(request, poll)):
+        raise Http404
+    try:
+        after = int(request.GET.get('after', 0))
+        before = int(request.GET.get('before', 0))
+    except ValueError:
+        raise Http404
+    if before:
+        response_dct = getComments(poll, before)
+    else:
+        start = time.time()
+        while True:
+            comments = list(Comment.objects.filter(poll=poll, id__gt=after
+                                                   ).order_by('id'))
+            if comments or time.time() - start >= settings.COMMENTS_WAIT:
+                break
+            # don't keep database connections while waiting
+            for connection in connections.all():
+                connection.close()
+            time.sleep(COMMENTS_WAIT_STEP)
+        response_dct = {'comments':comments}
+    response_dct['poll'] = poll
+    return render_to_response('comments.html', response_dct)
+
+@conditional(pollETag)
 def poll(request, poll_url):
     """Display a poll
     poll_url is given to identify the poll. If '_' is in the poll_url the second
@@ -259,10 +696,46 @@ def poll(request, poll_url):
     modification
     """
 
+    def getValues(request, choices):
+        "Get the submitted values explicitly given"
+        absent_value = poll.getAbsentValue()
+        choices = dict([(choice.id, choice) for choice in choices])
+        values = {}
+        for key in request.POST:
+            if not request.POST[key]:
+                continue
+            try:
+                # standard vote
+                if key.startswith('choice_'):
+                    choice = choices[int(key.split('_')[1])]
+                    # try if a specific value is specified in the form
+                    # like in balanced poll
+                    try:
+                        value = int(request.POST[key])
+                    except ValueError:
+                        value = 1
+                # one choice vote
+                elif key == 'choice':
+                    choice = choices[int(request.POST[key])]
+                    value = 1
+                else:
+                    continue
+            except (ValueError, KeyError):
+                # bad choice id : the choice has probably been deleted
+                continue
+            if value in BALLOT_VALUES and value != absent_value:
+                values[choice] = value
+        return values
+
+    def getVotesData(choices, values):
+        "Explicit values of a vote sent to the webhooks"
+        return [{'choice':choice.name, 'value':values[choice]}
+                for choice in choices if choice in values]
+
     def modifyVote(request, choices):
         "Modify user's votes"
         try:
-            voter = Voter.objects.filter(
+            voter = Voter.objects.filter(poll=poll,
                                   id=int(request.POST['voter']))[0]
         except (ValueError, IndexError):
             return
@@ -275,9 +748,13 @@ def poll(request, poll_url):
                 v = Voter.objects.filter(user=voter.user)
                 if len(v) == 1 and v[0] == voter:
                     delete_user = voter.user
+            logBallot(voter, 'D', voter.getBallot(), '')
             for choice in choices:
                 v = Vote.objects.filter(voter=voter, choice=choice)
                 v.delete()
+            queueWebhookEvents(Webhook.objects.filter(poll=poll),
+                           'vote_deleted', voter_id=voter.id,
+                           voter=voter.user.name)
             voter.delete()
             if delete_user:
                 delete_user.delete()
@@ -285,63 +762,17 @@ def poll(request, poll_url):
         # update the name
         voter.user.name = request.POST['author_name']
         voter.user.save()
-        # update the modification date
-        voter.save()
-        selected_choices = []
-        # set the selected choices
-        for key in request.POST:
-            # modify a one choice poll
-            if key == 'vote' and request.POST[key]:
-                try:
-                    id = int(request.POST[key])
-                    vote = Vote.objects.filter(id=id)[0]
-                    if vote.choice not in choices:
-                        # bad vote id : the associated choice has
-                        # probably been deleted
-                        vote.delete()
-                    else:
-                        vote.value = 1
-                        vote.save()
-                        selected_choices.append(vote.choice)
-                except (ValueError, IndexError):
-                    # the vote don't exist anymore
-                    pass
-            # modify an existing vote
-            if key.startswith('vote_') and request.POST[key]:
-                try:
-                    id = int(key.split('_')[1])
-                    vote = Vote.objects.filter(id=id)[0]
-                    if vote.choice not in choices:
-                        # bad vote id : the associated choice has
-                        # probably been deleted
-                        vote.delete()
-                    else:
-                        # try if a specific value is specified in the form
-                        # like in balanced poll
-                        try:
-                            value = int(request.POST[key])
-                        except ValueError:
-                            value = 1
-                        vote.value = value
-                        vote.save()
-                        selected_choices.append(vote.choice)
-                except (ValueError, IndexError):
-                    # the vote don't exist anymore
-                    pass
-        # update non selected choices
-        for choice in choices:
-            if choice not in selected_choices:
-                try:
-                    v = Vote.objects.filter(voter=voter, choice=choice)[0]
-                    v.value = 0
-                except IndexError:
-                    # the vote don't exist with this choice : probably
-                    # a new choice
-                    v = Vote(voter=voter, choice=choice, value=0)
-                v.save()
+        # update the votes and the modification date
+        values = getValues(request, choices)
+        voter.setVotes(values)
+        queueWebhookEvents(Webhook.objects.filter(poll=poll), 'vote_modified',
+                           voter_id=voter.id, voter=voter.user.name,
+                           votes=getVotesData(choices, values))
     def newComment(request, poll):
         "Comment the poll"
-        if poll.comments.count() >= settings.MAX_COMMENT_NB:
+        comment_count = Poll.objects.filter(pk=poll.pk).values_list(
+                                               'comment_count', flat=True)[0]
+        if comment_count >= settings.MAX_COMMENT_NB:
             return
         if 'comment_author' not in request.POST \
            or not request.POST['comment_author'] \
@@ -350,6 +781,8 @@ def poll(request, poll_url):
         c = Comment(poll=poll, author_name=request.POST['comment_author'],
                     text=request.POST['comment'])
         c.save()
+        notifyAuthor(poll, 'C', c.author_name)
+        poll.touch()
 
     def newVote(request, choices):
         "Create new votes"
@@ -358,50 +791,14 @@ def poll(request, poll_url):
         author = PollUser(name=request.POST['author_name'])
         author.save()
         voter = Voter(user=author, poll=poll)
-        voter.save()
-        selected_choices = []
-
-        # set the selected choices
-        for key in request.POST:
-            # standard vote
-            if key.startswith('choice_') and request.POST[key]:
-                try:
-                    id = int(key.split('_')[1])
-                    choice = Choice.objects.filter(id=id)[0]
-                    if choice not in choices:
-                        raise ValueError
-                    # try if a specific value is specified in the form
-                    # like in balanced poll
-                    try:
-                        value = int(request.POST[key])
-                    except ValueError:
-                        value = 1
-                    v = Vote(voter=voter, choice=choice, value=value)
-                    v.save()
-                    selected_choices.append(choice)
-                except (ValueError, IndexError):
-                    # bad choice id : the choice has probably been deleted
-                    pass
-            # one choice vote
-            if key == 'choice' and request.POST[key]:
-                try:
-                    id = int(request.POST[key])
-                    choice = Choice.objects.filter(id=id)[0]
-                    if choice not in choices:
-                        raise ValueError
-                    v = Vote(voter=voter, choice=choice, value=1)
-                    v.save()
-                    selected_choices.append(choice)
-                except (ValueError, IndexError):
-                    # bad choice id : the choice has probably been deleted
-                    pass
-        # set non selected choices
-        for choice in choices:
-            if choice not in selected_choices:
-                v = Vote(voter=voter, choice=choice, value=0)
-                v.save()
+        values = getValues(request, choices)
+        voter.setVotes(values)
+        notifyAuthor(poll, 'V', author.name)
+        queueWebhookEvents(Webhook.objects.filter(poll=poll), 'vote',
+                           voter_id=voter.id, voter=author.name,
+                           votes=getVotesData(choices, values))
         # results can now be displayed
-        request.session['knowned_vote_' + poll.base_url] = 1
+        setKnownVote(request, poll)
     response_dct, redirect = getBaseResponse(request)
     if redirect:
         return redirect
@@ -414,28 +811,54 @@ def poll(request, poll_url):
                 highlight_vote_date = int(highlight_vote_date)
             except ValueError:
                 highlight_vote_date = None
-    try:
-        poll = Poll.objects.filter(base_url=poll_url)[0]
-    except IndexError:
-        poll = None
-    choices = list(Choice.objects.filter(poll=poll))
+    def getPollChoices():
+        "Get the poll and its choices"
+        poll = getPoll(base_url=poll_url)
+        return poll, list(Choice.objects.filter(poll=poll))
+    with measured():
+        poll, choices = getPollChoices()
+    if (not choices or not poll) and onReplica():
+        # the poll may not be replicated yet
+        pinPrimary()
+        poll, choices = getPollChoices()
     # if the poll don't exist or if it has no choices the user is
     # redirected to the main page
     if not choices or not poll:
         return HttpResponseRedirect(reverse('index'))
 
-    # a vote is submitted
-    if 'author_name' in request.POST and poll.open:
+    def submitVote(request, choices):
+        "Record the submitted vote"
         if 'voter' in request.POST:
             # modification of an old vote
             modifyVote(request, choices)
         else:
             newVote(request, choices)
         # update the modification date of the poll
-        poll.save()
+        poll.touch()
+        deferAvailability(poll)
+
+    # a vote is submitted
+    if 'author_name' in request.POST and poll.open:
+        duplicate = None
+        if 'voter' not in request.POST and request.POST['author_name']:
+            duplicate = isDuplicateBallot(request, poll)
+        if duplicate == 'name':
+            response_dct['error'] = _("This vote has already been "
+                                      "recorded.")
+        elif duplicate == 'client' and 'confirm_vote' not in request.POST:
+            # the browsers behind a same address can look the same: the
+            # voter confirms
+            response_dct['error'] = _("A vote has already been recorded "
+                     "from this browser. If it is not yours, send your vote "
+                     "again to confirm it.")
+            response_dct['confirm_vote'] = request.POST['author_name']
+        else:
+            write(submitVote, request, choices)
+            if 'voter' not in request.POST and request.POST['author_name']:
+                addBallot(request, poll)
     if 'comment' in request.POST and poll.open:
         # comment posted
-        newComment(request, poll)
+        write(newComment, request, poll)
 
     # 'voter' is in request.GET when the edit button is pushed
     if 'voter' in request.GET and poll.open:
@@ -445,27 +868,17 @@ def poll(request, poll_url):
             pass
 
     response_dct.update({'poll':poll,
-                         'VOTE':Vote.VOTE,})
+                         'VOTE':Vote.VOTE,
+                         'banner_mark':BANNER_MARK})
     response_dct['base_url'] = "/".join(request.path.split('/')[:-2]) \
                                + '/%s/' % poll.base_url
 
-    # get voters and sum for each choice for this poll
-    voters = Voter.objects.filter(poll=poll)
-    choice_ids = [choice.id for choice in choices]
-    for voter in voters:
-        # highlight a voter
-        if time.mktime(voter.modification_date.timetuple()) \
-                                                         == highlight_vote_date:
-            voter.highlight = True
-        voter.votes = voter.getVotes(choice_ids)
-        # initialize undefined vote
-        choice_vote_ids = [vote.choice.id for vote in voter.votes]
-        for choice in choices:
-            if choice.id not in choice_vote_ids:
-                vote = Vote(voter=voter, choice=choice, value=None)
-                vote.save()
-        voter.votes.sort(lambda x, y : cmp(choices.index(x.choice), choices.index(y.choice)))
-    sums = [choice.getSum(poll.type == 'B') for choice in choices]
+    # sum for each choice for this poll
+    sums = poll.getSums(choices)
+    for choice, sum in zip(choices, sums):
+        choice.sum = sum
+    if poll.type == 'B':
+        sums = [sum/2 for sum in sums]
     vote_max = max(sums)
     c_idx = 0
     while c_idx < len(choices):
@@ -480,21 +893,86 @@ def poll(request, poll_url):
     for choice in choices:
         if choice.limit:
            response_dct['limit_set'] = True
-        if choice.limit and sums[choices.index(choice)] >= choice.limit:
-            choice.available = False
-        else:
-            choice.available = True
-        choice.save()
-    response_dct['voters'] = voters
+    # saved in the background by the votes and the modifications of choices
+    poll.checkAvailability(choices, sums)
     response_dct['choices'] = choices
-    response_dct['comments'] = Comment.objects.filter(poll=poll)
     # verify if vote's result has to be displayed
     response_dct['hide_vote'] = poll.hide_choices
     if poll.hide_choices:
         if u'display_result' in request.GET:
-            request.session['knowned_vote_' + poll.base_url] = 1
-        if 'knowned_vote_' + poll.base_url in request.session:
+            setKnownVote(request, poll)
+        if isKnownVote(request, poll):
             response_dct['hide_vote'] = False
     response_dct['form_comment'] = CommentForm()
     response_dct['max_comment_nb'] = settings.MAX_COMMENT_NB
-    return render_to_response('vote.html', response_dct)
+    response_dct['comments_wait'] = settings.COMMENTS_WAIT
+    if settings.MAX_COMMENT_NB and not response_dct['hide_vote']:
+        response_dct.update(getComments(poll))
+
+    # get voters
+    voters = Voter.objects.filter(poll=poll)
+    absent_value = poll.getAbsentValue()
+    renderer = CellRenderer(poll)
+    def prepareVoters(chunk):
+        "Set votes and cells of a chunk of voters"
+        for voter in chunk:
+            # highlight a voter
+            if time.mktime(voter.modification_date.timetuple()) \
+                                                         == highlight_vote_date:
+                voter.highlight = True
+            voter.votes = voter.getVotes(choices, absent_value)
+            voter.cells = renderer.render(voter.votes)
+        return chunk
+
+    if response_dct['hide_vote']:
+        response_dct['voters'] = []
+    elif settings.VOTERS_PER_PAGE:
+        # the page starts after the "voters_after" voter or with the edited
+        # voter
+        after, included = None, False
+        try:
+            if 'current_voter_id' in response_dct:
+                after = voters.get(id=response_dct['current_voter_id'])
+                included = True
+            elif 'voters_after' in request.GET:
+                after = voters.get(id=int(request.GET['voters_after']))
+        except (ValueError, Voter.DoesNotExist):
+            pass
+        page = []
+        for chunk in iterVoters(voters, after, settings.VOTERS_PER_PAGE + 1,
+                                included):
+            page = chunk
+            break
+        if len(page) > settings.VOTERS_PER_PAGE:
+            page = page[:settings.VOTERS_PER_PAGE]
+            response_dct['next_voters'] = page[-1].id
+        response_dct['previous_voters'] = bool(after)
+        response_dct['voters'] = prepareVoters(page)
+    elif settings.STREAM_VOTERS:
+        # the voter lines are rendered while the response is sent
+        response_dct['voters_mark'] = VOTERS_MARK
+        head, tail = loader.render_to_string('vote.html', response_dct
+                                             ).split(VOTERS_MARK)
+        state, language = saveState(), translation.get_language()
+        def streamPage():
+            # encoded here as the gzip middleware doesn't encode the content
+            yield head.encode(settings.DEFAULT_CHARSET)
+            lines = loader.get_template('voter_lines.html')
+            with restoredState(state):
+                with translation.override(language):
+                    for chunk in iterVoters(voters,
+                                    chunk_size=settings.VOTERS_CHUNK_SIZE):
+                        yield lines.render(Context(dict(response_dct,
+                                                 voters=prepareVoters(chunk))
+                                            )).encode(settings.DEFAULT_CHARSET)
+            yield tail.encode(settings.DEFAULT_CHARSET)
+        return StreamingHttpResponse(streamPage())
+    else:
+        response_dct['voters'] = prepareVoters(list(voters.select_related(
+                                                                    'user')))
+    response = render_to_response('vote.html', response_dct)
+    if request.method == 'GET' and not request.GET and not poll.hide_choices \
+       and not highlight_vote_date:
+        # the same for every browser: served when the site is overloaded
+        keepPage(poll, response)
+    return response
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# See the file COPYING for details.
+
+'''
+Delivery of the webhook events
+'''
+
+import datetime
+import hashlib
+import hmac
+import httplib
+import socket
+import sys
+import threading
+import time
+import traceback
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+
+from papillon.polls.models import WebhookEvent
+
+# private, loopback, link-local, multicast and reserved networks: never
+# called unless their host is in WEBHOOKS_ALLOWED_HOSTS
+UNSAFE_NETWORKS = ('0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8',
+                   '169.254.0.0/16', '172.16.0.0/12', '192.0.0.0/24',
+                   '192.0.2.0/24', '192.168.0.0/16', '198.18.0.0/15',
+                   '198.51.100.0/24', '203.0.113.0/24', '224.0.0.0/3',
+                   '::/127', '100::/64', '2001::/23', '2001:db8::/32',
+                   'fc00::/7', 'fe80::/10', 'fec0::/10', 'ff00::/8')
+
+class UnsafeAddress(socket.error):
+    "The server of a webhook is not on a public address"
+
+def parseAddress(address):
+    "Size in bits and value of an IPv4 or IPv6 address - None if invalid"
+    for family, bits in ((socket.AF_INET, 32), (socket.AF_INET6, 128)):
+        try:
+            packed = socket.inet_pton(family, address)
+        except (socket.error, ValueError):
+            continue
+        return bits, int(packed.encode('hex'), 16)
+
+def parseNetwork(network):
+    address, prefix = network.split('/')
+    bits, value = parseAddress(address)
+    return bits, value, int(prefix)
+
+_unsafe_networks = [parseNetwork(network) for network in UNSAFE_NETWORKS]
+
+def isPublicAddress(address):
+    "Check that an IP address is not in UNSAFE_NETWORKS"
+    parsed = parseAddress(address.split('%')[0])
+    if not parsed:
+        return False
+    bits, value = parsed
+    if bits == 128 and value >> 32 == 0xffff:
+        # IPv4-mapped address
+        bits, value = 32, value & 0xffffffff
+    for network_bits, network, prefix in _unsafe_networks:
+        if network_bits == bits \
+           and value >> (bits - prefix) == network >> (bits - prefix):
+            return False
+    return True
+
+def isAllowedHost(host):
+    return host.lower() in [allowed.lower() for allowed
+                            in settings.WEBHOOKS_ALLOWED_HOSTS]
+
+def getSafeAddress(host, port):
+    '''Address to connect to a server resolved at each connection: a name
+    which resolves to a private or local address is refused even if it was
+    public when the webhook was declared'''
+    if isAllowedHost(host):
+        return host, port
+    addresses = [info[4][0] for info in socket.getaddrinfo(host, port, 0,
+                                                           socket.SOCK_STREAM)]
+    unsafe = [address for address in addresses if not isPublicAddress(address)]
+    if unsafe:
+        raise UnsafeAddress('%s resolves to %s' % (host, unsafe[0]))
+    return addresses[0], port
+
+class HTTPConnection(httplib.HTTPConnection):
+    "Connection to the checked address of the server"
+    def connect(self):
+        self.sock = socket.create_connection(getSafeAddress(self.host,
+                                                            self.port),
+                                             self.timeout)
+
+class HTTPSConnection(httplib.HTTPSConnection):
+    "Connection to the checked address of the server - Python 2.7.9 or later"
+    def connect(self):
+        sock = socket.create_connection(getSafeAddress(self.host, self.port),
+                                        self.timeout)
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+CONNECTIONS = {'http':HTTPConnection, 'https':HTTPSConnection}
+
+def sign(secret, timestamp, body):
+    '''Signature of "timestamp.body" checked by the receivers of the webhooks:
+    an old timestamp denotes a replayed request'''
+    return 'sha256=' + hmac.new(str(secret), '%s.%s' % (timestamp, body),
+                                hashlib.sha256).hexdigest()
+
+def getEndpoint(url):
+    "Scheme and server of an address"
+    parsed = urlparse.urlsplit(url)
+    return parsed.scheme, parsed.netloc
+
+class Deliverer(object):
+    '''POST events to their webhooks with a bounded pool of threads.
+    The connections to an endpoint are kept open between the events and at
+    most ENDPOINT_CONCURRENCY requests are made at once to an endpoint: the
+    events of a busy endpoint are left in the queue instead of waiting in a
+    thread, so a slow endpoint holds a few threads, not the whole pool. Each
+    delivery is saved as soon as it ends.
+    '''
+    def __init__(self, threads, endpoint_concurrency, timeout):
+        self.pool = ThreadPool(threads)
+        self.threads = threads
+        self.endpoint_concurrency = endpoint_concurrency
+        self.timeout = timeout
+        # deliveries in progress and their webhooks by endpoint
+        self.running = {}
+        self.webhooks = {}
+        # open connections not used by a thread by endpoint
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.ended = threading.Condition(self.lock)
+        self.delivered, self.failed = 0, 0
+
+    def getFreeThreads(self):
+        with self.lock:
+            return self.threads - sum(self.running.values())
+
+    def getBusyWebhooks(self):
+        "Ids of the webhooks whose endpoint has no delivery left"
+        with self.lock:
+            return [webhook_id for endpoint, running in self.running.items()
+                    if running >= self.endpoint_concurrency
+                    for webhook_id in self.webhooks[endpoint]]
+
+    def isBusy(self):
+        with self.lock:
+            return bool(self.running)
+
+    def getStats(self):
+        "Number of delivered and failed events"
+        with self.lock:
+            return self.delivered, self.failed
+
+    def getEnded(self):
+        "Number of ended deliveries"
+        with self.lock:
+            return self.delivered + self.failed
+
+    def getConnection(self, endpoint):
+        "An idle connection to an endpoint or a new one and if it is new"
+        with self.lock:
+            if self.idle.get(endpoint):
+                return self.idle[endpoint].pop(), False
+        scheme, netloc = endpoint
+        return CONNECTIONS[scheme](netloc, timeout=self.timeout), True
+
+    def releaseConnection(self, endpoint, connection):
+        with self.lock:
+            self.idle.setdefault(endpoint, []).append(connection)
+
+    def post(self, url, body, headers):
+        "POST body to url and return the status of the response"
+        parsed = urlparse.urlsplit(url)
+        endpoint = (parsed.scheme, parsed.netloc)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        while True:
+            connection, new = self.getConnection(endpoint)
+            try:
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if new:
+                    raise
+                # the endpoint has closed a kept connection: try again with a
+                # new one
+                continue
+            if response.will_close:
+                connection.close()
+            else:
+                self.releaseConnection(endpoint, connection)
+            return response.status
+
+    def deliver(self, event):
+        "Deliver an event and return if it has been received"
+        body = event.payload.encode('utf-8')
+        timestamp = str(int(time.time()))
+        headers = {'Content-Type':'application/json',
+                   'User-Agent':'Papillon',
+                   'X-Papillon-Event':event.event,
+                   'X-Papillon-Delivery':str(event.pk),
+                   'X-Papillon-Timestamp':timestamp,
+                   'X-Papillon-Signature':sign(event.webhook.secret,
+                                               timestamp, body)}
+        try:
+            status = self.post(event.webhook.url, body, headers)
+        except (httplib.HTTPException, socket.error, KeyError):
+            # KeyError: unknown scheme
+            return False
+        return 200 <= status < 300
+
+    def start(self, event, using):
+        '''Start the delivery of an event of the database using in a thread
+        unless its endpoint is busy. Return if it is started.'''
+        endpoint = getEndpoint(event.webhook.url)
+        with self.lock:
+            # excluded from the next claims while the endpoint is busy
+            self.webhooks.setdefault(endpoint, set()).add(event.webhook_id)
+            running = self.running.get(endpoint, 0)
+            if running >= self.endpoint_concurrency:
+                return False
+            self.running[endpoint] = running + 1
+        self.pool.apply_async(self.deliverEvent, (event, endpoint, using))
+        return True
+
+    def deliverEvent(self, event, endpoint, using):
+        "Deliver an event and save the result"
+        received = False
+        try:
+            received = self.deliver(event)
+            saveDelivery(event, received, using)
+        except Exception:
+            # the event is delivered again at the end of its lease
+            traceback.print_exc(file=sys.stderr)
+        finally:
+            with self.lock:
+                self.running[endpoint] -= 1
+                if not self.running[endpoint]:
+                    del self.running[endpoint]
+                    del self.webhooks[endpoint]
+                if received:
+                    self.delivered += 1
+                else:
+                    self.failed += 1
+                self.ended.notify_all()
+
+    def wait(self, timeout, ended=None):
+        '''Wait for the end of a delivery - at most timeout seconds. With
+        ended, the number of ended deliveries given by getEnded, return at
+        once if a delivery has ended since.'''
+        with self.lock:
+            if self.running and (ended is None
+                                 or self.delivered + self.failed == ended):
+                self.ended.wait(timeout)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for connections in self.idle.values():
+            for connection in connections:
+                connection.close()
+
+def saveDelivery(event, received, using):
+    '''Delete a delivered event - a failed one is tried again later with a
+    doubled delay'''
+    events = WebhookEvent.objects.using(using).filter(pk=event.pk)
+    if received:
+        events.delete()
+        return
+    event.attempts += 1
+    if event.attempts >= settings.WEBHOOKS_MAX_ATTEMPTS:
+        # abandoned
+        events.delete()
+        return
+    delay = settings.WEBHOOKS_RETRY_DELAY * 2 ** (event.attempts - 1)
+    events.update(attempts=event.attempts, next_attempt=datetime.datetime.now()
+                                       + datetime.timedelta(seconds=delay))
+
+def claimDueEvents(using, number, busy_webhooks):
+    '''Claim number events due on a database - except the ones of the busy
+    webhooks: another worker does not deliver them during WEBHOOKS_LEASE
+    seconds - they are delivered again after that if this worker has stopped.
+    '''
+    now = datetime.datetime.now()
+    lease = now + datetime.timedelta(seconds=settings.WEBHOOKS_LEASE)
+    claimed = []
+    for event in WebhookEvent.objects.using(using).filter(
+                     next_attempt__lte=now).exclude(webhook__in=busy_webhooks
+                     ).select_related('webhook').order_by('next_attempt',
+                                                          'id')[:number]:
+        # not claimed meanwhile by another worker
+        if WebhookEvent.objects.using(using).filter(pk=event.pk,
+                    next_attempt=event.next_attempt).update(next_attempt=lease):
+            claimed.append(event)
+    return claimed
+
+def deliverDueEvents(deliverer, using):
+    '''Start the delivery of the events due on a database - at most one by
+    free thread of the deliverer. The events of an endpoint which has become
+    busy are put behind the events queued meanwhile. Return the number of
+    started and postponed deliveries.
+    '''
+    number = min(deliverer.getFreeThreads(), settings.WEBHOOKS_BATCH_SIZE)
+    if number <= 0:
+        return 0, 0
+    started, postponed = 0, []
+    for event in claimDueEvents(using, number, deliverer.getBusyWebhooks()):
+        if deliverer.start(event, using):
+            started += 1
+        else:
+            postponed.append(event.pk)
+    WebhookEvent.objects.using(using).filter(pk__in=postponed).update(
+                                      next_attempt=datetime.datetime.now())
+    return started, len(postponed)
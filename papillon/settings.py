@@ -14,9 +14,100 @@ EXTRA_URL = 'papillon/'
 
 TINYMCE_URL = 'http://localhost/tinymce/'
 MAX_COMMENT_NB = 10 # max number of comments by poll - 0 to disable comments
+# the previous comments are loaded on demand
+COMMENTS_ON_PAGE = 20
+# seconds a request for new comments waits for them - only with asynchronous
+# workers (see docs/conf/gunicorn.conf.py) as each request holds a worker
+COMMENTS_WAIT = 0
 ALLOW_FRONTPAGE_POLL = False # disabled is recommanded for public instance
 # time to live in days
 DAYS_TO_LIVE = 30
+# store the votes of a voter packed in one row instead of one row by choice -
+# existing votes are converted with "./manage.py pack_ballots"
+PACKED_BALLOTS = False
+# display the voters of a poll by pages of VOTERS_PER_PAGE voters - None to
+# display all of them
+VOTERS_PER_PAGE = None
+# send the poll pages while their voters are read by chunks of
+# VOTERS_CHUNK_SIZE voters - not used with VOTERS_PER_PAGE
+STREAM_VOTERS = False
+VOTERS_CHUNK_SIZE = 100
+# keep the hidden polls whose results can be displayed to a browser in a
+# signed cookie - at most KNOWN_VOTES_MAX polls - instead of the session
+KNOWN_VOTES_COOKIE = False
+KNOWN_VOTES_MAX = 100
+# above this number of polls (according to the statistics of PostgreSQL or
+# MySQL) the unfiltered list of the administration pages doesn't count them
+ADMIN_ESTIMATED_COUNT = 100000
+# limits of the votes and comments posted: (number of posts, seconds) by
+# client address and by poll - None to disable. Their counters are kept in the
+# cache: configure a shared cache (memcached, see local_settings.py.sample)
+# when Papillon runs in several processes.
+POST_RATE_BY_CLIENT = None
+POST_RATE_BY_POLL = None
+# header of the client address - 'HTTP_X_FORWARDED_FOR' behind a proxy
+CLIENT_ADDRESS_HEADER = 'REMOTE_ADDR'
+# refuse the new votes of a poll with the author name ('name') of a previous
+# vote and ask a confirmation of the new votes from the browser ('client') of
+# a previous vote - () to disable. The browser is known by its address and its
+# headers: the browsers of a same model behind a same address (NAT, school or
+# company network) look the same, hence the confirmation. The previous votes
+# are remembered in the cache for DUPLICATE_FILTER_TIMEOUT seconds in a filter
+# of DUPLICATE_FILTER_BYTES bytes by poll.
+DUPLICATE_BALLOTS = ()
+DUPLICATE_FILTER_BYTES = 4096
+DUPLICATE_FILTER_TIMEOUT = 30 * 24 * 3600
+# maximum number of choices of a poll created with the JSON API
+API_MAX_CHOICES = 500
+# overload protection: above OVERLOAD_REQUESTS requests in progress in a
+# process or an average database latency of OVERLOAD_LATENCY seconds, the poll
+# pages are served from their last rendering (kept OVERLOAD_PAGE_TIMEOUT
+# seconds in the cache) and the posts are refused during OVERLOAD_RETRY
+# seconds - None to disable
+OVERLOAD_REQUESTS = None
+OVERLOAD_LATENCY = None
+OVERLOAD_RETRY = 30
+OVERLOAD_PAGE_TIMEOUT = 24 * 3600
+# deferred tasks (sorting of the dated choices, availability of the choices,
+# erasement of the old polls every TASKS_CLEANING_INTERVAL seconds - by
+# transactions on TASKS_CLEANING_CHUNK polls) executed
+# by TASKS_THREADS threads of each process - 0 to execute them only with
+# "./manage.py run_tasks --loop". The queue is checked every TASKS_INTERVAL
+# seconds and a failed task is tried again after TASKS_RETRY_DELAY seconds,
+# doubled each time, TASKS_MAX_ATTEMPTS times at most. A task started by a
+# stopped runner is started again after TASKS_LEASE seconds.
+TASKS_THREADS = 2
+TASKS_INTERVAL = 5
+TASKS_BATCH_SIZE = 100
+TASKS_RETRY_DELAY = 30
+TASKS_MAX_ATTEMPTS = 5
+TASKS_LEASE = 600
+TASKS_CLEANING_INTERVAL = 24 * 3600
+TASKS_CLEANING_CHUNK = 20
+# the tally of a poll is snapshotted by "./manage.py snapshot_tallies" after
+# TALLY_SNAPSHOT_EVENTS new ballot events: its results at a date are replayed
+# from the nearest snapshot
+TALLY_SNAPSHOT_EVENTS = 1000
+# digests of new votes and comments sent by "./manage.py send_notifications"
+# by batches of NOTIFICATIONS_BATCH_SIZE e-mails on the same SMTP connection
+NOTIFICATIONS_BATCH_SIZE = 100
+DEFAULT_FROM_EMAIL = 'papillon@localhost'
+# events of the webhooks delivered by "./manage.py deliver_webhooks" with
+# WEBHOOKS_THREADS threads - at most WEBHOOKS_ENDPOINT_CONCURRENCY at once for
+# the same server. A failed delivery is tried again after WEBHOOKS_RETRY_DELAY
+# seconds, doubled each time, WEBHOOKS_MAX_ATTEMPTS times at most. The events
+# claimed by a stopped worker are delivered again after WEBHOOKS_LEASE seconds.
+WEBHOOKS_THREADS = 10
+WEBHOOKS_ENDPOINT_CONCURRENCY = 2
+WEBHOOKS_TIMEOUT = 10 # in seconds
+WEBHOOKS_BATCH_SIZE = 100
+WEBHOOKS_RETRY_DELAY = 30
+WEBHOOKS_MAX_ATTEMPTS = 10
+WEBHOOKS_LEASE = 600
+# the webhooks are not called on private, loopback, link-local or reserved
+# addresses except on these hosts (names or addresses as written in the
+# address of the webhooks), e.g. ('192.168.1.10', 'intranet.example.com')
+WEBHOOKS_ALLOWED_HOSTS = ()
 
 ADMINS = (
     # ('Your Name', 'your_email@domain.com'),
@@ -35,6 +126,25 @@ DATABASES = {
     }
 }
 
+# PRAGMA set on each new sqlite connection - see local_settings.py.sample for
+# a production profile
+SQLITE_PRAGMAS = {}
+# execute all the writes one after the other in a dedicated thread
+SINGLE_WRITER = False
+
+# alias in DATABASES of a replica of the default database used by read-only
+# views - see local_settings.py.sample
+REPLICA_DATABASE = None
+REPLICA_VIEWS = ('index', 'category', 'poll', 'feed')
+# time in seconds during which a browser reads from the default database after
+# a modification - must be greater than the replication lag
+REPLICA_STICKY_TIME = 30
+# aliases in DATABASES where polls are spread - see local_settings.py.sample
+# a replica is not used with shards
+SHARD_DATABASES = ()
+DATABASE_ROUTERS = ['papillon.polls.routers.ShardRouter',
+                    'papillon.polls.routers.ReplicaRouter']
+
 # Local time zone for this installation. Choices can be found here:
 # http://www.postgresql.org/docs/8.1/static/datetime-keywords.html#DATETIME-TIMEZONE-SET-TABLE
 # although not all variations may be possible on all operating systems.
@@ -68,6 +178,17 @@ MEDIA_URL = '/static/'
 # if you have set an EXTRA_URL set the full path
 ADMIN_MEDIA_PREFIX = '/static/admin/'
 
+# static files collected with hashed names by "./manage.py collect_assets"
+ASSETS_ROOT = PROJECT_PATH + '/assets/'
+# if you have set an EXTRA_URL set the full path
+ASSETS_URL = '/assets/'
+# let the web server send the collected files: 'X-Sendfile' (Apache
+# mod_xsendfile, lighttpd) or 'X-Accel-Redirect' (nginx) - None to send them
+# with Django
+ASSETS_SENDFILE = None
+# nginx internal location of ASSETS_ROOT used with X-Accel-Redirect
+ASSETS_ACCEL_PREFIX = '/protected-assets/'
+
 SECRET_KEY = ''
 
 # List of callables that know how to import templates from various sources.
@@ -77,14 +198,23 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'django.middleware.gzip.GZipMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'papillon.polls.middleware.ThrottleMiddleware',
+    'papillon.polls.middleware.OverloadMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'papillon.polls.middleware.ReplicaMiddleware',
+    'papillon.polls.middleware.KnownVotesMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.doc.XViewMiddleware',
 )
 
 ROOT_URLCONF = 'papillon.urls'
+# also used by the development server: it sends the collected static files
+# without the middlewares
+WSGI_APPLICATION = 'papillon.wsgi.application'
 
 TEMPLATE_DIRS = (
     # Put strings here, like "/home/html/django_templates" or "C:/www/django/templates".
@@ -99,6 +229,7 @@ INSTALLED_APPS = (
     'django.contrib.admin',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
+    'django.contrib.messages',
     'django.contrib.sites',
     'django.contrib.markup',
 
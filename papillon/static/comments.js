@@ -0,0 +1,77 @@
+/* incremental loading of the comments of a poll */
+/* Copyright (C) 2013  Étienne Loks  <etienne.loks_AT_peacefrogsDOTnet>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as
+published by the Free Software Foundation, either version 3 of the
+License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+See the file COPYING for details.
+*/
+
+var comments_refresh = 60000; /* in milliseconds */
+
+/* callback is called with the list items - complete after the request */
+function getComments(query, callback, complete){
+    var request = new XMLHttpRequest();
+    request.open('GET', comments_url + query, true);
+    request.onreadystatechange = function(){
+        if (request.readyState != 4) return;
+        if (request.status == 200) callback(request.responseText);
+        if (complete) complete();
+    };
+    request.send(null);
+}
+
+/* id of the last displayed comment */
+function lastCommentId(){
+    var items = document.getElementById('comments').getElementsByTagName('li');
+    for (var idx = items.length - 1; idx >= 0; idx--){
+        if (items[idx].id) return items[idx].id.split('_')[1];
+    }
+    return 0;
+}
+
+/* the previous comments replace the link to them */
+function loadPreviousComments(link){
+    var item = link.parentNode;
+    getComments(link.href.substring(link.href.indexOf('?')), function(html){
+        var list = document.createElement('ul');
+        list.innerHTML = html;
+        while (list.firstChild)
+            item.parentNode.insertBefore(list.firstChild, item);
+        item.parentNode.removeChild(item);
+    });
+    return false;
+}
+
+/* when the server waits for new comments they are requested again at once */
+function refreshComments(){
+    getComments('?after=' + lastCommentId(), function(html){
+        document.getElementById('comments').innerHTML += html;
+    }, function(){
+        setTimeout(refreshComments, comments_wait ? 1000 : comments_refresh);
+    });
+}
+
+function initComments(){
+    var list = document.getElementById('comments');
+    if (!list) return;
+    list.onclick = function(event){
+        var target = (event || window.event).target;
+        if (target && target.parentNode.className == 'previous_comments')
+            return loadPreviousComments(target);
+    };
+    setTimeout(refreshComments, comments_wait ? 0 : comments_refresh);
+}
+
+if (window.addEventListener) window.addEventListener('load', initComments, false);
+else window.attachEvent('onload', initComments);
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Settings of the tests of Papillon: ./manage.py test polls --settings=test_settings
+# The test databases are sqlite files so the threads of the tests (writer,
+# webhook deliveries) share them. "replica" reads the test default database
+# and "shard1" and "shard2" are used by the sharding tests.
+
+from settings import *
+
+SECRET_KEY = SECRET_KEY or 'papillon-tests'
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': PROJECT_PATH + '/papillon.db',
+        'TEST_NAME': PROJECT_PATH + '/test_papillon.db',
+    },
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': PROJECT_PATH + '/papillon.db',
+        'TEST_MIRROR': 'default',
+    },
+    'shard1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': PROJECT_PATH + '/papillon_shard1.db',
+        'TEST_NAME': PROJECT_PATH + '/test_papillon_shard1.db',
+    },
+    'shard2': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': PROJECT_PATH + '/papillon_shard2.db',
+        'TEST_NAME': PROJECT_PATH + '/test_papillon_shard2.db',
+    },
+}
+# the tests set the replica and the shards they use
+REPLICA_DATABASE = None
+SHARD_DATABASES = ()
+SINGLE_WRITER = False
+
+# tables created from the models
+SOUTH_TESTS_MIGRATE = False
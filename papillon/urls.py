@@ -24,6 +24,7 @@ from django.contrib import admin
 admin.autodiscover()
 
 from polls.feeds import PollLatestEntries
+from papillon.polls.admin import shard_sites
 
 base = '^' + settings.EXTRA_URL
 if settings.EXTRA_URL and not base.endswith('/'):
@@ -36,6 +37,9 @@ urlpatterns = patterns('',
      url(base + r'^admin/', include(admin.site.urls)),
      url(base + r'$', 'papillon.polls.views.index', name='index'),
      url(base + r'create/$', 'papillon.polls.views.create', name='create'),
+     url(base + r'stats/$', 'papillon.polls.views.stats', name='stats'),
+     url(base + r'api/create/$', 'papillon.polls.views.createApi',
+            name='create_api'),
      url(base + r'edit/(?P<admin_url>\w+)/$',
             'papillon.polls.views.edit', name='edit'),
      url(base + r'editChoicesAdmin/(?P<admin_url>\w+)/$',
@@ -48,9 +52,18 @@ urlpatterns = patterns('',
             name='poll'),
      url(base + r'poll/(?P<poll_url>\w+)/vote/$', 'papillon.polls.views.poll',
             name='vote'),
+     url(base + r'poll/(?P<poll_url>\w+)/comments/$',
+            'papillon.polls.views.comments', name='comments'),
      url(base + r'feeds/poll/(?P<poll_url>\w+)$', PollLatestEntries(), name='feed'),
+     url(base + r'assets/(?P<path>.*)$', 'papillon.polls.views.asset',
+            name='asset'),
      (base + r'static/(?P<path>.*)$', 'django.views.static.serve',
                           {'document_root': settings.PROJECT_PATH + '/static'}),
      (base + r'media/(?P<path>.*)$', 'django.views.static.serve',
                           {'document_root': settings.PROJECT_PATH + '/media/'}),
 )
+
+for alias, site in shard_sites:
+    urlpatterns += patterns('',
+        (base + r'admin/shard/%s/' % alias, include(site.urls)),
+    )
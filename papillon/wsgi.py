@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# WSGI application of Papillon for WSGI servers loading it from its module
+# name (gunicorn papillon.wsgi:application)
+
+import os
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'papillon.settings')
+
+from papillon.polls.handlers import PapillonHandler
+application = PapillonHandler()